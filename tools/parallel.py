@@ -1,18 +1,27 @@
 import os
 import sys
+import heapq
+import select
+import signal
+import time
+import traceback
+import cPickle
 
 
 class ParallelError(Exception):
 
-    def __init__(self, out, errors):
+    def __init__(self, out, errors, results=None, tracebacks=None):
         self.out = out
         self.errors = errors
+        self.results = results or {}
+        self.tracebacks = tracebacks or {}
         Exception.__init__(self, out)
 
 
 class ParallelExecute(object):
 
-    def __init__(self, functions, max_simultaneous_procs=20):
+    def __init__(self, functions, max_simultaneous_procs=20, timeout=None,
+                 timeouts=None, costs=None):
         """
         This takes in a dictionary of functions which map to a set of
         functions that they depend on.
@@ -26,12 +35,27 @@ class ParallelExecute(object):
 
         max_simultaneous_procs: Throttle the number of processes we have
                                 running at once.
+
+        timeout: Seconds after which a function still running is killed and
+                 counts as failed (default: no limit).
+
+        timeouts: Dictionary of per function timeouts overriding timeout.
+
+        costs: Dictionary of the expected run time of the functions (in any
+               unit, default 1 each). Ready functions start in order of the
+               longest chain of costs from them to the end of the graph,
+               so the longest dependency chain starts as early as possible.
+               Functions of the same priority start in the order of the
+               list, or of their names for a dictionary.
         """
         if not isinstance(functions, dict):
-            function_list = functions
+            function_list = list(functions)
             functions = {}
             for fn in function_list:
                 functions[fn] = set()
+        else:
+            function_list = sorted(functions,
+                                   key=lambda fn: getattr(fn, "__name__", ""))
 
         dependents = {}
         for fn, deps in functions.iteritems():
@@ -43,41 +67,163 @@ class ParallelExecute(object):
         self.max_procs = max_simultaneous_procs
         self.functions = functions
         self.dependents = dependents
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        self.costs = costs or {}
+        self.priority = self._get_priority()
+        # Not id(fn), so that the order doesn't change from run to run
+        self.rank = dict((fn, n) for n, fn in enumerate(function_list))
         self.pid_map = {}
         self.ready_to_run = []
+        self.results = {}
+        self.tracebacks = {}
+
+    def _get_priority(self):
+        """
+        Compute the cost of the longest chain of dependents of every
+        function, the function included.
+        """
+        priority = {}
+        for root in self.functions:
+            stack = [root]
+            while stack:
+                fn = stack[-1]
+                if fn in priority:
+                    stack.pop()
+                    continue
+                todo = [d for d in self.dependents[fn] if d not in priority]
+                if todo:
+                    if [d for d in todo if d in stack]:
+                        # A cycle; the functions on it never get ready
+                        # and end up reported as a deadlock
+                        priority[fn] = self.costs.get(fn, 1)
+                        stack.pop()
+                        continue
+                    stack.extend(todo)
+                    continue
+                stack.pop()
+                priority[fn] = self.costs.get(fn, 1) + max(
+                    [priority[d] for d in self.dependents[fn]] or [0])
+        return priority
+
+    def _make_ready(self, fn):
+        heapq.heappush(self.ready_to_run,
+                       (-self.priority[fn], self.rank[fn], fn))
 
     def _run(self, function):
         self.functions.pop(function)
+        read_fd, write_fd = os.pipe()
         pid = os.fork()
         if pid:
-            self.pid_map[pid] = function
+            os.close(write_fd)
+            timeout = self.timeouts.get(function, self.timeout)
+            deadline = None
+            if timeout is not None:
+                deadline = time.time() + timeout
+            self.pid_map[pid] = (function, read_fd, [], deadline)
         else:
-            function()
-            sys.exit(0)
+            os.close(read_fd)
+            try:
+                try:
+                    result = (True, function(), None)
+                except Exception:
+                    result = (False, None, traceback.format_exc())
+                try:
+                    data = cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+                except Exception:
+                    data = cPickle.dumps((result[0], repr(result[1]),
+                                          result[2]),
+                                         cPickle.HIGHEST_PROTOCOL)
+                while data:
+                    data = data[os.write(write_fd, data):]
+            finally:
+                # os._exit() doesn't flush what the function printed
+                for stream in (sys.stdout, sys.stderr):
+                    try:
+                        stream.flush()
+                    except Exception:
+                        pass
+                os._exit(0)
+
+    def _wait(self):
+        """
+        Wait for at least one function to finish or time out.
+
+        :return: List of (pid, function, outcome) tuples, outcome being
+                (ok, result, traceback).
+        """
+        finished = []
+        while not finished:
+            fds = dict((read_fd, pid) for pid, (_, read_fd, _, _) in
+                       self.pid_map.iteritems())
+            deadlines = [deadline for _, _, _, deadline in
+                         self.pid_map.itervalues() if deadline is not None]
+            wait = None
+            if deadlines:
+                wait = max(0, min(deadlines) - time.time())
+            readable = select.select(fds.keys(), [], [], wait)[0]
+            for read_fd in readable:
+                pid = fds[read_fd]
+                function, _, chunks, _ = self.pid_map[pid]
+                data = os.read(read_fd, 65536)
+                if data:
+                    chunks.append(data)
+                    continue
+                del self.pid_map[pid]
+                os.close(read_fd)
+                status = os.waitpid(pid, 0)[1]
+                try:
+                    outcome = cPickle.loads("".join(chunks))
+                except Exception:
+                    outcome = (False, None, "Process exited with status "
+                               "%d without a result\n" % status)
+                finished.append((pid, function, outcome))
+            now = time.time()
+            for pid, (function, read_fd, _, deadline) in self.pid_map.items():
+                if deadline is None or now < deadline:
+                    continue
+                del self.pid_map[pid]
+                os.close(read_fd)
+                os.kill(pid, signal.SIGKILL)
+                os.waitpid(pid, 0)
+                timeout = self.timeouts.get(function, self.timeout)
+                finished.append((pid, function,
+                                 (False, None, "Timed out after %s s\n" %
+                                  timeout)))
+        return finished
 
     def run_until_completion(self):
+        """
+        Run the functions, each in a process of its own, once all the
+        functions it depends on succeeded.
+
+        :return: Dictionary of the return values of the functions.
+        :raise ParallelError: If functions failed (raised, died or timed
+                out) or could never run; its results and tracebacks
+                attributes hold the outcome of every function that ran.
+        """
         for fn, deps in self.functions.iteritems():
             if len(deps) == 0:
-                self.ready_to_run.append(fn)
+                self._make_ready(fn)
 
         errors = []
         while len(self.pid_map) > 0 or len(self.ready_to_run) > 0:
             max_allowed = self.max_procs - len(self.pid_map)
             max_able = len(self.ready_to_run)
             for _ in xrange(min(max_allowed, max_able)):
-                self._run(self.ready_to_run.pop())
+                self._run(heapq.heappop(self.ready_to_run)[-1])
 
-            # Handle one proc that's finished.
-            pid, status = os.wait()
-            fn = self.pid_map.pop(pid)
-            if status != 0:
-                errors.append("%s failed" % fn.__name__)
-                continue
+            for pid, fn, (ok, result, tb) in self._wait():
+                if not ok:
+                    self.tracebacks[fn] = tb
+                    errors.append("%s failed:\n%s" % (fn.__name__, tb))
+                    continue
+                self.results[fn] = result
 
-            for dependent in self.dependents[fn]:
-                self.functions[dependent].remove(fn)
-                if len(self.functions[dependent]) == 0:
-                    self.ready_to_run.append(dependent)
+                for dependent in self.dependents[fn]:
+                    self.functions[dependent].remove(fn)
+                    if len(self.functions[dependent]) == 0:
+                        self._make_ready(dependent)
 
         if len(self.functions) > 0 and len(errors) == 0:
             errors.append("Deadlock detected")
@@ -85,7 +231,9 @@ class ParallelExecute(object):
         if len(errors) > 0:
             msg = "Errors occurred during execution:"
             msg = '\n'.join([msg] + errors)
-            raise ParallelError(msg, errors)
+            raise ParallelError(msg, errors, self.results, self.tracebacks)
+
+        return self.results
 
 
 def redirect_io(log_file='/dev/null'):
@@ -0,0 +1,98 @@
+#!/usr/bin/python
+
+import os
+import sys
+import heapq
+import tempfile
+import unittest
+
+import common
+import parallel
+
+
+def add():
+    return 1 + 1
+
+
+def fail():
+    raise ValueError("failed")
+
+
+def write():
+    # Buffered, as after redirect_io(), and no newline, so that nothing
+    # flushes it before the process exits
+    sys.stdout = os.fdopen(1, "w")
+    sys.stderr = os.fdopen(2, "w")
+    sys.stdout.write("out")
+    sys.stderr.write("err")
+    return "written"
+
+
+class ParallelExecuteTest(unittest.TestCase):
+
+    def testResults(self):
+        functions = {add: set(), write: set([add])}
+        results = self.run_functions(functions)[0]
+        self.assertEqual(results, {add: 2, write: "written"})
+
+    def testException(self):
+        functions = {add: set(), fail: set(), write: set([fail])}
+        try:
+            self.run_functions(functions)
+        except parallel.ParallelError, details:
+            self.assertEqual(details.results, {add: 2})
+            self.assertEqual(details.tracebacks.keys(), [fail])
+            self.assertTrue("ValueError: failed" in details.tracebacks[fail])
+        else:
+            self.fail("ParallelError not raised")
+
+    def testOrder(self):
+        # Functions of the same priority start in a reproducible order
+        functions = []
+        for name in "cab":
+            fn = lambda: None
+            fn.__name__ = name
+            functions.append(fn)
+        for functions, expected in ((functions, "cab"),
+                                    (dict.fromkeys(functions, ()), "abc")):
+            execute = parallel.ParallelExecute(functions)
+            for fn in execute.functions:
+                execute._make_ready(fn)
+            order = ""
+            while execute.ready_to_run:
+                order += heapq.heappop(execute.ready_to_run)[-1].__name__
+            self.assertEqual(order, expected)
+
+    def testOutput(self):
+        output = self.run_functions([write])[1]
+        self.assertEqual(sorted(output), ["err", "out"])
+
+    def run_functions(self, functions):
+        """
+        Run functions with stdout and stderr going to temporary files.
+
+        :return: Tuple (results, [stdout text, stderr text]).
+        """
+        files = [tempfile.TemporaryFile() for _ in range(2)]
+        saved = []
+        for fd, out in zip((1, 2), files):
+            (sys.stdout, sys.stderr)[fd - 1].flush()
+            saved.append(os.dup(fd))
+            os.dup2(out.fileno(), fd)
+        try:
+            execute = parallel.ParallelExecute(functions)
+            results = execute.run_until_completion()
+        finally:
+            for fd, saved_fd in zip((1, 2), saved):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+        output = []
+        for out in files:
+            out.seek(0)
+            output.append(out.read())
+            out.close()
+        return results, output
+
+
+if __name__ == '__main__':
+    unittest.main()
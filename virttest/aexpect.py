@@ -14,6 +14,7 @@ import fcntl
 import tempfile
 import logging
 import shutil
+import collections
 
 BASE_DIR = os.path.join('/tmp', 'aexpect')
 
@@ -98,6 +99,91 @@ def _get_reader_filename(base_dir, a_id, reader):
     return os.path.join(base_dir, a_id, "outpipe-%s" % reader)
 
 
+class _OutputBuffer(object):
+
+    """
+    Output of a child process, kept as a list of chunks (appending to a
+    string copies it every time).
+
+    With a limit, only the last limit bytes are kept, the oldest output
+    being dropped as new output comes in.
+    """
+
+    def __init__(self, limit=None):
+        self.chunks = collections.deque()
+        self.size = 0
+        self.limit = limit
+
+    def __len__(self):
+        return self.size
+
+    def append(self, data):
+        if data:
+            self.chunks.append(data)
+            self.size += len(data)
+            self._trim()
+
+    def unread(self, data):
+        """
+        Put data back at the beginning of the buffer.
+        """
+        if data:
+            self.chunks.appendleft(data)
+            self.size += len(data)
+
+    def set_limit(self, limit):
+        """
+        :param limit: Number of bytes to keep, or None to keep everything.
+        """
+        self.limit = limit
+        self._trim()
+
+    def _trim(self):
+        if not self.limit:
+            return
+        while self.size > self.limit:
+            excess = self.size - self.limit
+            chunk = self.chunks[0]
+            if len(chunk) <= excess:
+                self.chunks.popleft()
+                self.size -= len(chunk)
+            else:
+                self.chunks[0] = chunk[excess:]
+                self.size -= excess
+
+    def read(self, size=None):
+        """
+        Remove the first size bytes (by default all of them) of the buffer
+        and return them.
+        """
+        if size is None or size >= self.size:
+            data = "".join(self.chunks)
+            self.chunks.clear()
+            self.size = 0
+            return data
+        parts = []
+        left = size
+        while left:
+            chunk = self.chunks.popleft()
+            if len(chunk) > left:
+                self.chunks.appendleft(chunk[left:])
+                chunk = chunk[:left]
+            parts.append(chunk)
+            left -= len(chunk)
+        self.size -= size
+        return "".join(parts)
+
+    def getvalue(self):
+        """
+        Return the content of the buffer.
+        """
+        if len(self.chunks) > 1:
+            self.chunks = collections.deque(["".join(self.chunks)])
+        if self.chunks:
+            return self.chunks[0]
+        return ""
+
+
 # The following is the server part of the module.
 
 if __name__ == "__main__":
@@ -192,7 +278,7 @@ if __name__ == "__main__":
         sys.stdout.flush()
 
         # Initialize buffers
-        buffers = ["" for reader in readers]
+        buffers = [_OutputBuffer() for reader in readers]
 
         # Read from child and write to files/pipes
         server_log.info('Entering main read loop')
@@ -206,8 +292,9 @@ if __name__ == "__main__":
             # If a reader pipe is ready for writing --
             for (i, fd) in enumerate(reader_fds):
                 if fd in w:
-                    bytes_written = os.write(fd, buffers[i])
-                    buffers[i] = buffers[i][bytes_written:]
+                    data = buffers[i].read(65536)
+                    bytes_written = os.write(fd, data)
+                    buffers[i].unread(data[bytes_written:])
             if ctrlpipe_fd in r:
                 cmd_len = int(os.read(ctrlpipe_fd, 10))
                 data = os.read(ctrlpipe_fd, cmd_len)
@@ -215,6 +302,10 @@ if __name__ == "__main__":
                     _makeraw(shell_fd)
                 elif data == "standard":
                     _makestandard(shell_fd, echo)
+                elif data.startswith("limit "):
+                    limit = int(data.split()[1]) or None
+                    for bfr in buffers:
+                        bfr.set_limit(limit)
             # If there's data to read from the child process --
             if shell_fd in r:
                 try:
@@ -228,8 +319,8 @@ if __name__ == "__main__":
                 data = data.replace("\r", "")
                 output_file.write(data)
                 output_file.flush()
-                for i in range(len(readers)):
-                    buffers[i] += data
+                for bfr in buffers:
+                    bfr.append(data)
             # If os.read() raised an exception or there was nothing to read --
             if check_termination or shell_fd not in r:
                 pid, status = os.waitpid(shell_pid, os.WNOHANG)
@@ -265,11 +356,13 @@ if __name__ == "__main__":
 # The following is the client part of the module.
 
 import subprocess
+import heapq
 import time
 import signal
 import re
 import threading
 import logging
+import mmap
 import utils_misc
 
 
@@ -364,6 +457,363 @@ class ShellStatusError(ShellError):
                 (self.cmd, self.output))
 
 
+# The following is the in-process engine of the module: instead of a server
+# process per child process, one thread multiplexes the ptys of all the
+# child processes of the Python process and keeps their output in memory.
+
+ENGINES = ("server", "local")
+
+# Engine of the Spawn instances that don't ask for one, see set_engine()
+_engine = "server"
+
+
+def set_engine(engine):
+    """
+    Set the engine of the child processes started from now on.
+
+    "server" (the default) runs a server process per child process that
+    keeps running on its own, so a later Spawn(a_id=...), even in another
+    Python process, can attach to it again.  "local" runs the child
+    processes directly and reads their output in a thread of the current
+    process; they can only be attached to again from this process, and
+    their pseudo terminals close when it exits.
+
+    :param engine: "server" or "local".
+    """
+    global _engine
+    if engine not in ENGINES:
+        raise ValueError("Unknown aexpect engine %r" % engine)
+    _engine = engine
+
+
+class _LocalProcess(object):
+
+    """
+    A child process run by the in-process engine, and its output.
+    """
+
+    def __init__(self, a_id, command, echo, readers):
+        self.a_id = a_id
+        self.echo = echo
+        self.limit = None
+        self.output = _OutputBuffer()
+        self.buffers = dict((reader, _OutputBuffer()) for reader in readers)
+        self.status = None
+        self.eof = False
+        self.done = False
+        self.cond = threading.Condition()
+        # Pipes waking up the readers waiting for output, by reader
+        self.wakeups = {}
+
+        (self.pid, self.fd) = pty.fork()
+        if self.pid == 0:
+            # Child process: set $TERM = dumb and run the command (never
+            # returning into the code of the parent)
+            try:
+                os.putenv("TERM", "dumb")
+                command += " && echo %s > /dev/null" % a_id
+                if len(command) > 255:
+                    new_stack = None
+                    if len(command) > 2000000:
+                        new_stack = (1 + len(command) / 2072576) * 8196
+                        command = "ulimit -s %s\nulimit -n 819200\n%s" % (
+                            new_stack, command)
+                    tmp_dir = os.path.join(BASE_DIR, a_id)
+                    try:
+                        os.makedirs(tmp_dir)
+                    except OSError:
+                        pass
+                    tmp_file = tempfile.mktemp(suffix='.sh',
+                                               prefix='aexpect-', dir=tmp_dir)
+                    fd_cmd = open(tmp_file, "w")
+                    fd_cmd.write(command)
+                    fd_cmd.close()
+                    os.execv("/bin/bash", ["/bin/bash", "-c",
+                                           "source %s" % tmp_file])
+                else:
+                    os.execv("/bin/bash", ["/bin/bash", "-c", command])
+            finally:
+                os._exit(1)
+        # Don't leak the pty into the other child processes
+        flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+        fcntl.fcntl(self.fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        _makestandard(self.fd, echo)
+
+    def feed(self, data):
+        # Remove carriage returns from the data -- they often cause
+        # trouble and are normally not needed
+        data = data.replace("\r", "")
+        self.cond.acquire()
+        try:
+            self.output.append(data)
+            for bfr in self.buffers.values():
+                bfr.append(data)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        self._wake_up()
+
+    def finish(self, status):
+        self.cond.acquire()
+        try:
+            self.status = status
+            self.eof = True
+            self.done = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        self._wake_up()
+
+    def set_limit(self, limit):
+        self.cond.acquire()
+        try:
+            self.limit = limit
+            self.output.set_limit(limit)
+            for bfr in self.buffers.values():
+                bfr.set_limit(limit)
+        finally:
+            self.cond.release()
+
+    def _wake_up(self):
+        for _, write_fd in self.wakeups.values():
+            try:
+                os.write(write_fd, "x")
+            except OSError:
+                pass
+
+    def _get_wakeup_fd(self, reader):
+        if reader not in self.wakeups:
+            fds = os.pipe()
+            for fd in fds:
+                fcntl.fcntl(fd, fcntl.F_SETFL,
+                            fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                fcntl.fcntl(fd, fcntl.F_SETFD,
+                            fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+            self.wakeups[reader] = fds
+        return self.wakeups[reader][0]
+
+    def close_wakeups(self):
+        for fds in self.wakeups.values():
+            for fd in fds:
+                os.close(fd)
+        self.wakeups = {}
+
+    def poll(self, reader, timeout):
+        """
+        Wait up to timeout seconds for output of the process the reader
+        hasn't read, or for the process to terminate.
+
+        (A timed Condition.wait() would poll, adding up to 50 ms to every
+        wait, so readers sleep in select() on a pipe instead.)
+
+        :return: True if either happened.
+        """
+        end_time = time.time() + timeout
+        self.cond.acquire()
+        try:
+            bfr = self.buffers.setdefault(reader, _OutputBuffer(self.limit))
+            if bfr or self.done:
+                return True
+            wakeup_fd = self._get_wakeup_fd(reader)
+        finally:
+            self.cond.release()
+        while True:
+            try:
+                while os.read(wakeup_fd, 1024):
+                    pass
+            except OSError:
+                pass
+            if bfr or self.done:
+                return True
+            remaining = end_time - time.time()
+            if remaining <= 0:
+                return False
+            try:
+                select.select([wakeup_fd], [], [], remaining)
+            except select.error:
+                pass
+
+    def read(self, reader):
+        """
+        Return the output the reader hasn't read yet.
+        """
+        self.cond.acquire()
+        try:
+            bfr = self.buffers.setdefault(reader, _OutputBuffer(self.limit))
+            return bfr.read()
+        finally:
+            self.cond.release()
+
+    def drain(self, reader):
+        """
+        Return the output the reader hasn't read yet and whether the output
+        ended, without waiting, for readers watching the wakeup pipe of
+        get_wakeup_fd().
+
+        :return: Tuple (data, True if the process terminated).
+        """
+        self.cond.acquire()
+        try:
+            done = self.done
+            try:
+                while os.read(self.wakeups[reader][0], 1024):
+                    pass
+            except (OSError, KeyError):
+                pass
+            bfr = self.buffers.setdefault(reader, _OutputBuffer(self.limit))
+            return bfr.read(), done
+        finally:
+            self.cond.release()
+
+    def get_wakeup_fd(self, reader):
+        """
+        Return a file descriptor that becomes readable when there's new
+        output for the reader or the process terminates.
+        """
+        self.cond.acquire()
+        try:
+            return self._get_wakeup_fd(reader)
+        finally:
+            self.cond.release()
+
+    def write(self, data):
+        while data and not self.done:
+            try:
+                data = data[os.write(self.fd, data):]
+            except OSError:
+                return
+
+
+class _Multiplexer(object):
+
+    """
+    A thread that reads the output of all the child processes of the
+    in-process engine with a single epoll.
+    """
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.epoll = select.epoll()
+        self.lock = threading.Lock()
+        self.processes = {}
+        self.running = {}
+        self.thread = threading.Thread(target=self._loop,
+                                       name="aexpect_multiplexer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, process):
+        self.lock.acquire()
+        try:
+            self.processes[process.a_id] = process
+            self.running[process.fd] = process
+        finally:
+            self.lock.release()
+        self.epoll.register(process.fd, select.EPOLLIN)
+
+    def get(self, a_id):
+        return self.processes.get(a_id)
+
+    def remove(self, a_id):
+        self.lock.acquire()
+        try:
+            process = self.processes.pop(a_id, None)
+        finally:
+            self.lock.release()
+        if process is not None:
+            process.close_wakeups()
+
+    def _loop(self):
+        while True:
+            # Reap the processes whose pty closed without delay
+            timeout = 0.5
+            if [p for p in self.running.values() if p.eof]:
+                timeout = 0.01
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError:
+                continue
+            active = set()
+            for fd, _ in events:
+                process = self.running.get(fd)
+                if process is None or process.eof:
+                    continue
+                try:
+                    data = os.read(fd, 16384)
+                except OSError:
+                    data = ""
+                if data:
+                    process.feed(data)
+                    active.add(fd)
+                else:
+                    # The pty closed; wait for the process to exit
+                    process.eof = True
+                    self.epoll.unregister(fd)
+            # Processes without pending output may have exited
+            self.lock.acquire()
+            try:
+                waiting = [p for p in self.running.values()
+                           if p.fd not in active]
+            finally:
+                self.lock.release()
+            for process in waiting:
+                try:
+                    pid, status = os.waitpid(process.pid, os.WNOHANG)
+                except OSError:
+                    pid, status = process.pid, None
+                if not pid:
+                    continue
+                if status is not None:
+                    status = os.WEXITSTATUS(status)
+                self.lock.acquire()
+                try:
+                    del self.running[process.fd]
+                finally:
+                    self.lock.release()
+                if not process.eof:
+                    self.epoll.unregister(process.fd)
+                    self._drain(process)
+                os.close(process.fd)
+                process.finish(status)
+
+    def _drain(self, process):
+        """
+        Read the output an exited process left in its pty (it may have
+        written it after the last poll).
+        """
+        flags = fcntl.fcntl(process.fd, fcntl.F_GETFL)
+        fcntl.fcntl(process.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        while True:
+            try:
+                data = os.read(process.fd, 16384)
+            except OSError:
+                # EIO: the pty closed, EAGAIN: a child of the process still
+                # holds it open
+                return
+            if not data:
+                return
+            process.feed(data)
+
+
+_multiplexer = None
+_multiplexer_lock = threading.Lock()
+
+
+def _get_multiplexer():
+    """
+    Return the multiplexer of the current process, starting it if needed
+    (a forked process doesn't inherit the thread of its parent's).
+    """
+    global _multiplexer
+    _multiplexer_lock.acquire()
+    try:
+        if _multiplexer is None or _multiplexer.pid != os.getpid():
+            _multiplexer = _Multiplexer()
+        return _multiplexer
+    finally:
+        _multiplexer_lock.release()
+
+
 def run_tail(command, termination_func=None, output_func=None, output_prefix="",
              timeout=1.0, auto_close=True):
     """
@@ -490,17 +940,22 @@ class Spawn(object):
     responsible for restoring its own state by properly defining
     __getinitargs__().
 
-    The first named pipe is used by _tail(), a function that runs in the
-    background and reports new output from the child as it is produced.
+    The first named pipe is read by the tail dispatcher, a thread that
+    reports new output from the child as it is produced (see Tail).
     The second named pipe is used by a set of functions that read and parse
     output as requested by the user in an interactive manner, similar to
     pexpect.
     When unpickled it automatically
     resumes _tail() if needed.
+
+    With the "local" engine (see set_engine()) there is no server: the
+    child process runs directly and a thread of the current process reads
+    the output of all such processes and keeps it in memory, for
+    get_output() and for every reader.
     """
 
     def __init__(self, command=None, a_id=None, auto_close=False, echo=False,
-                 linesep="\n"):
+                 linesep="\n", engine=None):
         """
         Initialize the class and run command as a child process.
 
@@ -515,17 +970,28 @@ class Spawn(object):
                 parameter has an effect only when starting a new server.
         :param linesep: Line separator to be appended to strings sent to the
                 child process by sendline().
+        :param engine: "server" or "local", by default the engine set with
+                set_engine().  Ignored when attaching to a process, which
+                keeps the engine it was started with.
         """
         self.a_id = a_id or utils_misc.generate_random_string(8)
         self.log_file = None
 
-        base_dir = os.path.join(BASE_DIR, self.a_id)
+        self.command = command
+
+        # Remember some attributes
+        self.auto_close = auto_close
+        self.echo = echo
+        self.linesep = linesep
+
+        # Make sure the 'readers' and 'close_hooks' attributes exist
+        if not hasattr(self, "readers"):
+            self.readers = []
+        if not hasattr(self, "close_hooks"):
+            self.close_hooks = []
+        self.reader_fds = {}
 
         # Define filenames for communication with server
-        try:
-            os.makedirs(base_dir)
-        except Exception:
-            pass
         (self.shell_pid_filename,
          self.status_filename,
          self.output_filename,
@@ -536,18 +1002,24 @@ class Spawn(object):
          self.server_log_filename) = _get_filenames(BASE_DIR,
                                                     self.a_id)
 
-        self.command = command
-
-        # Remember some attributes
-        self.auto_close = auto_close
-        self.echo = echo
-        self.linesep = linesep
+        # A process of the in-process engine
+        self._local = None
+        if command:
+            if (engine or _engine) == "local":
+                self._local = _LocalProcess(self.a_id, command, echo,
+                                            self.readers)
+                _get_multiplexer().add(self._local)
+                return
+        elif _multiplexer is not None and _multiplexer.pid == os.getpid():
+            self._local = _multiplexer.get(self.a_id)
+            if self._local is not None:
+                return
 
-        # Make sure the 'readers' and 'close_hooks' attributes exist
-        if not hasattr(self, "readers"):
-            self.readers = []
-        if not hasattr(self, "close_hooks"):
-            self.close_hooks = []
+        base_dir = os.path.join(BASE_DIR, self.a_id)
+        try:
+            os.makedirs(base_dir)
+        except Exception:
+            pass
 
         # Define the reader filenames
         self.reader_filenames = dict(
@@ -576,7 +1048,6 @@ class Spawn(object):
                 pass
 
         # Open the reading pipes
-        self.reader_fds = {}
         try:
             assert(_locked(self.lock_server_running_filename))
             for reader, filename in self.reader_filenames.items():
@@ -642,6 +1113,43 @@ class Spawn(object):
         """
         return self.reader_fds.get(reader)
 
+    def _poll_reader(self, reader, timeout):
+        """
+        Wait up to timeout seconds for output the reader hasn't read yet,
+        or for the end of the output.  Intended for use by derived classes.
+
+        :param reader: The name of the reader.
+        :param timeout: Time (seconds) to wait.
+        :return: True if _read_reader() won't block.
+        """
+        if self._local is not None:
+            return self._local.poll(reader, timeout)
+        try:
+            r, w, x = select.select([self._get_fd(reader)], [], [], timeout)
+        except (select.error, TypeError):
+            # Reading reports the error as the end of the output
+            return True
+        return bool(r)
+
+    def _read_reader(self, reader, timeout):
+        """
+        Read output the reader hasn't read yet.  Intended for use by derived
+        classes.
+
+        :param reader: The name of the reader.
+        :param timeout: Time (seconds) to wait for output.
+        :return: The data read, "" at the end of the output (the process
+                terminated) or None if no output arrived in time.
+        """
+        if not self._poll_reader(reader, timeout):
+            return None
+        if self._local is not None:
+            return self._local.read(reader)
+        try:
+            return os.read(self._get_fd(reader), 1024)
+        except (OSError, TypeError):
+            return ""
+
     def _close_reader_fds(self):
         """
         Close all reader file descriptors.
@@ -666,6 +1174,8 @@ class Spawn(object):
         Note: this may be the PID of the shell process running the user given
         command.
         """
+        if self._local is not None:
+            return self._local.pid
         try:
             fileobj = open(self.shell_pid_filename, "r")
             pid = int(fileobj.read())
@@ -679,6 +1189,14 @@ class Spawn(object):
         Wait for the process to exit and return its exit status, or None
         if the exit status is not available.
         """
+        if self._local is not None:
+            self._local.cond.acquire()
+            try:
+                while not self._local.done:
+                    self._local.cond.wait(1)
+            finally:
+                self._local.cond.release()
+            return self._local.status
         _wait(self.lock_server_running_filename)
         try:
             fileobj = open(self.status_filename, "r")
@@ -688,18 +1206,70 @@ class Spawn(object):
         except Exception:
             return None
 
-    def get_output(self):
+    def get_output(self, size=None):
         """
         Return the STDOUT and STDERR output of the process so far.
+
+        :param size: Return only the last size bytes of the output (only
+                those are read from the output file).
         """
+        if self._local is not None:
+            self._local.cond.acquire()
+            try:
+                output = self._local.output.getvalue()
+            finally:
+                self._local.cond.release()
+            if size is not None and size < len(output):
+                output = output[len(output) - size:]
+            return output
         try:
             fileobj = open(self.output_filename, "r")
+            if size is not None:
+                fileobj.seek(0, os.SEEK_END)
+                fileobj.seek(max(0, fileobj.tell() - size))
             output = fileobj.read()
             fileobj.close()
             return output
         except Exception:
             return ""
 
+    def map_output(self):
+        """
+        Return the STDOUT and STDERR output of the process so far, without
+        reading it into memory: a read-only mmap of the output file, which
+        re and find() work on like on a string.  With the local engine the
+        output already is in memory, and is returned as a string.
+        """
+        if self._local is not None:
+            return self.get_output()
+        try:
+            fileobj = open(self.output_filename, "r")
+            try:
+                return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+            finally:
+                fileobj.close()
+        except Exception:
+            # E.g. an empty output file
+            return ""
+
+    def set_buffer_limit(self, limit):
+        """
+        Bound the memory the output of the process takes, e.g. for long
+        lived consoles whose output is mostly not read.
+
+        The output a reader hasn't read yet is kept up to limit bytes (plus
+        what the pipe of the reader holds with the server engine), the
+        oldest output being dropped (a ring buffer).  With the local engine,
+        which keeps the whole output in memory, get_output() returns only
+        the last limit bytes too.
+
+        :param limit: Size in bytes, or None for no limit.
+        """
+        if self._local is not None:
+            self._local.set_limit(limit)
+        else:
+            self.send_ctrl("limit %d" % (limit or 0))
+
     def get_stripped_output(self):
         """
         Return the STDOUT and STDERR output without the console codes escape
@@ -711,6 +1281,8 @@ class Spawn(object):
         """
         Return True if the process is running.
         """
+        if self._local is not None:
+            return not self._local.done
         return _locked(self.lock_server_running_filename)
 
     def is_defunct(self):
@@ -734,6 +1306,16 @@ class Spawn(object):
         :param sig: The signal to send the process when attempting to kill it.
         """
         self.kill(sig=sig)
+        if self._local is not None:
+            # Wait for the process to be reaped
+            self.get_status()
+            for hook in self.close_hooks:
+                hook(self)
+            _get_multiplexer().remove(self.a_id)
+            # Remove the script of a long command
+            shutil.rmtree(os.path.join(BASE_DIR, self.a_id),
+                          ignore_errors=True)
+            return
         # Wait for the server to exit
         _wait(self.lock_server_running_filename)
         # Call all cleanup routines
@@ -763,6 +1345,9 @@ class Spawn(object):
 
         :param cont: String to send to the child process.
         """
+        if self._local is not None:
+            self._local.write(cont)
+            return
         try:
             fd = os.open(self.inpipe_filename, os.O_RDWR)
             os.write(fd, cont)
@@ -785,6 +1370,14 @@ class Spawn(object):
         :param control_str: Control string to send to the child process
                             container.
         """
+        if self._local is not None:
+            if self._local.done:
+                return
+            if control_str == "raw":
+                _makeraw(self._local.fd)
+            elif control_str == "standard":
+                _makestandard(self._local.fd, self._local.echo)
+            return
         try:
             fd = os.open(self.ctrlpipe_filename, os.O_RDWR)
             os.write(fd, "%10d%s" % (len(control_str), control_str))
@@ -800,17 +1393,156 @@ def kill_tail_threads():
     """
     Kill all Tail threads.
 
-    After calling this function no new threads should be started.
+    Stops the tail dispatcher: the Tail instances stop reporting output and
+    termination, until they are unpickled again.
     """
-    global _thread_kill_requested
+    global _thread_kill_requested, _tail_dispatcher
     _thread_kill_requested = True
 
+    _tail_dispatcher_lock.acquire()
+    try:
+        dispatcher = _tail_dispatcher
+        _tail_dispatcher = None
+    finally:
+        _tail_dispatcher_lock.release()
+    if dispatcher is not None and dispatcher.pid == os.getpid():
+        dispatcher.stop()
     for t in threading.enumerate():
         if hasattr(t, "name") and t.name.startswith("tail_thread"):
             t.join(10)
     _thread_kill_requested = False
 
 
+class _TailDispatcher(object):
+
+    """
+    A thread that reads the output of all the Tail instances of the process
+    with a single epoll and passes it to their callbacks line by line.
+
+    It only wakes up for new output and for the incomplete lines to pass on
+    when no more output follows them for flush_delay seconds.
+    """
+
+    # Seconds without output after which an incomplete line is passed on
+    flush_delay = 0.05
+
+    def __init__(self):
+        self.pid = os.getpid()
+        self.epoll = select.epoll()
+        self.lock = threading.Lock()
+        self.tails = {}
+        # Heap of (time, fd, tail) of the pending flushes
+        self.flushes = []
+        self.stopping = False
+        self.ctrl_fds = os.pipe()
+        for fd in self.ctrl_fds:
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+            fcntl.fcntl(fd, fcntl.F_SETFD,
+                        fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        self.epoll.register(self.ctrl_fds[0], select.EPOLLIN)
+        self.thread = threading.Thread(target=self._loop,
+                                       name="aexpect_tail_dispatcher")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, tail):
+        """
+        Start reading the output of a Tail instance.
+        """
+        fd = tail._get_tail_fd()
+        if fd is None:
+            # Nothing to read from, report the termination right away
+            tail._end_tail()
+            return
+        self.lock.acquire()
+        try:
+            self.tails[fd] = tail
+        finally:
+            self.lock.release()
+        try:
+            self.epoll.register(fd, select.EPOLLIN)
+        except IOError:
+            # A closed fd number reused before the old tail ended
+            self.epoll.modify(fd, select.EPOLLIN)
+
+    def _remove(self, fd):
+        self.lock.acquire()
+        try:
+            tail = self.tails.pop(fd, None)
+        finally:
+            self.lock.release()
+        try:
+            self.epoll.unregister(fd)
+        except (IOError, ValueError):
+            pass
+        return tail
+
+    def stop(self):
+        """
+        Stop reading and reporting the output of all the Tail instances.
+        """
+        self.stopping = True
+        os.write(self.ctrl_fds[1], "x")
+        if threading.currentThread() is not self.thread:
+            self.thread.join(10)
+
+    def _loop(self):
+        while not self.stopping:
+            timeout = -1
+            if self.flushes:
+                timeout = max(0, self.flushes[0][0] - time.time())
+            try:
+                events = self.epoll.poll(timeout)
+            except IOError:
+                continue
+            for fd, _ in events:
+                if self.stopping:
+                    break
+                tail = self.tails.get(fd)
+                if tail is None:
+                    continue
+                data, eof = tail._read_tail()
+                if data:
+                    flush_time = tail._feed_tail(data)
+                    if flush_time is not None:
+                        heapq.heappush(self.flushes, (flush_time, fd, tail))
+                if eof:
+                    self._remove(fd)
+                    tail._end_tail()
+            now = time.time()
+            while self.flushes and self.flushes[0][0] <= now:
+                flush_time, _, tail = heapq.heappop(self.flushes)
+                # Later output postpones (or cancels) the flush
+                if tail._tail_flush_time == flush_time:
+                    tail._flush_tail()
+        for fd in self.tails.keys():
+            self._remove(fd)._detach_tail()
+        for fd in self.ctrl_fds:
+            os.close(fd)
+        self.epoll.close()
+
+
+_tail_dispatcher = None
+_tail_dispatcher_lock = threading.Lock()
+
+
+def _get_tail_dispatcher():
+    """
+    Return the tail dispatcher of the current process, starting it if
+    needed.
+    """
+    global _tail_dispatcher
+    _tail_dispatcher_lock.acquire()
+    try:
+        if (_tail_dispatcher is None or
+                _tail_dispatcher.pid != os.getpid()):
+            _tail_dispatcher = _TailDispatcher()
+        return _tail_dispatcher
+    finally:
+        _tail_dispatcher_lock.release()
+
+
 class Tail(Spawn):
 
     """
@@ -824,13 +1556,17 @@ class Tail(Spawn):
     When the child process exits, its exit status is reported to an additional
     callback function.
 
+    The output of all the instances is read by a single thread, the tail
+    dispatcher, which calls their output callbacks.  The exit status is
+    reported from a thread of the instance (named after thread_name).
+
     When this class is unpickled, it automatically resumes reporting output.
     """
 
     def __init__(self, command=None, a_id=None, auto_close=False, echo=False,
                  linesep="\n", termination_func=None, termination_params=(),
                  output_func=None, output_params=(), output_prefix="",
-                 thread_name=None):
+                 thread_name=None, engine=None):
         """
         Initialize the class and run command as a child process.
 
@@ -857,14 +1593,16 @@ class Tail(Spawn):
                 output line.
         :param output_prefix: String to prepend to lines sent to output_func.
         :param thread_name: Name of thread to better identify hanging threads.
+        :param engine: "server" or "local", see Spawn.
         """
         # Add a reader and a close hook
         self._add_reader("tail")
-        self._add_close_hook(Tail._join_thread)
+        self._add_close_hook(Tail._join_tail)
         self._add_close_hook(Tail._close_log_file)
 
         # Init the superclass
-        Spawn.__init__(self, command, a_id, auto_close, echo, linesep)
+        Spawn.__init__(self, command, a_id, auto_close, echo, linesep,
+                       engine)
         if thread_name is None:
             self.thread_name = ("tail_thread_%s_%s") % (self.a_id,
                                                         str(command)[:10])
@@ -878,10 +1616,15 @@ class Tail(Spawn):
         self.output_params = output_params
         self.output_prefix = output_prefix
 
-        # Start the thread in the background
-        self.tail_thread = None
+        # Start reading the output in the background
+        self._tailing = False
+        self._tail_bfr = ""
+        self._tail_flush_time = None
+        self._tail_done = threading.Event()
+        self._tail_done.set()
+        self._tail_end_thread = None
         if termination_func or output_func:
-            self._start_thread()
+            self._start_tail()
 
     def __reduce__(self):
         return self.__class__, (self.__getinitargs__())
@@ -902,8 +1645,8 @@ class Tail(Spawn):
                 Must take a single parameter -- the exit status.
         """
         self.termination_func = termination_func
-        if termination_func and not self.tail_thread:
-            self._start_thread()
+        if termination_func and not self._tailing:
+            self._start_tail()
 
     def set_termination_params(self, termination_params):
         """
@@ -922,8 +1665,8 @@ class Tail(Spawn):
                 output from the process.  Must take a single string parameter.
         """
         self.output_func = output_func
-        if output_func and not self.tail_thread:
-            self._start_thread()
+        if output_func and not self._tailing:
+            self._start_tail()
 
     def set_output_params(self, output_params):
         """
@@ -955,81 +1698,226 @@ class Tail(Spawn):
         if self.log_file is not None:
             utils_misc.close_log_file(self.log_file)
 
-    def _tail(self):
-        def print_line(text):
-            # Pre-pend prefix and remove trailing whitespace
-            text = self.output_prefix + text.rstrip()
-            # Pass text to output_func
-            try:
-                params = self.output_params + (text,)
-                self.output_func(*params)
-            except TypeError:
-                pass
+    def _print_line(self, text):
+        # Pre-pend prefix and remove trailing whitespace
+        text = self.output_prefix + text.rstrip()
+        # Pass text to output_func
+        try:
+            params = self.output_params + (text,)
+            self.output_func(*params)
+        except TypeError:
+            pass
+        except Exception, details:
+            # Don't let the dispatcher thread die
+            logging.error("Error in the output callback of %s: %s",
+                          self.thread_name, details)
 
+    def _get_tail_fd(self):
+        """
+        Return the file descriptor the tail dispatcher waits for.
+        """
+        if self._local is not None:
+            return self._local.get_wakeup_fd("tail")
+        return self._get_fd("tail")
+
+    def _read_tail(self):
+        """
+        Read the output available to the tail reader (called by the tail
+        dispatcher).
+
+        :return: Tuple (data, True if the output ended).
+        """
+        if self._local is not None:
+            return self._local.drain("tail")
+        try:
+            data = os.read(self._get_fd("tail"), 65536)
+        except (OSError, TypeError):
+            data = ""
+        return data, not data
+
+    def _feed_tail(self, data):
+        """
+        Send the complete lines of the output to output_func (called by the
+        tail dispatcher).
+
+        :return: Time to flush the incomplete last line at, or None.
+        """
+        bfr = self._tail_bfr + data
+        last_newline_index = bfr.rfind("\n")
+        if self.output_func and last_newline_index >= 0:
+            for line in bfr[:last_newline_index].split("\n"):
+                self._print_line(line)
+        # Leave only the last line
+        self._tail_bfr = bfr[last_newline_index + 1:]
+        self._tail_flush_time = None
+        if self._tail_bfr:
+            self._tail_flush_time = (time.time() +
+                                     _TailDispatcher.flush_delay)
+        return self._tail_flush_time
+
+    def _flush_tail(self):
+        """
+        Send the incomplete last line of the output to output_func.
+        """
+        self._tail_flush_time = None
+        if self._tail_bfr:
+            self._print_line(self._tail_bfr)
+            self._tail_bfr = ""
+
+    def _end_tail(self):
+        """
+        Report the end of the output (called by the tail dispatcher).
+
+        Waiting for the exit status may take a while with the server engine,
+        so it's done in a thread of the instance.
+        """
+        self._flush_tail()
+        self._tail_end_thread = threading.Thread(target=self._report_status,
+                                                 name=self.thread_name)
+        self._tail_end_thread.start()
+
+    def _report_status(self):
         try:
-            fd = self._get_fd("tail")
-            bfr = ""
-            while True:
-                global _thread_kill_requested
-                if _thread_kill_requested:
-                    try:
-                        os.close(fd)
-                    except:
-                        pass
-                    return
-                try:
-                    # See if there's any data to read from the pipe
-                    r, w, x = select.select([fd], [], [], 0.05)
-                except Exception:
-                    break
-                if fd in r:
-                    # Some data is available; read it
-                    new_data = os.read(fd, 1024)
-                    if not new_data:
-                        break
-                    bfr += new_data
-                    # Send the output to output_func line by line
-                    # (except for the last line)
-                    if self.output_func:
-                        lines = bfr.split("\n")
-                        for line in lines[:-1]:
-                            print_line(line)
-                    # Leave only the last line
-                    last_newline_index = bfr.rfind("\n")
-                    bfr = bfr[last_newline_index + 1:]
-                else:
-                    # No output is available right now; flush the bfr
-                    if bfr:
-                        print_line(bfr)
-                        bfr = ""
-            # The process terminated; print any remaining output
-            if bfr:
-                print_line(bfr)
             # Get the exit status, print it and send it to termination_func
             status = self.get_status()
-            if status is None:
+            if status is None or _thread_kill_requested:
                 return
-            print_line("(Process terminated with status %s)" % status)
+            self._print_line("(Process terminated with status %s)" % status)
             try:
                 params = self.termination_params + (status,)
                 self.termination_func(*params)
             except TypeError:
                 pass
         finally:
-            self.tail_thread = None
+            self._tailing = False
+            self._tail_done.set()
+
+    def _detach_tail(self):
+        """
+        Stop tailing without reporting the termination (kill_tail_threads()).
+        """
+        fd = self.reader_fds.pop("tail", None)
+        if fd is not None:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self._tailing = False
+        self._tail_done.set()
+
+    def _start_tail(self):
+        self._tailing = True
+        self._tail_done.clear()
+        _get_tail_dispatcher().add(self)
+
+    def _join_tail(self):
+        # Wait for the output and the exit status to be reported, unless
+        # called while reporting them (i.e. from a callback)
+        current = threading.currentThread()
+        if current is self._tail_end_thread:
+            return
+        if (_tail_dispatcher is not None and
+                current is _tail_dispatcher.thread):
+            return
+        self._tail_done.wait()
+
+
+# Patterns that can't be part of a larger alternation: global flags and
+# backreferences (whose group numbers would change)
+_UNCOMBINABLE_RE = re.compile(r"\(\?[iLmsux]|\(\?P=|\\[1-9]")
 
-    def _start_thread(self):
-        self.tail_thread = threading.Thread(target=self._tail,
-                                            name=self.thread_name)
-        self.tail_thread.start()
 
-    def _join_thread(self):
-        # Wait for the tail thread to exit
-        # (it's done this way because self.tail_thread may become None at any
-        # time)
-        t = self.tail_thread
-        if t:
-            t.join()
+class _PatternMatcher(object):
+
+    """
+    Search a growing output for a list of patterns.
+
+    All the patterns are compiled once, into a single alternation when
+    possible.  An incremental search only scans the output added since the
+    previous search, plus the overlap bytes before it (from the beginning
+    of their line), so a match spanning both parts is found too.
+    """
+
+    overlap = 1024
+
+    def __init__(self, patterns):
+        """
+        :param patterns: List of regular expression patterns; None and empty
+                strings are ignored.
+        """
+        self.regexes = [(i, re.compile(pattern))
+                        for i, pattern in enumerate(patterns) if pattern]
+        self.combined = None
+        self.scanned = 0
+        if [p for _, p in self.regexes
+                if not isinstance(p.pattern, basestring) or
+                _UNCOMBINABLE_RE.search(p.pattern)]:
+            return
+        if self.regexes:
+            try:
+                self.combined = re.compile("|".join(
+                    "(?P<p%d>%s)" % (i, regex.pattern)
+                    for i, regex in self.regexes))
+            except re.error:
+                pass
+
+    def search(self, cont, incremental=True):
+        """
+        Return the index of the first pattern that matches a substring of
+        cont, or None, like Expect.match_patterns().
+
+        :param cont: Output, the output of the previous incremental search
+                followed by new output.
+        :param incremental: Whether to scan the new output only.
+        """
+        start = 0
+        if incremental:
+            start = cont.rfind("\n", 0, max(0, self.scanned - self.overlap))
+            start += 1
+            self.scanned = len(cont)
+        first = None
+        if self.combined is not None:
+            match = self.combined.search(cont, start)
+            if match is None:
+                return None
+            # The leftmost match; an earlier pattern may match further on
+            first = int(match.lastgroup[1:])
+        for i, regex in self.regexes:
+            if first is not None and i >= first:
+                break
+            if regex.search(cont, start):
+                return i
+        return first
+
+
+def _get_last_word(cont):
+    """
+    Return the last word of cont, reading only its end.
+    """
+    size = 256
+    while True:
+        words = cont[-size:].split()
+        if len(words) > 1 or size >= len(cont):
+            if words:
+                return words[-1]
+            return ""
+        size *= 4
+
+
+def _get_last_nonempty_line(cont):
+    """
+    Return the last non-empty line of cont, reading only its end.
+    """
+    size = 1024
+    while True:
+        lines = cont[-size:].splitlines()
+        nonempty = [i for i, l in enumerate(lines) if l.strip()]
+        # The first line of the tail may be cut
+        if (nonempty and nonempty[-1] > 0) or size >= len(cont):
+            if nonempty:
+                return lines[nonempty[-1]]
+            return ""
+        size *= 4
 
 
 class Expect(Tail):
@@ -1044,7 +1932,7 @@ class Expect(Tail):
     def __init__(self, command=None, a_id=None, auto_close=True, echo=False,
                  linesep="\n", termination_func=None, termination_params=(),
                  output_func=None, output_params=(), output_prefix="",
-                 thread_name=None):
+                 thread_name=None, engine=None):
         """
         Initialize the class and run command as a child process.
 
@@ -1070,6 +1958,7 @@ class Expect(Tail):
         :param output_params: Parameters to send to output_func before the
                 output line.
         :param output_prefix: String to prepend to lines sent to output_func.
+        :param engine: "server" or "local", see Spawn.
         """
         # Add a reader
         self._add_reader("expect")
@@ -1077,7 +1966,8 @@ class Expect(Tail):
         # Init the superclass
         Tail.__init__(self, command, a_id, auto_close, echo, linesep,
                       termination_func, termination_params,
-                      output_func, output_params, output_prefix, thread_name)
+                      output_func, output_params, output_prefix, thread_name,
+                      engine)
 
     def __reduce__(self):
         return self.__class__, (self.__getinitargs__())
@@ -1099,22 +1989,14 @@ class Expect(Tail):
         end_time = None
         if timeout:
             end_time = time.time() + timeout
-        fd = self._get_fd("expect")
-        data = ""
+        data = []
         while True:
-            try:
-                r, w, x = select.select([fd], [], [], internal_timeout)
-            except Exception:
-                return data
-            if fd in r:
-                new_data = os.read(fd, 1024)
-                if not new_data:
-                    return data
-                data += new_data
-            else:
-                return data
+            new_data = self._read_reader("expect", internal_timeout)
+            if not new_data:
+                return "".join(data)
+            data.append(new_data)
             if end_time and time.time() > end_time:
-                return data
+                return "".join(data)
 
     def match_patterns(self, cont, patterns):
         """
@@ -1133,6 +2015,39 @@ class Expect(Tail):
             if re.search(patterns[i], cont):
                 return i
 
+    def _get_output_matcher(self, patterns, filter_func=None,
+                            match_func=None):
+        """
+        Return a function matching the output read so far against patterns.
+
+        Unless a custom filter_func or match_func is given, the function
+        scans only the output read since its previous call.
+
+        :param patterns: List of strings (regular expression patterns)
+        :param filter_func: Function to apply to the output before matching
+                it, or None.
+        :param match_func: Function to compare the output and patterns, or
+                None for match_patterns().
+        :return: Function taking the output (a string or a bytearray) and
+                returning the index of the matching pattern or None.
+        """
+        # Honour match_patterns() of derived classes
+        overridden = (self.match_patterns.im_func is not
+                      Expect.match_patterns.im_func)
+        if not match_func and overridden:
+            match_func = self.match_patterns
+        if match_func:
+            if filter_func is None:
+                return lambda cont: match_func(str(cont), patterns)
+            return lambda cont: match_func(filter_func(str(cont)), patterns)
+        matcher = _PatternMatcher(patterns)
+        if filter_func is None:
+            return matcher.search
+        if filter_func in (_get_last_word, _get_last_nonempty_line):
+            # They only copy the end of the output
+            return lambda cont: matcher.search(filter_func(cont), False)
+        return lambda cont: matcher.search(filter_func(str(cont)), False)
+
     def match_patterns_multiline(self, cont, patterns):
         """
         Match list of lines against a list of patterns.
@@ -1152,7 +2067,7 @@ class Expect(Tail):
                 if re.search(patterns[i], line):
                     return i
 
-    def read_until_output_matches(self, patterns, filter_func=lambda x: x,
+    def read_until_output_matches(self, patterns, filter_func=None,
                                   timeout=60, internal_timeout=None,
                                   print_func=None, match_func=None):
         """
@@ -1160,12 +2075,14 @@ class Expect(Tail):
 
         Read using read_nonblocking until a match is found using match_patterns,
         or until timeout expires. Before attempting to search for a match, the
-        data is filtered using the filter_func function provided.
+        data is filtered using the filter_func function provided.  Without
+        filter_func and match_func, only the data read since the previous
+        attempt (and a little before it) is searched.
 
         :param patterns: List of strings (regular expression patterns)
         :param filter_func: Function to apply to the data read from the child before
                 attempting to match it against the patterns (should take and
-                return a string)
+                return a string), or None
         :param timeout: The duration (in seconds) to wait until a match is
                 found
         :param internal_timeout: The timeout to pass to read_nonblocking
@@ -1178,19 +2095,14 @@ class Expect(Tail):
                 terminates while waiting for output
         :raise ExpectError: Raised if an unknown error occurs
         """
-        if not match_func:
-            match_func = self.match_patterns
-        fd = self._get_fd("expect")
-        o = ""
+        matcher = self._get_output_matcher(patterns, filter_func, match_func)
+        # Grows in place, unlike a string
+        o = bytearray()
         end_time = time.time() + timeout
         while True:
-            try:
-                r, w, x = select.select([fd], [], [],
-                                        max(0, end_time - time.time()))
-            except (select.error, TypeError):
-                break
-            if not r:
-                raise ExpectTimeoutError(patterns, o)
+            if not self._poll_reader("expect",
+                                     max(0, end_time - time.time())):
+                raise ExpectTimeoutError(patterns, str(o))
             # Read data from child
             data = self.read_nonblocking(internal_timeout,
                                          end_time - time.time())
@@ -1201,17 +2113,18 @@ class Expect(Tail):
                 for line in data.splitlines():
                     print_func(line)
             # Look for patterns
-            o += data
-            match = match_func(filter_func(o), patterns)
+            o.extend(data)
+            match = matcher(o)
             if match is not None:
-                return match, o
+                return match, str(o)
 
         # Check if the child has terminated
         if utils_misc.wait_for(lambda: not self.is_alive(), 5, 0, 0.1):
-            raise ExpectProcessTerminatedError(patterns, self.get_status(), o)
+            raise ExpectProcessTerminatedError(patterns, self.get_status(),
+                                               str(o))
         else:
             # This shouldn't happen
-            raise ExpectError(patterns, o)
+            raise ExpectError(patterns, str(o))
 
     def read_until_last_word_matches(self, patterns, timeout=60,
                                      internal_timeout=None, print_func=None):
@@ -1231,13 +2144,7 @@ class Expect(Tail):
                 terminates while waiting for output
         :raise ExpectError: Raised if an unknown error occurs
         """
-        def get_last_word(cont):
-            if cont:
-                return cont.split()[-1]
-            else:
-                return ""
-
-        return self.read_until_output_matches(patterns, get_last_word,
+        return self.read_until_output_matches(patterns, _get_last_word,
                                               timeout, internal_timeout,
                                               print_func)
 
@@ -1263,14 +2170,8 @@ class Expect(Tail):
                 terminates while waiting for output
         :raise ExpectError: Raised if an unknown error occurs
         """
-        def get_last_nonempty_line(cont):
-            nonempty_lines = [l for l in cont.splitlines() if l.strip()]
-            if nonempty_lines:
-                return nonempty_lines[-1]
-            else:
-                return ""
-
-        return self.read_until_output_matches(patterns, get_last_nonempty_line,
+        return self.read_until_output_matches(patterns,
+                                              _get_last_nonempty_line,
                                               timeout, internal_timeout,
                                               print_func)
 
@@ -1319,7 +2220,8 @@ class ShellSession(Expect):
                  linesep="\n", termination_func=None, termination_params=(),
                  output_func=None, output_params=(), output_prefix="",
                  thread_name=None, prompt=r"[\#\$]\s*$",
-                 status_test_command="echo $?"):
+                 status_test_command="echo $?", engine=None,
+                 status_sentinel=False):
         """
         Initialize the class and run command as a child process.
 
@@ -1349,22 +2251,33 @@ class ShellSession(Expect):
         :param status_test_command: Command to be used for getting the last
                 exit status of commands run inside the shell (used by
                 cmd_status_output() and friends).
+        :param engine: "server" or "local", see Spawn.
+        :param status_sentinel: If True, cmd_status_output() gets the exit
+                status along with the output of the command, see
+                set_status_sentinel().
         """
         # Init the superclass
         Expect.__init__(self, command, a_id, auto_close, echo, linesep,
                         termination_func, termination_params,
-                        output_func, output_params, output_prefix, thread_name)
+                        output_func, output_params, output_prefix, thread_name,
+                        engine)
 
         # Remember some attributes
         self.prompt = prompt
         self.status_test_command = status_test_command
+        self.status_sentinel = status_sentinel
+        # Whether the shell turned out to support the sentinel (None: not
+        # checked yet)
+        self._sentinel_supported = None
+        self._sentinel = "S%sS" % utils_misc.generate_random_string(8)
 
     def __reduce__(self):
         return self.__class__, (self.__getinitargs__())
 
     def __getinitargs__(self):
         return Expect.__getinitargs__(self) + (self.prompt,
-                                               self.status_test_command)
+                                               self.status_test_command,
+                                               None, self.status_sentinel)
 
     @classmethod
     def remove_command_echo(cls, cont, cmd):
@@ -1393,6 +2306,74 @@ class ShellSession(Expect):
         """
         self.status_test_command = status_test_command
 
+    def set_status_sentinel(self, status_sentinel):
+        """
+        Enable or disable getting exit statuses in the same round trip as
+        the output.
+
+        When enabled, cmd_status_output() sends the command followed by an
+        echo of its exit status between two unique markers, instead of
+        waiting for the prompt and then sending status_test_command.  This
+        requires a POSIX shell: the first time, the session checks the
+        shell echoes the markers properly, and keeps using
+        status_test_command if it doesn't.
+
+        :param status_sentinel: True to enable, False to disable.
+        """
+        self.status_sentinel = status_sentinel
+
+    def _wrap_command(self, cmd):
+        """
+        Return cmd followed by the echo of its exit status between the
+        sentinel markers, or None if nothing can follow cmd on its line.
+        """
+        cmd = cmd.rstrip()
+        # A comment would swallow the echo, a multi-line command (e.g. with
+        # a heredoc) would run it too early
+        if "#" in cmd or "\n" in cmd:
+            return None
+        # 'cmd;; echo' is a syntax error (but 'find -exec ... \;' is fine)
+        while cmd.endswith(";") and not cmd.endswith("\\;"):
+            cmd = cmd[:-1].rstrip()
+        # So are 'cmd &; echo' and 'cmd |; echo', and a line continuation
+        if not cmd or cmd[-1] in "&|\\":
+            return None
+        return "%s; echo %s$?%s" % (cmd, self._sentinel, self._sentinel)
+
+    def _use_sentinel(self, timeout, internal_timeout):
+        """
+        Return True if the shell supports the sentinel, checking it once.
+        """
+        if self._sentinel_supported is None:
+            check = "echo %s$?%s" % (self._sentinel, self._sentinel)
+            try:
+                o = self.cmd_output(check, timeout, internal_timeout)
+            except ShellError:
+                return False
+            self._sentinel_supported = self._parse_sentinel(o) is not None
+            if not self._sentinel_supported:
+                logging.debug("Shell doesn't support the exit status "
+                              "sentinel, using '%s' instead",
+                              self.status_test_command)
+        return self._sentinel_supported
+
+    def _parse_sentinel(self, o):
+        """
+        Find the exit status sentinel in the output of a command.
+
+        Whatever the shell prints after it (e.g. job notifications) is kept
+        in the output, as it is without the sentinel.
+
+        :return: Tuple (status, output without the sentinel) or None.
+        """
+        match = None
+        for match in re.finditer(r"%s(\d+)%s\r?\n?" % (self._sentinel,
+                                                       self._sentinel), o):
+            pass
+        if match is None:
+            return None
+        return int(match.group(1)), o[:match.start()] + o[match.end():]
+
     def is_responsive(self, timeout=5.0):
         """
         Return True if the process responds to STDIN/terminal input.
@@ -1548,7 +2529,16 @@ class ShellSession(Expect):
         :raise ShellStatusError: Raised if the exit status cannot be obtained
         :raise ShellError: Raised if an unknown error occurs
         """
-        o = self.cmd_output(cmd, timeout, internal_timeout, print_func)
+        wrapped = self.status_sentinel and self._wrap_command(cmd)
+        if wrapped and self._use_sentinel(timeout, internal_timeout):
+            o = self.cmd_output(wrapped, timeout, internal_timeout,
+                                print_func)
+            result = self._parse_sentinel(o)
+            if result is not None:
+                return result
+            # No sentinel (e.g. cmd started another shell), ask the shell
+        else:
+            o = self.cmd_output(cmd, timeout, internal_timeout, print_func)
         try:
             # Send the 'echo $?' (or equivalent) command to get the exit status
             s = self.cmd_output(self.status_test_command, 10, internal_timeout)
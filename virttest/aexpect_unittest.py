@@ -0,0 +1,239 @@
+#!/usr/bin/python
+
+import os
+import random
+import unittest
+
+import common
+import aexpect
+
+
+class LocalEngineTest(unittest.TestCase):
+
+    def get_session(self, **kwargs):
+        session = aexpect.ShellSession("/bin/sh", engine="local", **kwargs)
+        self.addCleanup(session.close)
+        session.sendline("PS1='$ '")
+        session.read_up_to_prompt(timeout=10)
+        return session
+
+    def testShellSession(self):
+        session = self.get_session()
+        self.assertTrue(session.is_alive())
+        self.assertEqual(session.cmd_status_output("echo hello; false"),
+                         (1, "hello\n"))
+        self.assertEqual(session.cmd_output("echo a; echo b"), "a\nb\n")
+        session.close()
+        self.assertFalse(session.is_alive())
+
+    def testStatus(self):
+        process = aexpect.Spawn("echo out; exit 3", engine="local")
+        self.assertEqual(process.get_status(), 3)
+        self.assertEqual(process.get_output(), "out\n")
+        process.close()
+
+    def testShortLivedProcesses(self):
+        # Output written right before the process exits isn't lost
+        processes = [aexpect.Spawn("echo hello%d" % i, engine="local")
+                     for i in range(50)]
+        for i, process in enumerate(processes):
+            self.assertEqual(process.get_status(), 0)
+            self.assertEqual(process.get_output(), "hello%d\n" % i)
+            process.close()
+
+    def testTailLastLine(self):
+        lines = []
+        tail = aexpect.Tail("printf last", engine="local",
+                            output_func=lines.append)
+        tail.get_status()
+        tail.close()
+        self.assertEqual(lines,
+                         ["last", "(Process terminated with status 0)"])
+
+    def testReattach(self):
+        session = self.get_session()
+        again = aexpect.ShellSession(a_id=session.get_id())
+        self.assertEqual(again.get_pid(), session.get_pid())
+        self.assertEqual(again.cmd_output("echo again"), "again\n")
+
+    def testLongCommand(self):
+        process = aexpect.Spawn("echo %s" % ("x" * 300), engine="local")
+        self.assertEqual(process.get_status(), 0)
+        self.assertEqual(process.get_output(), "x" * 300 + "\n")
+        process.close()
+        self.assertFalse(os.path.exists(os.path.join(aexpect.BASE_DIR,
+                                                     process.get_id())))
+
+
+class StatusSentinelTest(unittest.TestCase):
+
+    def get_session(self, **kwargs):
+        session = aexpect.ShellSession("/bin/sh", engine="local",
+                                       status_sentinel=True, **kwargs)
+        self.addCleanup(session.close)
+        session.sendline("PS1='$ '")
+        session.read_up_to_prompt(timeout=10)
+        return session
+
+    def testWrapCommand(self):
+        session = self.get_session()
+        sentinel = session._sentinel
+        echo = "; echo %s$?%s" % (sentinel, sentinel)
+        self.assertEqual(session._wrap_command("true"), "true" + echo)
+        self.assertEqual(session._wrap_command("a; b; ;\n"), "a; b" + echo)
+        self.assertEqual(session._wrap_command("find -exec ls {} \\;"),
+                         "find -exec ls {} \\;" + echo)
+        for cmd in ("sleep 1 &", "a &&", "a |", "a \\", "echo a # c",
+                    "cat << EOF\nx\nEOF", ";"):
+            self.assertEqual(session._wrap_command(cmd), None)
+
+    def testStatusOutput(self):
+        session = self.get_session()
+        for cmd, result in (("echo hi; (exit 3)", (3, "hi\n")),
+                            ("echo ran; true;", (0, "ran\n")),
+                            ("printf foo", (0, "foo")),
+                            ("echo a # c", (0, "a\n")),
+                            ("false ;\n", (1, ""))):
+            self.assertEqual(session.cmd_status_output(cmd), result)
+        self.assertTrue(session._sentinel_supported)
+
+    def testFallback(self):
+        session = self.get_session()
+        # Markers the shell doesn't echo back as they were sent
+        session._sentinel = "S$((1))S"
+        self.assertEqual(session.cmd_status_output("echo x; false"),
+                         (1, "x\n"))
+        self.assertFalse(session._sentinel_supported)
+
+
+class PatternMatcherTest(unittest.TestCase):
+
+    def search(self, cont, patterns):
+        # Reference: aexpect's original match_patterns()
+        return aexpect.Expect.match_patterns.im_func(None, cont, patterns)
+
+    def testSearch(self):
+        matcher = aexpect._PatternMatcher([r"login:\s*$", r"[\#\$]\s*$"])
+        self.assertEqual(matcher.search("Password: "), None)
+        self.assertEqual(matcher.search("Password: \n$ "), 1)
+        # The first pattern wins, even if it matches further on
+        matcher = aexpect._PatternMatcher([None, "b+c", "a"])
+        self.assertEqual(matcher.search("a bc", False), 1)
+        self.assertEqual(matcher.search("", False), None)
+
+    def testUncombinable(self):
+        for patterns in (["(?i)LOGIN", "x"], [r"(ab)\1", "zz"]):
+            matcher = aexpect._PatternMatcher(patterns)
+            self.assertEqual(matcher.combined, None)
+            self.assertEqual(matcher.search("xx login abab", False), 0)
+
+    def testIncremental(self):
+        rand = random.Random(0)
+        pattern_lists = [[r"login:\s*$", r"[\#\$]\s*$"],
+                         [None, "b+c", "a"], ["(?i)LOGIN", "x"],
+                         [r"(ab)\1", "zz"], ["foo\nbar", "q$"],
+                         ["^start", "end"]]
+        alphabet = "abcxzq$#\n login:foo bar LOGIN start end"
+        for patterns in pattern_lists:
+            for _ in range(200):
+                text = "".join(rand.choice(alphabet)
+                               for _ in range(rand.randint(0, 60)))
+                matcher = aexpect._PatternMatcher(patterns)
+                # A small overlap, so matches span the rescanned part
+                matcher.overlap = 8
+                cuts = sorted(rand.sample(range(len(text) + 1),
+                                            min(3, len(text) + 1)))
+                for cut in cuts + [len(text)]:
+                    found = matcher.search(text[:cut])
+                    expected = self.search(text[:cut], patterns)
+                    self.assertEqual(found, expected,
+                                     (patterns, text[:cut]))
+                    if found is not None:
+                        break
+
+    def testLastWord(self):
+        rand = random.Random(1)
+        for _ in range(500):
+            text = "".join(rand.choice("ab \n\t")
+                           for _ in range(rand.randint(0, 3000)))
+            words = text.split()
+            self.assertEqual(aexpect._get_last_word(text),
+                             words and words[-1] or "")
+
+    def testLastNonemptyLine(self):
+        rand = random.Random(2)
+        for _ in range(500):
+            text = "".join(rand.choice("ab \n\n\t")
+                           for _ in range(rand.randint(0, 3000)))
+            lines = [l for l in text.splitlines() if l.strip()]
+            self.assertEqual(aexpect._get_last_nonempty_line(text),
+                             lines and lines[-1] or "")
+        # A long last line is not cut
+        text = "x\n" + "y" * 5000 + "\n"
+        self.assertEqual(aexpect._get_last_nonempty_line(text), "y" * 5000)
+
+
+class OutputBufferTest(unittest.TestCase):
+
+    def testReadUnread(self):
+        bfr = aexpect._OutputBuffer()
+        bfr.append("abc")
+        bfr.append("")
+        bfr.append("defg")
+        self.assertEqual(len(bfr), 7)
+        self.assertEqual(bfr.read(4), "abcd")
+        bfr.unread("cd")
+        self.assertEqual(bfr.getvalue(), "cdefg")
+        self.assertEqual(bfr.read(), "cdefg")
+        self.assertEqual(len(bfr), 0)
+        self.assertEqual(bfr.read(3), "")
+
+    def testLimit(self):
+        bfr = aexpect._OutputBuffer(5)
+        bfr.append("abc")
+        bfr.append("defg")
+        self.assertEqual(bfr.getvalue(), "cdefg")
+        bfr.append("123456")
+        self.assertEqual(bfr.getvalue(), "23456")
+        bfr.set_limit(2)
+        self.assertEqual(bfr.read(), "56")
+        bfr.set_limit(None)
+        bfr.append("x" * 10)
+        self.assertEqual(len(bfr), 10)
+
+    def testRandom(self):
+        rand = random.Random(3)
+        for _ in range(300):
+            limit = rand.choice([None, 1, 5, 17, 100])
+            bfr = aexpect._OutputBuffer(limit)
+            expected = ""
+            for _ in range(30):
+                action = rand.random()
+                if action < 0.5:
+                    data = "".join(rand.choice("abc")
+                                   for _ in range(rand.randint(0, 20)))
+                    bfr.append(data)
+                    expected += data
+                    if limit:
+                        expected = expected[-limit:]
+                elif action < 0.7:
+                    size = rand.choice([None, 0, 1, 3, 50])
+                    data = bfr.read(size)
+                    self.assertEqual(data, expected[:size])
+                    expected = expected[len(data):]
+                    # Put some back, as the server does after short writes
+                    rest = data[rand.randint(0, len(data)):]
+                    bfr.unread(rest)
+                    expected = rest + expected
+                elif action < 0.8:
+                    limit = rand.choice([None, 1, 5, 17, 100])
+                    bfr.set_limit(limit)
+                    if limit:
+                        expected = expected[-limit:]
+                else:
+                    self.assertEqual(bfr.getvalue(), expected)
+                self.assertEqual(len(bfr), len(expected))
+
+
+if __name__ == '__main__':
+    unittest.main()
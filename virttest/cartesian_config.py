@@ -134,16 +134,33 @@ The base of the definitions come verbatim as follows:
 
 import os
 import collections
+import errno
 import optparse
 import logging
 import re
 import string
 import sys
+import hashlib
+import heapq
+import itertools
+import json
+import keyword
+import multiprocessing
+import tempfile
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 _reserved_keys = set(("name", "shortname", "dep"))
 
 num_failed_cases = 5
 
+# Bump this whenever the layout of the parsed tree changes, so stale parse
+# caches written by older versions are ignored.
+_cache_version = 4
+
 
 class ParserError(Exception):
 
@@ -188,71 +205,126 @@ else:
     enum = enumerate
 
 
-def _match_adjacent(block, ctx, ctx_set):
+def _match_adjacent(block, ctx, ctx_mask):
     """
     It try to match as many blocks as possible from context.
 
+    Labels are represented as bits: block is a tuple of label masks (the
+    bits of all context labels each filter label matches), ctx is the tuple
+    of the bits of context labels and ctx_mask is the OR of ctx.
+
     :return: Count of matched blocks.
     """
-    if block[0] not in ctx_set:
+    if not block[0] & ctx_mask:
         return 0
     if len(block) == 1:
         return 1                          # First match and length is 1.
-    if block[1] not in ctx_set:
-        return int(ctx[-1] == block[0])   # Check match with last from ctx.
+    if not block[1] & ctx_mask:
+        return int(bool(ctx[-1] & block[0]))  # Check match with last from ctx.
     k = 0
-    i = ctx.index(block[0])
+    i = 0
+    while not ctx[i] & block[0]:
+        i += 1
     while i < len(ctx):                   # Try to  match all of blocks.
-        if k > 0 and ctx[i] != block[k]:  # Block not match
+        if k > 0 and not ctx[i] & block[k]:  # Block not match
             i -= k - 1
             k = 0                         # Start from first block in next ctx.
-        if ctx[i] == block[k]:
+        if ctx[i] & block[k]:
             k += 1
             if k >= len(block):           # match all of blocks
                 break
-            if block[k] not in ctx_set:   # block in not in whole ctx.
+            if not block[k] & ctx_mask:   # block in not in whole ctx.
                 break
         i += 1
     return k
 
 
-def _might_match_adjacent(block, ctx, ctx_set, descendant_labels):
-    matched = _match_adjacent(block, ctx, ctx_set)
+def _might_match_adjacent(block, ctx, ctx_mask, descendant_labels):
+    matched = _match_adjacent(block, ctx, ctx_mask)
     for elem in block[matched:]:        # Try to find rest of blocks in subtree
-        if elem not in descendant_labels:
-            # print "Can't match %s, ctx %s" % (block, ctx)
+        if not elem & descendant_labels:
             return False
     return True
 
 
+def _compile_word(word):
+    """
+    Precompile a word (the ``..`` separated part of a filter).
+
+    :param word: List of blocks, each a tuple of label masks.
+    :return: Tuple (single, multi, adjacent) where single is the OR of all
+            one-label blocks matching exactly one context label, multi are
+            the masks of one-label blocks matching several context labels and
+            adjacent are the blocks with more labels.  None if the word can
+            never match.
+    """
+    single = 0
+    multi = []
+    adjacent = []
+    for block in word:
+        if not all(block):
+            return None
+        if len(block) > 1:
+            adjacent.append(block)
+        elif block[0] & (block[0] - 1):
+            multi.append(block[0])
+        else:
+            single |= block[0]
+    return single, multi, adjacent
+
+
 # Filter must inherit from object (otherwise type() won't work)
 class Filter(object):
-    __slots__ = ["filter"]
+    __slots__ = ["filter", "masks", "words"]
 
     def __init__(self, lfilter):
         self.filter = lfilter
         # print self.filter
 
-    def match(self, ctx, ctx_set):
-        for word in self.filter:  # Go through ,
-            for block in word:    # Go through ..
-                if _match_adjacent(block, ctx, ctx_set) != len(block):
+    def compile(self, label_mask):
+        """
+        Translate the filter labels into bitmasks (see Parser._compile()).
+
+        :param label_mask: Function returning the mask of context labels a
+                filter label matches.
+        """
+        self.masks = [[tuple([label_mask(label) for label in block])
+                       for block in word]
+                      for word in self.filter]
+        self.words = [w for w in [_compile_word(word) for word in self.masks]
+                      if w is not None]
+
+    def match(self, ctx, ctx_mask):
+        for single, multi, adjacent in self.words:  # Go through ,
+            if ctx_mask & single != single:
+                continue
+            for mask in multi:
+                if not mask & ctx_mask:
                     break
             else:
-                # print "Filter pass: %s ctx: %s" % (self.filter, ctx)
-                return True       # All match
+                for block in adjacent:
+                    if _match_adjacent(block, ctx, ctx_mask) != len(block):
+                        break
+                else:
+                    return True       # All match
         return False
 
-    def might_match(self, ctx, ctx_set, descendant_labels):
+    def might_match(self, ctx, ctx_mask, descendant_labels):
         # There is some posibility to match in children blocks.
-        for word in self.filter:
-            for block in word:
-                if not _might_match_adjacent(block, ctx, ctx_set,
-                                             descendant_labels):
+        available = ctx_mask | descendant_labels
+        for single, multi, adjacent in self.words:
+            if available & single != single:
+                continue
+            for mask in multi:
+                if not mask & available:
                     break
             else:
-                return True
-        # print "Filter not pass: %s ctx: %s" % (self.filter, ctx)
+                for block in adjacent:
+                    if not _might_match_adjacent(block, ctx, ctx_mask,
+                                                 descendant_labels):
+                        break
+                else:
+                    return True
         return False
 
 
@@ -274,21 +346,21 @@ class NoOnlyFilter(Filter):
 class OnlyFilter(NoOnlyFilter):
     # pylint: disable=W0613
 
-    def is_irrelevant(self, ctx, ctx_set, descendant_labels):
+    def is_irrelevant(self, ctx, ctx_mask, descendant_labels):
         # Matched in this tree.
-        return self.match(ctx, ctx_set)
+        return self.match(ctx, ctx_mask)
 
-    def requires_action(self, ctx, ctx_set, descendant_labels):
+    def requires_action(self, ctx, ctx_mask, descendant_labels):
         # Impossible to match in this tree.
-        return not self.might_match(ctx, ctx_set, descendant_labels)
+        return not self.might_match(ctx, ctx_mask, descendant_labels)
 
-    def might_pass(self, failed_ctx, failed_ctx_set, ctx, ctx_set,
+    def might_pass(self, failed_ctx, failed_ctx_mask, ctx, ctx_mask,
                    descendant_labels):
-        for word in self.filter:
+        for word in self.masks:
             for block in word:
-                if (_match_adjacent(block, ctx, ctx_set) >
-                        _match_adjacent(block, failed_ctx, failed_ctx_set)):
-                    return self.might_match(ctx, ctx_set, descendant_labels)
+                if (_match_adjacent(block, ctx, ctx_mask) >
+                        _match_adjacent(block, failed_ctx, failed_ctx_mask)):
+                    return self.might_match(ctx, ctx_mask, descendant_labels)
         return False
 
     def __str__(self):
@@ -300,21 +372,21 @@ class OnlyFilter(NoOnlyFilter):
 
 class NoFilter(NoOnlyFilter):
 
-    def is_irrelevant(self, ctx, ctx_set, descendant_labels):
-        return not self.might_match(ctx, ctx_set, descendant_labels)
+    def is_irrelevant(self, ctx, ctx_mask, descendant_labels):
+        return not self.might_match(ctx, ctx_mask, descendant_labels)
 
     # pylint: disable=W0613
-    def requires_action(self, ctx, ctx_set, descendant_labels):
-        return self.match(ctx, ctx_set)
+    def requires_action(self, ctx, ctx_mask, descendant_labels):
+        return self.match(ctx, ctx_mask)
 
     # pylint: disable=W0613
-    def might_pass(self, failed_ctx, failed_ctx_set, ctx, ctx_set,
+    def might_pass(self, failed_ctx, failed_ctx_mask, ctx, ctx_mask,
                    descendant_labels):
-        for word in self.filter:
+        for word in self.masks:
             for block in word:
-                if (_match_adjacent(block, ctx, ctx_set) <
-                        _match_adjacent(block, failed_ctx, failed_ctx_set)):
-                    return not self.match(ctx, ctx_set)
+                if (_match_adjacent(block, ctx, ctx_mask) <
+                        _match_adjacent(block, failed_ctx, failed_ctx_mask)):
+                    return not self.match(ctx, ctx_mask)
         return False
 
     def __str__(self):
@@ -433,8 +505,23 @@ class FileReader(StrReader):
 
         :parse filename: The name of the input file.
         """
-        StrReader.__init__(self, open(filename).read())
+        content = open(filename).read()
+        StrReader.__init__(self, content)
         self.filename = filename
+        self.digest = hashlib.sha1(content).hexdigest()
+
+
+def _file_digest(filename):
+    """
+    Return the content hash used to validate cached parse trees.
+
+    :param filename: Path of the file to hash.
+    """
+    fileobj = open(filename, "rb")
+    try:
+        return hashlib.sha1(fileobj.read()).hexdigest()
+    finally:
+        fileobj.close()
 
 
 class Label(object):
@@ -501,7 +588,8 @@ class Label(object):
 class Node(object):
     __slots__ = ["var_name", "name", "filename", "dep", "content", "children",
                  "labels", "append_to_shortname", "failed_cases", "default",
-                 "q_dict"]
+                 "q_dict", "name_bits", "name_mask", "labels_mask",
+                 "location"]
 
     def __init__(self):
         self.var_name = []
@@ -514,6 +602,12 @@ class Node(object):
         self.append_to_shortname = False
         self.failed_cases = collections.deque()
         self.default = False
+        # Bitmask form of name and labels, filled by Parser._compile()
+        self.name_bits = ()
+        self.name_mask = 0
+        self.labels_mask = 0
+        # "file:line" of the variants block the node is a variant of
+        self.location = ""
 
     def dump(self, indent, recurse=False):
         print("%s%s" % (" " * indent, self.name))
@@ -529,31 +623,70 @@ class Node(object):
 match_subtitute = re.compile("\$\{(.+?)\}")
 
 
-def _subtitution(value, d):
-    """
-    Only optimization string Template subtitute is quite expensive operation.
+_name_exp = re.compile(r"[A-Za-z_][A-Za-z0-9_]*$")
+
+# Code of ${...} expressions which aren't plain keys, by expression.
+_expr_code = {}
+
 
-    :param value: String where could be $string for subtitution.
-    :param d: Dictionary from which should be value subtituted to value.
+def _eval_expr(expr, d):
+    code = _expr_code.get(expr)
+    if code is None:
+        # eval() of a string ignores leading blanks, compile() doesn't.
+        code = compile(expr.lstrip(" \t"), "<string>", "eval")
+        _expr_code[expr] = code
+    return eval(code, None, d)
+
+
+class _Template(object):
 
-    :return: Substituted string
     """
-    if "$" in value:
+    Value containing ${...} references, split once into literal chunks and
+    references so that substituting it is a join of dict lookups.
+    """
+    __slots__ = ["value", "refs", "tail"]
+
+    def __init__(self, value):
+        """
+        :param value: String with ${...} references.
+        """
+        self.value = value
+        # (start of literal, literal, expression, expression is a key)
+        self.refs = []
         start = 0
-        st = ""
-        try:
-            match = match_subtitute.search(value, start)
-            while match:
-                val = eval(match.group(1), None, d)
-                st += value[start:match.start()] + str(val)
-                start = match.end()
-                match = match_subtitute.search(value, start)
-        except:
-            pass
-        st += value[start:len(value)]
-        return st
-    else:
-        return value
+        for match in match_subtitute.finditer(value):
+            expr = match.group(1)
+            is_key = bool(_name_exp.match(expr) and
+                          not keyword.iskeyword(expr) and expr != "None")
+            self.refs.append((start, value[start:match.start()], expr,
+                              is_key))
+            start = match.end()
+        self.tail = value[start:]
+
+    def substitute(self, d):
+        """
+        :param d: Dictionary from which should be value subtituted to value.
+        :return: Substituted string.  ${key} is replaced by d[key], other
+                references are evaluated as Python expressions in d.  If a
+                reference fails, it and the rest of the value are left as
+                they are.
+        """
+        chunks = []
+        for start, literal, expr, is_key in self.refs:
+            try:
+                if is_key and expr in d:
+                    val = str(d[expr])
+                else:
+                    # Anything else is evaluated like a Python expression.
+                    val = str(_eval_expr(expr, d))
+            except:
+                # Leave this and following references unsubstituted.
+                chunks.append(self.value[start:])
+                return "".join(chunks)
+            chunks.append(literal)
+            chunks.append(val)
+        chunks.append(self.tail)
+        return "".join(chunks)
 
 
 class Token(object):
@@ -773,7 +906,7 @@ class LInclude(Token):
 
 
 class LOperators(Token):
-    __slots__ = ["name", "value"]
+    __slots__ = ["name", "value", "template"]
     identifier = ""
     function = None
 
@@ -782,8 +915,22 @@ class LOperators(Token):
         self.name = str(name)
         # pylint: disable=W0201
         self.value = str(value)
+        # Values with references are compiled once, when parsed.
+        # pylint: disable=W0201
+        self.template = None
+        if "${" in self.value:
+            self.template = _Template(self.value)
         return self
 
+    def substitute(self, d):
+        """
+        :param d: Dictionary from which references in value are substituted.
+        :return: Value with references substituted.
+        """
+        if self.template is None:
+            return self.value
+        return self.template.substitute(d)
+
 
 class LSet(LOperators):
     __slots__ = []
@@ -794,7 +941,7 @@ class LSet(LOperators):
         :param d: Dictionary for apply value
         """
         if self.name not in _reserved_keys:
-            d[self.name] = _subtitution(self.value, d)
+            d[self.name] = self.substitute(d)
 
 
 class LAppend(LOperators):
@@ -803,7 +950,7 @@ class LAppend(LOperators):
 
     def apply_to_dict(self, d):
         if self.name not in _reserved_keys:
-            d[self.name] = d.get(self.name, "") + _subtitution(self.value, d)
+            d[self.name] = d.get(self.name, "") + self.substitute(d)
 
 
 class LPrepend(LOperators):
@@ -812,7 +959,7 @@ class LPrepend(LOperators):
 
     def apply_to_dict(self, d):
         if self.name not in _reserved_keys:
-            d[self.name] = _subtitution(self.value, d) + d.get(self.name, "")
+            d[self.name] = self.substitute(d) + d.get(self.name, "")
 
 
 class LRegExpSet(LOperators):
@@ -821,7 +968,7 @@ class LRegExpSet(LOperators):
 
     def apply_to_dict(self, d):
         exp = re.compile("%s$" % self.name)
-        value = _subtitution(self.value, d)
+        value = self.substitute(d)
         for key in d:
             if key not in _reserved_keys and exp.match(key):
                 d[key] = value
@@ -833,7 +980,7 @@ class LRegExpAppend(LOperators):
 
     def apply_to_dict(self, d):
         exp = re.compile("%s$" % self.name)
-        value = _subtitution(self.value, d)
+        value = self.substitute(d)
         for key in d:
             if key not in _reserved_keys and exp.match(key):
                 d[key] += value
@@ -845,7 +992,7 @@ class LRegExpPrepend(LOperators):
 
     def apply_to_dict(self, d):
         exp = re.compile("%s$" % self.name)
-        value = _subtitution(self.value, d)
+        value = self.substitute(d)
         for key in d:
             if key not in _reserved_keys and exp.match(key):
                 d[key] = value + d[key]
@@ -939,10 +1086,18 @@ tokens_oper = {"": LSet,
                }
 
 
-tokens_oper_re = [r"\=", r"\+\=", r"\<\=", r"\?\=", r"\?\+\=", r"\?\<\="]
-
-
-_ops_exp = re.compile(r"|".join(tokens_oper_re))
+# Master expression of the scanner in Lexer.match(), one group per kind of
+# token.  Lexer.match() dispatches on the index of the matched group.
+_token_exp = re.compile(r"""
+    ([A-Za-z0-9_-]+)            # 1: identifier characters
+    |(\s+)                      # 2: whitespace
+    |([+<?])                    # 3: operator prefix
+    |(=)                        # 4: end of operator
+    |([.:@,\[\]()!])            # 5: tokens_map
+    |"([^"]*"?)                 # 6: quoted string
+    |(\#)                       # 7: comment
+    """, re.VERBOSE)
+_T_IDEN, _T_WHITE, _T_OPER, _T_SET, _T_MAP, _T_STR, _T_HASH = range(1, 8)
 
 
 class Lexer(object):
@@ -971,8 +1126,6 @@ class Lexer(object):
     def match(self, line, pos):
         l0 = line[0]
         chars = ""
-        m = None
-        cind = 0
         if l0 == "v":
             if line.startswith("variants:"):
                 yield LVariants()
@@ -1007,82 +1160,99 @@ class Lexer(object):
                 while line[pos].isspace():
                     pos += 1
 
+        # Every operator ends with the first "=" of the line, so assignments
+        # are recognized without scanning the line.
+        eq = -1
         if self.fast and pos == 0:  # due to refexp
-            cind = line[pos:].find(":")
-            m = _ops_exp.search(line[pos:])
+            eq = line.find("=")
+            if eq >= 0:
+                cind = line.find(":")
+                if 0 <= cind <= eq + 1:
+                    eq = -1
 
         oper = ""
-        token = None
 
         if self.rest_as_string:
             self.rest_as_string = False
             yield LString(line[pos:].lstrip())
-        elif self.fast and m and (cind < 0 or cind > m.end()):
-            chars = ""
-            yield LIdentifier(line[:m.start()].rstrip())
-            yield tokens_oper[m.group()[:-1]]()
-            yield LString(line[m.end():].lstrip())
+        elif eq >= 0:
+            start = eq
+            if eq > 1 and line[eq - 2] == "?" and line[eq - 1] in "+<":
+                start = eq - 2
+            elif eq > 0 and line[eq - 1] in "?+<":
+                start = eq - 1
+            yield LIdentifier(line[:start].rstrip())
+            yield tokens_oper[line[start:eq]]()
+            yield LString(line[eq + 1:].lstrip())
         else:
-            li = enum(line[pos:], pos)
-            for pos, char in li:
-                if char.isalnum() or char in spec_iden:    # alfanum+_-
-                    chars += char
-                elif char in spec_oper:     # <+?=
+            end = len(line)
+            scan = _token_exp.match
+            while pos < end:
+                m = scan(line, pos)
+                if m is None:
                     if chars:
                         yield LIdentifier(chars)
-                        oper = ""
-                    chars = ""
-                    oper += char
-                else:
+                    raise LexerError("Unexpected character %s on"
+                                     " pos %s. Special chars are allowed"
+                                     " only in variable assignation"
+                                     " statement" % (line[pos], pos), line,
+                                     self.filename, self.linenum)
+                kind = m.lastindex
+                if kind == _T_IDEN:
+                    chars += m.group(kind)
+                    pos = m.end()
+                    continue
+                if kind == _T_OPER:
                     if chars:
                         yield LIdentifier(chars)
-                        chars = ""
-                    if char.isspace():   # Whitespace
-                        for pos, char in li:
-                            if not char.isspace():
-                                if not self.ignore_white:
-                                    yield LWhite()
-                                break
-                    if char.isalnum() or char in spec_iden:
-                        chars += char
-                    elif char == "=":
-                        if oper in tokens_oper:
-                            yield tokens_oper[oper]()
-                        else:
-                            raise LexerError("Unexpected character %s on"
-                                             " pos %s" % (char, pos),
-                                             self.line, self.filename,
-                                             self.linenum)
                         oper = ""
-                    elif char in tokens_map:
-                        token = tokens_map[char]()
-                    elif char == "\"":
-                        chars = ""
-                        pos, char = li.next()
-                        while char != "\"":
-                            chars += char
-                            pos, char = li.next()
-                        yield LString(chars)
-                    elif char == "#":
-                        break
-                    elif char in spec_oper:
-                        oper += char
-                    else:
+                    chars = ""
+                    oper += m.group(kind)
+                    pos = m.end()
+                    continue
+                if chars:
+                    yield LIdentifier(chars)
+                    chars = ""
+                pos = m.end()
+                if kind == _T_WHITE:
+                    if pos == end:
+                        # Lines are stripped, so this can't happen for lines
+                        # coming from a reader.
                         raise LexerError("Unexpected character %s on"
                                          " pos %s. Special chars are allowed"
                                          " only in variable assignation"
-                                         " statement" % (char, pos), line,
-                                         self.filename, self.linenum)
-                    if token is not None:
-                        yield token
-                        token = None
-                    if self.rest_as_string:
-                        self.rest_as_string = False
-                        yield LString(line[pos + 1:].lstrip())
-                        break
+                                         " statement" % (line[-1], end - 1),
+                                         line, self.filename, self.linenum)
+                    if not self.ignore_white:
+                        yield LWhite()
+                    continue
+                elif kind == _T_SET:
+                    if oper in tokens_oper:
+                        yield tokens_oper[oper]()
+                    else:
+                        raise LexerError("Unexpected character = on"
+                                         " pos %s" % (pos - 1),
+                                         self.line, self.filename,
+                                         self.linenum)
+                    oper = ""
+                elif kind == _T_MAP:
+                    yield tokens_map[m.group(kind)]()
+                elif kind == _T_HASH:
+                    break
+                else:
+                    chars = m.group(kind)
+                    if not chars.endswith('"'):
+                        # Unterminated string ends the line without LEndL.
+                        return
+                    # The string is kept as pending identifier characters.
+                    chars = chars[:-1]
+                    yield LString(chars)
+                if self.rest_as_string:
+                    self.rest_as_string = False
+                    yield LString(line[pos:].lstrip())
+                    break
         if chars:
             yield LIdentifier(chars)
-            chars = ""
         yield LEndL()
 
     def get_lexer(self):
@@ -1306,16 +1476,337 @@ def parse_filter(lexer, tokens):
     return or_filters
 
 
+def _intern(value):
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+class LayeredDict(object):
+
+    """
+    Dictionary generated by Parser.get_dicts(layered=True).
+
+    Dictionaries generated one after another mostly hold the same keys and
+    values, so a LayeredDict only stores the keys in which it differs from a
+    base dictionary shared with its neighbours.  The base is never modified:
+    changes only go to the own layer (copy on write).  Keys and string values
+    are interned.
+
+    It has the interface of a dict, so it can be passed to Params.
+    """
+    __slots__ = ["base", "own", "deleted"]
+
+    def __init__(self, base, own=None, deleted=frozenset()):
+        """
+        :param base: Shared dict, never modified.
+        :param own: Dict of keys added or changed against base.
+        :param deleted: Set of keys of base missing in this dict.
+        """
+        self.base = base
+        if own is None:
+            own = {}
+        self.own = own
+        self.deleted = deleted
+
+    def __reduce__(self):
+        return (LayeredDict, (self.base, self.own, self.deleted))
+
+    def __getitem__(self, key):
+        own = self.own
+        if key in own:
+            return own[key]
+        if key in self.deleted:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.own[key] = value
+        if key in self.deleted:
+            self.deleted = self.deleted - frozenset((key,))
+
+    def __delitem__(self, key):
+        if key in self.own:
+            del self.own[key]
+            if key in self.base:
+                self.deleted = self.deleted | frozenset((key,))
+        elif key in self.base and key not in self.deleted:
+            self.deleted = self.deleted | frozenset((key,))
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        if key in self.own:
+            return True
+        return key in self.base and key not in self.deleted
+
+    has_key = __contains__
+
+    def __iter__(self):
+        own = self.own
+        deleted = self.deleted
+        for key in own:
+            yield key
+        for key in self.base:
+            if key not in own and key not in deleted:
+                yield key
+
+    iterkeys = __iter__
+
+    def __len__(self):
+        base = self.base
+        return (len(base) - len(self.deleted) +
+                len([key for key in self.own if key not in base]))
+
+    def keys(self):
+        return list(self)
+
+    def iteritems(self):
+        for key in self:
+            yield key, self[key]
+
+    def items(self):
+        return list(self.iteritems())
+
+    def itervalues(self):
+        for key in self:
+            yield self[key]
+
+    def values(self):
+        return list(self.itervalues())
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def setdefault(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            self[key] = default
+            return default
+
+    def pop(self, key, *default):
+        try:
+            value = self[key]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[key]
+        return value
+
+    def update(self, other=(), **kwargs):
+        if hasattr(other, "keys"):
+            for key in other.keys():
+                self[key] = other[key]
+        else:
+            for key, value in other:
+                self[key] = value
+        for key, value in kwargs.items():
+            self[key] = value
+
+    def clear(self):
+        self.own = {}
+        self.deleted = frozenset(self.base)
+
+    def copy(self):
+        """
+        :return: Flat dict with the same content.
+        """
+        return dict(self.iteritems())
+
+    def __eq__(self, other):
+        if isinstance(other, LayeredDict):
+            other = other.copy()
+        return self.copy() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self.copy())
+
+
+collections.MutableMapping.register(LayeredDict)
+
+
+class ParserProfile(object):
+
+    """
+    Statistics collected by a Parser created with profile=True.
+    """
+
+    def __init__(self):
+        # filename: [total time, time without includes, times parsed]
+        self.files = {}
+        self._file_stack = []
+        # variants block location: [time, visited nodes, pruned nodes]
+        self.blocks = {}
+        self.visited = 0
+        self.pruned = 0
+        self.dicts = 0
+        # Failed cases (negative cache of nodes) statistics
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_evictions = 0
+
+    def start_file(self, filename):
+        self._file_stack.append((filename, time.time(), [0.0]))
+
+    def stop_file(self):
+        filename, start, included = self._file_stack.pop()
+        elapsed = time.time() - start
+        stats = self.files.setdefault(filename, [0.0, 0.0, 0])
+        stats[0] += elapsed
+        stats[1] += elapsed - included[0]
+        stats[2] += 1
+        if self._file_stack:
+            self._file_stack[-1][2][0] += elapsed
+
+    def add_node(self, location, elapsed, pruned):
+        stats = self.blocks.setdefault(location, [0.0, 0, 0])
+        stats[0] += elapsed
+        stats[1] += 1
+        self.visited += 1
+        if pruned:
+            stats[2] += 1
+            self.pruned += 1
+
+    def add_dict(self, location, elapsed):
+        self.blocks.setdefault(location, [0.0, 0, 0])[0] += elapsed
+        self.dicts += 1
+
+    def report(self, top=20):
+        """
+        :param top: Number of the slowest files and blocks to list.
+        :return: Report as a string.
+        """
+        lines = ["Parse time per file (total, without includes, count):"]
+        files = sorted(self.files.items(), key=lambda x: -x[1][0])
+        for filename, (total, own, count) in files[:top]:
+            lines.append("  %8.3fs %8.3fs %4d  %s" % (total, own, count,
+                                                     filename))
+        lines.append("Walk time per variants block (time, visited, "
+                     "pruned):")
+        blocks = sorted(self.blocks.items(), key=lambda x: -x[1][0])
+        for location, (elapsed, visited, pruned) in blocks[:top]:
+            lines.append("  %8.3fs %8d %8d  %s" % (elapsed, visited, pruned,
+                                                  location or "<top>"))
+        lines.append("Nodes visited: %d, pruned: %d, dicts: %d" %
+                     (self.visited, self.pruned, self.dicts))
+        lookups = self.cache_hits + self.cache_misses
+        ratio = 0.0
+        if lookups:
+            ratio = 100.0 * self.cache_hits / lookups
+        lines.append("Failed cases cache (size %d): hits: %d, misses: %d "
+                     "(%.1f%% hit), evictions: %d" %
+                     (num_failed_cases, self.cache_hits, self.cache_misses,
+                      ratio, self.cache_evictions))
+        return "\n".join(lines) + "\n"
+
+
+class _WalkState(object):
+
+    """
+    Bookkeeping shared by all levels of one walk over the parsed tree.
+    """
+    __slots__ = ["leaves", "skip", "build", "select", "layered", "base",
+                 "target"]
+
+    def __init__(self, skip=0, build=True, select=None, layered=False,
+                 target=None):
+        """
+        :param skip: Number of leading leaves for which nothing is yielded.
+        :param build: If False, yield (name, shortname) tuples instead of
+                building dictionaries.
+        :param select: Function taking (name, shortname) of a leaf and
+                returning whether its dictionary should be built.
+        :param layered: If True, yield LayeredDicts instead of dicts.
+        :param target: Path of child indexes from the root, only the subtree
+                at its end is walked.
+        """
+        self.leaves = 0
+        self.skip = skip
+        self.build = build
+        self.select = select
+        self.layered = layered
+        self.base = None
+        self.target = target
+
+    def share(self, d):
+        """
+        Turn d into a LayeredDict sharing the base of previous dicts.
+
+        When d differs from the current base in more than half of its keys,
+        d becomes the new base.
+        """
+        base = self.base
+        if base is not None:
+            own = {}
+            for key, value in d.iteritems():
+                if key in base:
+                    old = base[key]
+                    # Only immutable values are shared, so that changing
+                    # e.g. a list of one dict doesn't change others.
+                    if old is value or (type(value) is str and old == value):
+                        continue
+                own[intern(key)] = _intern(value)
+            deleted = [key for key in base if key not in d]
+            if (len(own) + len(deleted)) * 2 <= len(d):
+                if deleted:
+                    return LayeredDict(base, own, frozenset(deleted))
+                return LayeredDict(base, own)
+        base = {}
+        for key, value in d.iteritems():
+            base[intern(key)] = _intern(value)
+        self.base = base
+        return LayeredDict(base)
+
+
+# Parser used by the workers of Parser.get_dicts(processes=n), inherited
+# through fork().
+_pool_parser = None
+
+
+def _get_subtree_dicts(args):
+    target, layered = args
+    walk = _WalkState(layered=layered, target=target)
+    return list(_pool_parser._get_dicts(_pool_parser.node, [], [], [], [],
+                                        walk, ()))
+
+
 class Parser(object):
     # pylint: disable=W0102
 
     def __init__(self, filename=None, defaults=False, expand_defaults=[],
-                 debug=False):
+                 debug=False, cache_dir=None, profile=False):
         self.node = Node()
         self.debug = debug
         self.defaults = defaults
         self.expand_defaults = [LIdentifier(x) for x in expand_defaults]
 
+        # Parse trees of files are cached in cache_dir.  _cache_key describes
+        # everything parsed so far; it becomes None as soon as something
+        # which can't be cached (a string) is parsed.
+        self.cache_dir = cache_dir
+        self._cache_key = ""
+        self._sources = []
+        # Number of dicts generated by subtrees, indexed by the path of child
+        # indexes from the root.  Filled by walks started at the root.
+        self._leaf_counts = {}
+        # Labels of the tree interned as bits, see _compile().
+        self._compiled = False
+        self._label_bits = {}
+        # ParserProfile if profiling is enabled
+        self.profile = None
+        if profile:
+            self.profile = ParserProfile()
+
         self.filename = filename
         if self.filename:
             self.parse_file(self.filename)
@@ -1337,9 +1828,34 @@ class Parser(object):
 
         :param filename: Path of the configuration file.
         """
+        key = None
+        if self.cache_dir and self._cache_key is not None:
+            key = self._get_cache_key(filename)
+            # A profile needs the file to be actually parsed
+            node = None
+            if not self.profile:
+                node = self._load_cache(key)
+            if node is not None:
+                self._debug("Loaded parse tree of %s from cache", filename)
+                self._tree_changed()
+                self.node = node
+                self.filename = filename
+                self._cache_key = key
+                return
+
+        # _sources keeps the files read by earlier parse_file() calls too:
+        # the tree, hence its cache entry, depends on them as well
+        self._tree_changed()
         self.node.filename = filename
-        self.node = self._parse(Lexer(FileReader(filename)), self.node)
+        if self.profile:
+            self.profile.start_file(filename)
+        self.node = self._parse(Lexer(self._file_reader(filename)), self.node)
+        if self.profile:
+            self.profile.stop_file()
         self.filename = filename
+        if key is not None:
+            self._save_cache(key)
+        self._cache_key = key
 
     def parse_string(self, s):
         """
@@ -1347,8 +1863,172 @@ class Parser(object):
 
         :param s: String to parse.
         """
-        self.node.filename = StrReader("").filename
-        self.node = self._parse(Lexer(StrReader(s)), self.node)
+        self._cache_key = None
+        self._tree_changed()
+        reader = StrReader(s)
+        self.node.filename = reader.filename
+        if self.profile:
+            self.profile.start_file(reader.filename)
+        self.node = self._parse(Lexer(reader), self.node)
+        if self.profile:
+            self.profile.stop_file()
+
+    def _tree_changed(self):
+        """
+        Forget everything derived from the parse tree.
+        """
+        self._leaf_counts = {}
+        self._compiled = False
+
+    def _compile(self, extra=None):
+        """
+        Prepare the parse tree for matching.
+
+        Every distinct context label (by long name) gets a bit.  Nodes get
+        the bits of their name and the mask of their descendant labels, and
+        filters translate each of their labels into the mask of context
+        labels it matches, so matching a filter against a context becomes a
+        few integer operations instead of set lookups of Labels.
+
+        :param extra: Node which isn't part of the parse tree (e.g. holding
+                an external context) to compile along with the tree.
+        """
+        if self._compiled and extra is None:
+            return
+        label_bits = {}
+        name_masks = {}
+        nodes = []
+        visited = set()
+        stack = [self.node]
+        if extra is not None:
+            stack.append(extra)
+        while stack:
+            node = stack.pop()
+            if id(node) in visited:
+                continue
+            visited.add(id(node))
+            nodes.append(node)
+            stack.extend(node.children)
+            for label in node.name:
+                if label.long_name not in label_bits:
+                    bit = 1 << len(label_bits)
+                    label_bits[label.long_name] = bit
+                    name_masks[label.name] = name_masks.get(label.name,
+                                                            0) | bit
+
+        def label_mask(label):
+            # Labels with a variable name only match the same variant,
+            # labels without one match any variant of that name.
+            if label.var_name:
+                return label_bits.get(label.long_name, 0)
+            return name_masks.get(label.name, 0)
+
+        def compile_content(content):
+            for _, _, obj in content:
+                if isinstance(obj, Filter):
+                    obj.compile(label_mask)
+                    if isinstance(obj, (Condition, NegativeCondition)):
+                        compile_content(obj.content)
+
+        for node in nodes:
+            node.name_bits = tuple([label_bits[label.long_name]
+                                    for label in node.name])
+            node.name_mask = 0
+            for bit in node.name_bits:
+                node.name_mask |= bit
+            node.labels_mask = 0
+            for label in node.labels:
+                node.labels_mask |= label_bits.get(label.long_name, 0)
+            compile_content(node.content)
+        self._label_bits = label_bits
+        self._compiled = True
+
+    def _file_reader(self, filename):
+        """
+        Return a FileReader for filename and remember its content hash.
+        """
+        reader = FileReader(filename)
+        self._sources.append((os.path.abspath(filename), reader.digest))
+        return reader
+
+    def _get_cache_key(self, filename):
+        """
+        Compute the cache key of the tree produced by parsing filename.
+
+        The key covers the tree parsed so far, the file itself and the
+        parser options which change the shape of the tree.  Included files,
+        of this file and of the files parsed before, are validated
+        separately when the cache entry is loaded.
+        """
+        key = hashlib.sha1()
+        for part in (str(_cache_version), self._cache_key,
+                     os.path.abspath(filename), _file_digest(filename),
+                     repr(self.defaults),
+                     repr([str(x) for x in self.expand_defaults])):
+            key.update(part)
+            key.update("\0")
+        return key.hexdigest()
+
+    def _load_cache(self, key):
+        """
+        Load a cached parse tree.
+
+        :param key: Cache key returned by _get_cache_key().
+        :return: The cached root node, or None if there is no valid entry.
+        """
+        path = os.path.join(self.cache_dir, "%s.pickle" % key)
+        try:
+            cache_file = open(path, "rb")
+            try:
+                version, sources, node = pickle.load(cache_file)
+            finally:
+                cache_file.close()
+        except Exception:
+            return None
+        if version != _cache_version:
+            return None
+        for filename, digest in sources:
+            try:
+                if _file_digest(filename) != digest:
+                    self._debug("Parse cache of %s is stale", filename)
+                    return None
+            except (IOError, OSError):
+                return None
+        self._sources = sources
+        return node
+
+    def _save_cache(self, key):
+        """
+        Store the current parse tree in the cache.
+
+        :param key: Cache key returned by _get_cache_key().
+        """
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            fd, tmp_path = tempfile.mkstemp(prefix=".%s" % key,
+                                            dir=self.cache_dir)
+        except Exception, details:
+            self._warn("Could not write parse cache to %s: %s",
+                       self.cache_dir, details)
+            return
+        try:
+            cache_file = os.fdopen(fd, "wb")
+            try:
+                pickle.dump((_cache_version, self._sources, self.node),
+                            cache_file, pickle.HIGHEST_PROTOCOL)
+            finally:
+                cache_file.close()
+            # Rename is atomic, concurrent runs never see partial entries.
+            os.rename(tmp_path,
+                      os.path.join(self.cache_dir, "%s.pickle" % key))
+        except Exception, details:
+            self._warn("Could not write parse cache to %s: %s",
+                       self.cache_dir, details)
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
 
     def only_filter(self, variant):
         """
@@ -1405,6 +2085,7 @@ class Parser(object):
         allowed = block_allowed
         var_indent = 0
         var_name = ""
+        var_location = ""
         # meta contains variants meta-data
         meta = {}
         # pre_dict contains block of operation without collision with
@@ -1503,6 +2184,10 @@ class Parser(object):
                     if var_name not in self.expand_defaults:
                         meta_in_expand_defautls = True
                     node4 = Node()
+                    location = var_location
+                    if var_name:
+                        location += " " + var_name
+                    node4.location = location
                     while True:
                         lexer.set_prev_indent(var_indent)
                         # Get token from lexer and check syntax.
@@ -1571,6 +2256,7 @@ class Parser(object):
                         # Update mapping name to file
 
                         node3.dep = deps
+                        node3.location = location
 
                         if meta_with_default:
                             for wd in meta["default"]:
@@ -1627,6 +2313,7 @@ class Parser(object):
                                           "conditional block", lexer.line,
                                           lexer.reader.filename, lexer.linenum)
 
+                    var_location = "%s:%s" % (lexer.filename, lexer.linenum)
                     lexer.set_strict()
                     tokens = lexer.get_until_no_white([LLBracket, LColon,
                                                        LIdentifier, LEndL])
@@ -1711,8 +2398,12 @@ class Parser(object):
                         raise MissingIncludeError(lexer.line, lexer.filename,
                                                   lexer.linenum)
                     pre_dict = apply_predict(lexer, node, pre_dict)
-                    lch = Lexer(FileReader(filename))
+                    lch = Lexer(self._file_reader(filename))
+                    if self.profile:
+                        self.profile.start_file(filename)
                     node = self._parse(lch, node, -1)
+                    if self.profile:
+                        self.profile.stop_file()
                     lexer.set_prev_indent(prev_indent)
 
                 elif typet == LDel:
@@ -1750,13 +2441,213 @@ class Parser(object):
                                          lexer.line))
             raise
 
-    def get_dicts(self, node=None, ctx=[], content=[], shortname=[], dep=[]):
+    def get_dicts(self, node=None, ctx=[], content=[], shortname=[], dep=[],
+                  shard=None, shards=None, costs=None, layered=False,
+                  processes=None):
         """
         Generate dictionaries from the code parsed so far.  This should
         be called after parsing something.
 
+        The dictionaries can be split into shards (e.g. one per test host).
+        Leaves are handed out while walking the tree, so dictionaries which
+        belong to other shards are never built.  The split only depends on
+        the parsed config (and costs), so every host computes the same one.
+
+        :param shard: Index of the shard to generate (0 <= shard < shards),
+                or None to generate all dictionaries.
+        :param shards: Number of shards.
+        :param costs: Optional dict mapping dict names or shortnames to a
+                cost hint, e.g. historical runtime.  If given, shards are
+                balanced by total cost rather than by number of dicts.
+        :param layered: If True, generate LayeredDicts which share the keys
+                they have in common, to save memory when many dicts are
+                kept around.
+        :param processes: If more than 1, the subtrees of the parsed tree
+                are generated by that many worker processes (see
+                _get_dicts_parallel()).  Ignored for shards, for walks of
+                other nodes and when profiling.
         :return: A dict generator.
         """
+        if (processes and processes > 1 and node is None and not ctx and
+                not content and not shortname and not dep and shard is None
+                and not self.profile):
+            return self._get_dicts_parallel(processes, layered)
+        walk = _WalkState(layered=layered)
+        if shard is not None:
+            walk.select = self._get_shard_selector(node, ctx, content,
+                                                   shortname, dep, shard,
+                                                   shards, costs)
+        ctx_bits, ctx_mask = self._compile_ctx(node, ctx, content)
+        if node is None:
+            # Only walks from the root record per-subtree leaf counts.
+            return self._get_dicts(self.node, ctx, content, shortname, dep,
+                                   walk, (), ctx_bits, ctx_mask)
+        return self._get_dicts(node, ctx, content, shortname, dep, walk,
+                               None, ctx_bits, ctx_mask)
+
+    def _compile_ctx(self, node, ctx, content):
+        """
+        Compile the tree along with an external node, context and content.
+
+        :return: Tuple (bits, mask) of the context.
+        """
+        if node is None and not ctx and not content:
+            self._compile()
+            return (), 0
+        extra = Node()
+        extra.name = list(ctx)
+        extra.content = list(content)
+        if node is not None:
+            extra.children = [node]
+        self._compile(extra)
+        return extra.name_bits, extra.name_mask
+
+    def _split_tree(self, n_subtrees):
+        """
+        Split the tree into at least n_subtrees subtrees, if possible.
+
+        Nodes are split into their children level by level.  Nodes from
+        which only the default variant is used aren't split, because whether
+        their children generate dicts depends on their siblings.
+
+        :return: List of paths of child indexes leading to the subtrees, in
+                the order in which get_dicts() walks them.
+        """
+        subtrees = [((), self.node)]
+        changed = True
+        while changed and len(subtrees) < n_subtrees:
+            changed = False
+            split = []
+            for path, node in subtrees:
+                only_default = (self.defaults and
+                                node.var_name not in self.expand_defaults and
+                                [n for n in node.children if n.default])
+                if not node.children or only_default:
+                    split.append((path, node))
+                else:
+                    split.extend([(path + (i,), child)
+                                  for i, child in enumerate(node.children)])
+                    changed = True
+            subtrees = split
+        return [path for path, _ in subtrees]
+
+    def _get_dicts_parallel(self, processes, layered=False):
+        """
+        Generate dictionaries of subtrees in a pool of worker processes.
+
+        The tree is split into several subtrees per process.  Dictionaries
+        are yielded in the same order as get_dicts() yields them: those of a
+        subtree as soon as it and all subtrees before it are done.
+
+        :param processes: Number of worker processes.
+        :param layered: See get_dicts().
+        """
+        global _pool_parser
+        self._compile()
+        subtrees = self._split_tree(processes * 4)
+        _pool_parser = self
+        pool = multiprocessing.Pool(processes)
+        _pool_parser = None
+        try:
+            for dicts in pool.imap(_get_subtree_dicts,
+                                   [(path, layered) for path in subtrees]):
+                for d in dicts:
+                    yield d
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def count_dicts(self):
+        """
+        Count the dictionaries get_dicts() would generate, without building
+        them.
+
+        As a side effect the number of dictionaries produced by every subtree
+        is remembered, which lets get_dict() skip whole subtrees.
+
+        :return: Number of dictionaries.
+        """
+        self._compile()
+        walk = _WalkState(build=False)
+        for _ in self._get_dicts(self.node, [], [], [], [], walk, ()):
+            pass
+        return walk.leaves
+
+    def get_dict(self, index):
+        """
+        Return the index-th dictionary generated by get_dicts().
+
+        Subtrees whose leaf count is known (see count_dicts()) and which lie
+        entirely before index are skipped instead of being walked.
+
+        :param index: Position of the dictionary, negative values count from
+                the end.
+        :return: The dictionary.
+        :raise IndexError: If there is no such dictionary.
+        """
+        if index < 0 or () not in self._leaf_counts:
+            n_dicts = self.count_dicts()
+            if index < 0:
+                index += n_dicts
+            if not 0 <= index < n_dicts:
+                raise IndexError("dict index out of range")
+        self._compile()
+        walk = _WalkState(skip=index)
+        for d in self._get_dicts(self.node, [], [], [], [], walk, ()):
+            return d
+        raise IndexError("dict index out of range")
+
+    def _get_shard_selector(self, node, ctx, content, shortname, dep,
+                            shard, shards, costs):
+        """
+        Return a function telling, leaf by leaf, whether a leaf is in shard.
+
+        Without costs the leaves are dealt round-robin.  With costs, the
+        names of all leaves are collected first (without building dicts) and
+        distributed greedily, most expensive first, to the least loaded
+        shard.
+        """
+        if not shards or shards < 1 or not 0 <= shard < shards:
+            raise ValueError("Invalid shard %s/%s" % (shard, shards))
+        leaf_index = itertools.count()
+        if not costs:
+            return lambda name, short: leaf_index.next() % shards == shard
+
+        ctx_bits, ctx_mask = self._compile_ctx(node, ctx, content)
+        walk = _WalkState(build=False)
+        leaves = list(self._get_dicts(node or self.node, ctx, content,
+                                      shortname, dep, walk, None,
+                                      ctx_bits, ctx_mask))
+        known = [costs[n] for names in leaves for n in names if n in costs]
+        default_cost = 1.0
+        if known:
+            default_cost = float(sum(known)) / len(known)
+        weighted = []
+        for i, (name, short) in enumerate(leaves):
+            cost = costs.get(name, costs.get(short, default_cost))
+            weighted.append((cost, i))
+        weighted.sort(key=lambda x: (-x[0], x[1]))
+        loads = [(0.0, k) for k in range(shards)]
+        selected = set()
+        for cost, i in weighted:
+            load, k = heapq.heappop(loads)
+            if k == shard:
+                selected.add(i)
+            heapq.heappush(loads, (load + cost, k))
+        return lambda name, short: leaf_index.next() in selected
+
+    def _get_dicts(self, node, ctx, content, shortname, dep, walk,
+                   path=None, ctx_bits=(), ctx_mask=0):
+        """
+        Recursive worker of get_dicts(), count_dicts() and get_dict().
+
+        :param walk: _WalkState shared by all levels of this walk.
+        :param path: Tuple of child indexes leading from the root to node,
+                or None if leaf counts shouldn't be recorded or used.
+        :param ctx_bits: Bits of the labels in ctx (see _compile()).
+        :param ctx_mask: OR of ctx_bits.
+        """
         def process_content(content, failed_filters):
             # 1. Check that the filters in content are OK with the current
             #    context (ctx).
@@ -1776,7 +2667,7 @@ class Parser(object):
                     new_content.append(t)
                     continue
                 # obj is an OnlyFilter/NoFilter/Condition/NegativeCondition
-                if obj.requires_action(ctx, ctx_set, labels):
+                if obj.requires_action(ctx_bits, ctx_mask, labels):
                     # This filter requires action now
                     if type(obj) is OnlyFilter or type(obj) is NoFilter:
                         if obj not in blocked_filters:
@@ -1799,7 +2690,7 @@ class Parser(object):
                             failed_filters.append(t)
                             return False
                         continue
-                elif obj.is_irrelevant(ctx, ctx_set, labels):
+                elif obj.is_irrelevant(ctx_bits, ctx_mask, labels):
                     # This filter is no longer relevant and can be removed
                     continue
                 else:
@@ -1808,7 +2699,7 @@ class Parser(object):
             return True
 
         def might_pass(failed_ctx,
-                       failed_ctx_set,
+                       failed_ctx_mask,
                        failed_external_filters,
                        failed_internal_filters):
             all_content = content + node.content
@@ -1818,8 +2709,8 @@ class Parser(object):
             for t in failed_external_filters:
                 _, _, external_filter = t
                 if not external_filter.might_pass(failed_ctx,
-                                                  failed_ctx_set,
-                                                  ctx, ctx_set,
+                                                  failed_ctx_mask,
+                                                  ctx_bits, ctx_mask,
                                                   labels):
                     return False
             for t in failed_internal_filters:
@@ -1829,30 +2720,35 @@ class Parser(object):
             for t in failed_internal_filters:
                 _, _, internal_filter = t
                 if not internal_filter.might_pass(failed_ctx,
-                                                  failed_ctx_set,
-                                                  ctx, ctx_set,
+                                                  failed_ctx_mask,
+                                                  ctx_bits, ctx_mask,
                                                   labels):
                     return False
             return True
 
         def add_failed_case():
-            node.failed_cases.appendleft((ctx, ctx_set,
+            node.failed_cases.appendleft((ctx_bits, ctx_mask,
                                           new_external_filters,
                                           new_internal_filters))
             if len(node.failed_cases) > num_failed_cases:
                 node.failed_cases.pop()
+                if profile:
+                    profile.cache_evictions += 1
 
-        node = node or self.node
         # if self.debug:    #Print dict on which is working now.
         #    node.dump(0)
+        profile = self.profile
+        if profile:
+            start = time.time()
         # Update dep
         for d in node.dep:
             for dd in d:
                 dep = dep + [".".join([str(label) for label in ctx + dd])]
         # Update ctx
         ctx = ctx + node.name
-        ctx_set = set(ctx)
-        labels = node.labels
+        ctx_bits = ctx_bits + node.name_bits
+        ctx_mask |= node.name_mask
+        labels = node.labels_mask
         # Get the current name
         name = ".".join([str(label) for label in ctx])
 
@@ -1869,7 +2765,13 @@ class Parser(object):
                             name, content + node.content, failed_case)
                 del node.failed_cases[i]
                 node.failed_cases.appendleft(failed_case)
+                if profile:
+                    profile.cache_hits += 1
+                    profile.add_node(node.location, time.time() - start,
+                                     True)
                 return
+        if profile and node.failed_cases:
+            profile.cache_misses += 1
         # Check content and unpack it into new_content
         new_content = []
         new_external_filters = []
@@ -1878,7 +2780,11 @@ class Parser(object):
                 not process_content(content, new_external_filters)):
             add_failed_case()
             self._debug("Failed_cases %s", node.failed_cases)
+            if profile:
+                profile.add_node(node.location, time.time() - start, True)
             return
+        if profile:
+            profile.add_node(node.location, time.time() - start, False)
 
         # Update shortname
         if node.append_to_shortname:
@@ -1886,29 +2792,58 @@ class Parser(object):
 
         # Recurse into children
         count = 0
-        if self.defaults and node.var_name not in self.expand_defaults:
-            for n in node.children:
-                for d in self.get_dicts(n, ctx, new_content, shortname, dep):
-                    count += 1
-                    yield d
-                if n.default and count:
-                    break
-        else:
-            for n in node.children:
-                for d in self.get_dicts(n, ctx, new_content, shortname, dep):
-                    count += 1
-                    yield d
+        only_default = (self.defaults and
+                        node.var_name not in self.expand_defaults)
+        child_path = None
+        target = None
+        if walk.target is not None and path is not None:
+            if len(path) < len(walk.target):
+                target = walk.target[len(path)]
+        for i, n in enumerate(node.children):
+            if target is not None and i != target:
+                continue
+            if path is not None:
+                child_path = path + (i,)
+                n_leaves = self._leaf_counts.get(child_path)
+                if walk.skip and n_leaves and n_leaves <= walk.skip:
+                    # The whole subtree lies before the wanted dict.
+                    walk.skip -= n_leaves
+                    walk.leaves += n_leaves
+                    count += n_leaves
+                    if only_default and n.default:
+                        break
+                    continue
+            leaves = walk.leaves
+            for d in self._get_dicts(n, ctx, new_content, shortname, dep,
+                                     walk, child_path, ctx_bits, ctx_mask):
+                yield d
+            count += walk.leaves - leaves
+            if only_default and n.default and count:
+                break
         # Reached leaf?
         if not node.children:
-            self._debug("    reached leaf, returning it")
-            d = {"name": name, "dep": dep,
-                 "shortname": ".".join([str(sn.name) for sn in shortname])}
-            for _, _, op in new_content:
-                op.apply_to_dict(d)
-            yield d
+            count = 1
+            walk.leaves += 1
+            short = ".".join([str(sn.name) for sn in shortname])
+            if walk.skip:
+                walk.skip -= 1
+            elif not walk.build:
+                yield name, short
+            elif walk.select is None or walk.select(name, short):
+                self._debug("    reached leaf, returning it")
+                if profile:
+                    start = time.time()
+                d = {"name": name, "dep": dep, "shortname": short}
+                for _, _, op in new_content:
+                    op.apply_to_dict(d)
+                if walk.layered:
+                    d = walk.share(d)
+                if profile:
+                    profile.add_dict(node.location, time.time() - start)
+                yield d
         # If this node did not produce any dicts, remember the failed filters
-        # of its descendants
-        elif not count:
+        # of its descendants (unless some weren't walked)
+        elif not count and target is None:
             new_external_filters = []
             new_internal_filters = []
             for n in node.children:
@@ -1926,6 +2861,45 @@ class Parser(object):
                         if obj not in new_internal_filters:
                             new_internal_filters.append(obj)
             add_failed_case()
+        if path is not None and target is None:
+            self._leaf_counts[path] = count
+
+
+def parse_shard(value):
+    """
+    Parse a shard specification.
+
+    :param value: String "i/n", where 0 <= i < n.
+    :return: Tuple (i, n).
+    :raise ValueError: If value is not a valid shard specification.
+    """
+    try:
+        shard, shards = [int(x) for x in value.split("/")]
+    except ValueError:
+        raise ValueError("Invalid shard %r, expected i/n" % value)
+    if shards < 1 or not 0 <= shard < shards:
+        raise ValueError("Invalid shard %r, expected 0 <= i < n" % value)
+    return shard, shards
+
+
+def read_costs(filename):
+    """
+    Read cost hints for get_dicts(costs=...).
+
+    The file contains one "<dict name or shortname> <cost>" pair per line,
+    empty lines and lines starting with # are ignored.
+
+    :param filename: Path of the file.
+    :return: Dict mapping names to costs.
+    """
+    costs = {}
+    for line in open(filename):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, cost = line.rsplit(None, 1)
+        costs[name] = float(cost)
+    return costs
 
 
 def print_dicts_default(options, dicts):
@@ -1951,8 +2925,35 @@ def print_dicts_repr(options, dicts):
     print "]"
 
 
+def print_dicts_jsonl(options, dicts):
+    """
+    Print dictionaries as JSON lines, one compact object per dict.
+
+    Each dict is written as soon as it is generated, so the output of huge
+    matrices can be streamed into other tools without holding it in memory.
+    A reader closing the pipe early (e.g. ``| head``) ends the output quietly.
+    """
+    encode = json.JSONEncoder(separators=(",", ":")).encode
+    write = sys.stdout.write
+    keys = None
+    if options.keys:
+        keys = [key.strip() for key in options.keys.split(",") if key.strip()]
+    try:
+        for d in dicts:
+            if keys is not None:
+                d = dict((key, d[key]) for key in keys if key in d)
+            write(encode(d))
+            write("\n")
+        sys.stdout.flush()
+    except IOError, details:
+        if details.errno != errno.EPIPE:
+            raise
+
+
 def print_dicts(options, dicts):
-    if options.repr_mode:
+    if options.jsonl:
+        print_dicts_jsonl(options, dicts)
+    elif options.repr_mode:
         print_dicts_repr(options, dicts)
     else:
         print_dicts_default(options, dicts)
@@ -1970,16 +2971,38 @@ if __name__ == "__main__":
                       help="show dict contents")
     parser.add_option("-r", "--repr", dest="repr_mode", action="store_true",
                       help="output parsing results Python format")
+    parser.add_option("--jsonl", dest="jsonl", action="store_true",
+                      help="stream the dicts as JSON lines, one object per"
+                           " line")
+    parser.add_option("-k", "--keys", dest="keys", type="string",
+                      help="with --jsonl, output only these keys of each"
+                           " dict, \"key, key, key\"")
     parser.add_option("-d", "--defaults", dest="defaults", action="store_true",
                       help="use only default variant of variants if there"
                            " is some")
     parser.add_option("-e", "--expand", dest="expand", type="string",
                       help="list of vartiant which should be expanded when"
                            " defaults is enabled.  \"name, name, name\"")
+    parser.add_option("-s", "--shard", dest="shard", type="string",
+                      help="generate only shard i (counting from 0) of n"
+                           " shards, \"i/n\"")
+    parser.add_option("--shard-costs", dest="shard_costs", type="string",
+                      help="file with \"name cost\" lines used to balance"
+                           " the shards")
+    parser.add_option("--cache-dir", dest="cache_dir", type="string",
+                      help="directory in which parse trees of unchanged"
+                           " config files are cached")
+    parser.add_option("-j", "--processes", dest="processes", type="int",
+                      help="generate dicts of subtrees in that many worker"
+                           " processes")
+    parser.add_option("--profile", dest="profile", action="store_true",
+                      help="print parse and walk statistics to stderr")
 
     options, args = parser.parse_args()
     if not args:
         parser.error("filename required")
+    if options.keys and not options.jsonl:
+        parser.error("--keys requires --jsonl")
 
     if options.debug:
         logging.basicConfig(level=logging.DEBUG)
@@ -1988,12 +3011,25 @@ if __name__ == "__main__":
     if options.expand:
         expand = [x.strip() for x in options.expand.split(",")]
     c = Parser(args[0], defaults=options.defaults, expand_defaults=expand,
-               debug=options.debug)
+               debug=options.debug, cache_dir=options.cache_dir,
+               profile=options.profile)
     for s in args[1:]:
         c.parse_string(s)
 
     if options.debug:
         c.node.dump(0, True)
 
-    dicts = c.get_dicts()
+    if options.shard:
+        try:
+            shard, shards = parse_shard(options.shard)
+        except ValueError, details:
+            parser.error(str(details))
+        costs = None
+        if options.shard_costs:
+            costs = read_costs(options.shard_costs)
+        dicts = c.get_dicts(shard=shard, shards=shards, costs=costs)
+    else:
+        dicts = c.get_dicts(processes=options.processes)
     print_dicts(options, dicts)
+    if options.profile:
+        sys.stderr.write(c.profile.report())
@@ -2,7 +2,12 @@
 
 import unittest
 import os
+import sys
 import gzip
+import json
+import shutil
+import subprocess
+import tempfile
 
 import common
 import cartesian_config
@@ -744,6 +749,288 @@ class CartesianConfigTest(unittest.TestCase):
                              cartesian_config.Label("aaa")]]],
                           "Failed to parse filter.")
 
+    def testSubstitution(self):
+        self._checkStringConfig("""
+            image = f20
+            arch = x86_64
+            path = images/${image}-${arch}.qcow2
+            partial = ${image}/${missing}/${arch}
+            expr = ${ image.upper() }$arch
+            """,
+                                [
+                                    {'arch': 'x86_64',
+                                     'dep': [],
+                                     'expr': 'F20$arch',
+                                     'image': 'f20',
+                                     'name': '',
+                                     'partial': 'f20/${missing}/${arch}',
+                                     'path': 'images/f20-x86_64.qcow2',
+                                     'shortname': ''},
+                                ])
+
+    def testLexer(self):
+        def tokens(line, fast):
+            lexer = cartesian_config.Lexer(cartesian_config.StrReader(""))
+            if fast:
+                lexer.set_fast()
+            return [(type(t).__name__, str(t))
+                    for t in lexer.match(line, 0)]
+
+        self.assertEquals(tokens("a.b, (x=y)..c: d", False),
+                          [("LIdentifier", "a"), ("LDot", "."),
+                           ("LIdentifier", "b"), ("LComa", ","),
+                           ("LWhite", ""), ("LLRBracket", "("),
+                           ("LIdentifier", "x"), ("LSet", "="),
+                           ("LIdentifier", "y"), ("LRRBracket", ")"),
+                           ("LDot", "."), ("LDot", "."),
+                           ("LIdentifier", "c"), ("LColon", ":"),
+                           ("LWhite", ""), ("LIdentifier", "d"),
+                           ("LEndL", "endl")])
+        for fast in (False, True):
+            self.assertEquals(tokens("variants name [default=a-b]: # c",
+                                     fast),
+                              [("LVariants", "variants"), ("LWhite", ""),
+                               ("LIdentifier", "name"), ("LWhite", ""),
+                               ("LLBracket", "["),
+                               ("LIdentifier", "default"),
+                               ("LSet", "="), ("LIdentifier", "a-b"),
+                               ("LRBracket", "]"), ("LColon", ":"),
+                               ("LWhite", ""), ("LEndL", "endl")])
+        for op, token in (("=", "LSet"), ("+=", "LAppend"),
+                          ("<=", "LPrepend"), ("?=", "LRegExpSet"),
+                          ("?+=", "LRegExpAppend"),
+                          ("?<=", "LRegExpPrepend")):
+            line = "s.* %s a = b: c" % op
+            self.assertEquals(tokens(line, True),
+                              [("LIdentifier", "s.*"), (token, op),
+                               ("LString", "a = b: c"),
+                               ("LEndL", "endl")])
+            line = "var%sx" % op
+            self.assertEquals(tokens(line, False),
+                              [("LIdentifier", "var"), (token, op),
+                               ("LIdentifier", "x"), ("LEndL", "endl")])
+        try:
+            tokens("variants tests [defa$ult=system1]:", False)
+        except cartesian_config.LexerError, e:
+            self.assertTrue("Unexpected character $ on pos 20" in str(e))
+        else:
+            self.fail("LexerError not raised")
+
+    def testCountAndGetDict(self):
+        config = """
+            variants:
+                - a:
+                    variants:
+                        - x:
+                        - y:
+                - b:
+                    variants:
+                        - @x:
+                        - y:
+                        - z:
+            variants:
+                - 1:
+                - 2:
+            no a..y..2
+            """
+        for defaults in (False, True):
+            p = cartesian_config.Parser(defaults=defaults)
+            p.parse_string(config)
+            reference = list(p.get_dicts())
+            self.assertEquals(p.count_dicts(), len(reference))
+            for i in reversed(range(len(reference))):
+                self.assertEquals(p.get_dict(i), reference[i])
+            self.assertEquals(p.get_dict(-1), reference[-1])
+            self.assertRaises(IndexError, p.get_dict, len(reference))
+            self.assertEquals(list(p.get_dicts()), reference)
+
+    def testShards(self):
+        p = cartesian_config.Parser()
+        p.parse_string("""
+            variants:
+                - a:
+                - b:
+                - c:
+            variants:
+                - 1:
+                - 2:
+                - 3:
+            no c..3
+            """)
+        names = [d["name"] for d in p.get_dicts()]
+        shards = [[d["name"] for d in p.get_dicts(shard=i, shards=3)]
+                  for i in range(3)]
+        self.assertEquals([len(s) for s in shards], [3, 3, 2])
+        self.assertEquals(sorted(sum(shards, [])), sorted(names))
+
+        costs = dict((name, 1) for name in names)
+        costs["1.a"] = 20
+        shards = [[d["name"] for d in p.get_dicts(shard=i, shards=2,
+                                                  costs=costs)]
+                  for i in range(2)]
+        self.assertEquals(shards[0], ["1.a"])
+        self.assertEquals(sorted(sum(shards, [])), sorted(names))
+
+        self.assertRaises(ValueError, cartesian_config.parse_shard, "2/2")
+        self.assertEquals(cartesian_config.parse_shard("1/2"), (1, 2))
+
+    def testParallel(self):
+        config = """
+            variants:
+                - a:
+                - b:
+                    only 1
+                - c:
+            variants:
+                - @1:
+                - 2:
+                    no c
+                - 3:
+            variants:
+                - x:
+                - y:
+            """
+        for defaults in (False, True):
+            p = cartesian_config.Parser(defaults=defaults)
+            p.parse_string(config)
+            reference = list(p.get_dicts())
+            self.assertTrue(len(p._split_tree(4)) > 1)
+            self.assertEquals(list(p.get_dicts(processes=2)), reference)
+
+    def testProfile(self):
+        p = cartesian_config.Parser(profile=True)
+        p.parse_string("""
+            variants:
+                - a:
+                - b:
+            variants:
+                - 1:
+                - 2:
+                    no a
+            """)
+        self.assertEquals(len(list(p.get_dicts())), 3)
+        profile = p.profile
+        self.assertEquals(profile.dicts, 3)
+        self.assertTrue(profile.pruned >= 1)
+        self.assertEquals(profile.files["<string>"][2], 1)
+        self.assertTrue("<string>:2" in profile.blocks)
+        self.assertTrue("Nodes visited" in profile.report())
+
+    def testLayeredDicts(self):
+        p = cartesian_config.Parser()
+        p.parse_string("""
+            a = 1
+            b = 2
+            c = 3
+            d = 4
+            e = 5
+            f = 6
+            g = 7
+            h = 8
+            i = 9
+            j = 10
+            variants:
+                - x:
+                    a = x
+                - y:
+                    del d
+            variants:
+                - 1:
+                - 2:
+                    b = ${a}2
+            """)
+        flat = list(p.get_dicts())
+        layered = list(p.get_dicts(layered=True))
+        self.assertEquals(layered, flat)
+        self.assertEquals([sorted(d.items()) for d in layered],
+                          [sorted(d.items()) for d in flat])
+        self.assertTrue(layered[1].base is layered[0].base)
+        self.assertFalse("d" in layered[1])
+        self.assertRaises(KeyError, lambda: layered[1]["d"])
+        self.assertEquals(layered[2]["b"], "x2")
+
+        # Changes don't leak into dicts sharing the same base.
+        layered[0]["c"] = "changed"
+        del layered[0]["b"]
+        self.assertEquals(layered[1]["c"], "3")
+        self.assertEquals(layered[1]["b"], "2")
+        self.assertEquals(len(layered[0]), len(flat[0]) - 1)
+        self.assertEquals(dict(layered[0]), layered[0].copy())
+
+    def testParseCache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache_dir = os.path.join(tmpdir, "cache")
+            main_cfg = os.path.join(tmpdir, "main.cfg")
+            inc_cfg = os.path.join(tmpdir, "inc.cfg")
+            open(main_cfg, "w").write("include inc.cfg\n"
+                                      "variants:\n"
+                                      "    - a:\n"
+                                      "    - b:\n")
+            open(inc_cfg, "w").write("x = 1\n")
+
+            p = cartesian_config.Parser(main_cfg, cache_dir=cache_dir)
+            reference = list(p.get_dicts())
+            self.assertEquals(len(os.listdir(cache_dir)), 1)
+
+            p = cartesian_config.Parser(main_cfg, cache_dir=cache_dir)
+            self.assertEquals(list(p.get_dicts()), reference)
+            p.parse_string("only b")
+            self.assertEquals([d["name"] for d in p.get_dicts()], ["b"])
+
+            # Profiling parses the file even if it's cached
+            p = cartesian_config.Parser(main_cfg, cache_dir=cache_dir,
+                                        profile=True)
+            self.assertEquals(list(p.get_dicts()), reference)
+            self.assertTrue(main_cfg in p.profile.files)
+            self.assertTrue(inc_cfg in p.profile.files)
+
+            # Changing an included file invalidates the cached tree
+            open(inc_cfg, "w").write("x = 2\n")
+            p = cartesian_config.Parser(main_cfg, cache_dir=cache_dir)
+            self.assertEquals([d["x"] for d in p.get_dicts()], ["2", "2"])
+
+            # A file parsed after another depends on its includes too
+            second_cfg = os.path.join(tmpdir, "second.cfg")
+            open(second_cfg, "w").write("y = 1\n")
+            p = cartesian_config.Parser(main_cfg, cache_dir=cache_dir)
+            p.parse_file(second_cfg)
+            self.assertEquals([d["x"] for d in p.get_dicts()], ["2", "2"])
+            open(inc_cfg, "w").write("x = 3\n")
+            p = cartesian_config.Parser(main_cfg, cache_dir=cache_dir)
+            p.parse_file(second_cfg)
+            self.assertEquals([d["x"] for d in p.get_dicts()], ["3", "3"])
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def testJsonLines(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cfg = os.path.join(tmpdir, "test.cfg")
+            open(cfg, "w").write("x = 1\n"
+                                 "y = \"quoted\"\n"
+                                 "variants:\n"
+                                 "    - a:\n"
+                                 "        x = 2\n"
+                                 "    - b:\n")
+            script = os.path.join(mydir, "cartesian_config.py")
+            for args, keys in ((["--jsonl"], None),
+                               (["--jsonl", "-k", "name, x,missing"],
+                                ["name", "x"])):
+                cmd = [sys.executable, script, cfg] + args
+                process = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+                output = process.communicate()[0]
+                self.assertEquals(process.returncode, 0)
+                lines = output.splitlines()
+                self.assertEquals(len(lines), 2)
+                expected = list(cartesian_config.Parser(cfg).get_dicts())
+                for line, d in zip(lines, expected):
+                    if keys is not None:
+                        d = dict((key, d[key]) for key in keys)
+                    self.assertEquals(json.loads(line), d)
+        finally:
+            shutil.rmtree(tmpdir)
+
     def testHugeTest1(self):
         self._checkConfigDump('testcfg.huge/test1.cfg',
                               'testcfg.huge/test1.cfg.repr.gz')
@@ -19,6 +19,7 @@ TEST_PROVIDERS_DIR = os.path.join(ROOT_DIR, 'test-providers.d')
 TEST_PROVIDERS_DOWNLOAD_DIR = os.path.join(ROOT_DIR, 'test-providers.d',
                                            'downloads')
 TMP_DIR = os.path.join(ROOT_DIR, 'tmp')
+CACHE_DIR = os.path.join(ROOT_DIR, 'cache')
 BACKING_DATA_DIR = None
 
 
@@ -211,6 +212,20 @@ def get_tmp_dir():
     return TMP_DIR
 
 
+def get_cache_dir(subdir=None):
+    """
+    Return the cache dir, which (unlike the tmp dir) survives between jobs.
+
+    :param subdir: Optional name of a subdirectory of the cache dir.
+    """
+    cache_dir = CACHE_DIR
+    if subdir is not None:
+        cache_dir = os.path.join(cache_dir, subdir)
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    return cache_dir
+
+
 def get_download_dir():
     return DOWNLOAD_DIR
 
@@ -245,6 +260,7 @@ def clean_tmp_files():
 if __name__ == '__main__':
     print "root dir:         " + ROOT_DIR
     print "tmp dir:          " + TMP_DIR
+    print "cache dir:        " + CACHE_DIR
     print "data dir:         " + DATA_DIR
     print "deps dir:         " + DEPS_DIR
     print "backing data dir: " + BACKING_DATA_DIR
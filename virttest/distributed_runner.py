@@ -0,0 +1,410 @@
+"""
+Run the tests of a job on several hosts.
+
+A coordinator holds the tests of the job and hands them, one at a time,
+to the workers connected to it over TCP. Workers run the tests, stream
+their logs back while they run and report their status when done. A test
+whose worker dies (or stops answering) goes back to the queue.
+
+Messages are JSON objects, one per line:
+
+* worker: {"msg": "hello", "name": <worker name>}
+* coordinator: {"msg": "run", "index": <test index>, "params": <test dict>,
+  "first": <first test of the worker>, "last": <last test of the worker>}
+* worker: {"msg": "log", "index": <test index>, "data": <log text>}
+* worker: {"msg": "alive"}
+* worker: {"msg": "done", "index": <test index>, "status": <status>,
+  "elapsed": <seconds>, "timings": <seconds per phase>}
+* coordinator: {"msg": "exit"}
+"""
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+
+import job_journal
+
+
+def get_prereqs(tests):
+    """
+    Find the tests each test of a job has to wait for.
+
+    A test depends on the earlier tests whose names contain one of its dep
+    params.
+
+    :param tests: List of (index, test dict) of the tests, in order.
+    :return: Dict mapping the index of every test to the sorted list of
+            the indexes of the tests it depends on.
+    """
+    dep_tests = {}
+    for _, dct in tests:
+        for dep in dct.get("dep", []):
+            if dep not in dep_tests:
+                dep_tests[dep] = [j for j, other in tests
+                                  if dep in other["name"]]
+    prereqs = {}
+    for index, dct in tests:
+        matched = set()
+        for dep in dct.get("dep", []):
+            matched.update(j for j in dep_tests[dep] if j < index)
+        prereqs[index] = sorted(matched)
+    return prereqs
+
+
+def parse_address(address):
+    """
+    Parse a "host:port" string.
+
+    :return: Tuple (host, port).
+    :raise ValueError: If address is not of that form.
+    """
+    host, sep, port = address.rpartition(":")
+    if not sep or not port.isdigit():
+        raise ValueError("Invalid address '%s', expected host:port" %
+                         address)
+    return host, int(port)
+
+
+class _Connection(object):
+
+    """
+    Line based JSON messages over a socket.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.buf = ""
+        self.name = None
+        self.index = None
+        self.last_seen = time.time()
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def send(self, **msg):
+        self.sock.sendall(json.dumps(msg) + "\n")
+
+    def receive(self):
+        """
+        Read what is available on the socket.
+
+        :return: List of the complete messages received.
+        :raise EOFError: If the peer closed the connection.
+        """
+        data = self.sock.recv(65536)
+        if not data:
+            raise EOFError
+        self.last_seen = time.time()
+        self.buf += data
+        lines = self.buf.split("\n")
+        self.buf = lines.pop()
+        return [json.loads(line) for line in lines if line]
+
+    def close(self):
+        self.sock.close()
+
+
+class Coordinator(object):
+
+    """
+    Hand the tests of a job to remote workers, respecting their deps.
+
+    A test is handed out once all the earlier tests its dep params match
+    are done, and skipped (status SKIP) if one of them didn't pass. It goes
+    to the worker that ran the last of them, as long as that worker is
+    still connected, so it finds the VMs and images they prepared.
+
+    Every worker is told which tests are its first and last ones, to set up
+    and clean up its host. A test is a worker's last one when no more tests
+    could go to the worker, or when fewer remain than there are workers;
+    a worker that gets more tests after that starts over with a first one.
+    """
+
+    def __init__(self, tests, address=("", 0), done=None, max_requeue=2,
+                 timeout=300):
+        """
+        :param tests: List of (index, test dict) of the tests to run, in
+                order.
+        :param address: (host, port) to listen on; port 0 picks a free one.
+        :param done: Dict mapping indexes of tests that don't have to run
+                (e.g. from a resumed job) to whether they passed.
+        :param max_requeue: How many times the test of a dead worker is put
+                back in the queue before it counts as an error.
+        :param timeout: Seconds without any message after which a worker
+                running a test counts as dead.
+        """
+        self.tests = dict(tests)
+        self.order = [index for index, _ in tests]
+        self.max_requeue = max_requeue
+        self.timeout = timeout
+        self.status = dict(done or {})
+        self.requeued = {}
+        self.test_worker = {}
+        # Workers that got a first test but no last one yet
+        self.started = set()
+        self.pending = [index for index in self.order
+                        if index not in self.status]
+        self.connections = []
+        self.prereqs = get_prereqs(tests)
+
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind(address)
+        self.server.listen(16)
+        self.address = self.server.getsockname()
+
+    def _skip(self, on_result):
+        """
+        Skip the tests some of whose dependencies didn't pass.
+        """
+        for index in self.pending[:]:
+            prereqs = self.prereqs[index]
+            if [j for j in prereqs if not self.status.get(j, True)]:
+                if not [j for j in prereqs if j not in self.status]:
+                    self._finish(index, "SKIP", on_result)
+
+    def _next_test(self, worker):
+        """
+        Find the next test worker can run.
+
+        :return: Index of the test or None.
+        """
+        workers = [c.name for c in self.connections]
+        for index in self.pending:
+            prereqs = self.prereqs[index]
+            if [j for j in prereqs if j not in self.status]:
+                continue
+            if prereqs:
+                bound = self.test_worker.get(prereqs[-1])
+                if bound in workers and bound != worker:
+                    continue
+            return index
+        return None
+
+    def _is_last(self, worker):
+        """
+        Tell whether the test just handed to worker may be its last one.
+        """
+        workers = [c.name for c in self.connections if c.name is not None]
+        candidates = 0
+        for index in self.pending:
+            prereqs = self.prereqs[index]
+            if prereqs:
+                bound = self.test_worker.get(prereqs[-1])
+                if bound in workers and bound != worker:
+                    continue
+            candidates += 1
+        return candidates < len(workers)
+
+    def _finish(self, index, status, on_result, elapsed=0, timings=None,
+                worker=None):
+        self.status[index] = status in job_journal.PASSED
+        if index in self.pending:
+            self.pending.remove(index)
+        if worker is not None:
+            self.test_worker[index] = worker
+        on_result(index, status, elapsed, timings or {}, worker)
+
+    def _dispatch(self, on_result):
+        for conn in self.connections[:]:
+            if conn.name is None or conn.index is not None:
+                continue
+            index = self._next_test(conn.name)
+            if index is None:
+                continue
+            self.pending.remove(index)
+            conn.index = index
+            conn.last_seen = time.time()
+            first = conn.name not in self.started
+            last = self._is_last(conn.name)
+            if last:
+                self.started.discard(conn.name)
+            else:
+                self.started.add(conn.name)
+            logging.info("Running test %d on worker %s", index, conn.name)
+            try:
+                conn.send(msg="run", index=index, params=self.tests[index],
+                          first=first, last=last)
+            except socket.error:
+                self._drop(conn, on_result)
+
+    def _drop(self, conn, on_result):
+        self.connections.remove(conn)
+        conn.close()
+        self.started.discard(conn.name)
+        index = conn.index
+        if index is None:
+            logging.info("Worker %s disconnected", conn.name)
+            return
+        self.requeued[index] = self.requeued.get(index, 0) + 1
+        if self.requeued[index] > self.max_requeue:
+            logging.error("Worker %s died running test %d, giving up on "
+                          "the test", conn.name, index)
+            self._finish(index, "ERROR", on_result, worker=conn.name)
+        else:
+            logging.warning("Worker %s died running test %d, putting the "
+                            "test back in the queue", conn.name, index)
+            self.pending.append(index)
+            self.pending.sort()
+
+    def run(self, on_result, on_log=None):
+        """
+        Run all the tests on the workers that connect.
+
+        :param on_result: Called with (index, status, elapsed, timings,
+                worker name) of every finished or skipped test.
+        :param on_log: Called with (index, log text) for the log output of
+                the tests.
+        """
+        try:
+            while self.pending or [c for c in self.connections
+                                   if c.index is not None]:
+                self._skip(on_result)
+                self._dispatch(on_result)
+                if not self.pending and not [c for c in self.connections
+                                             if c.index is not None]:
+                    break
+                readable = select.select([self.server] + self.connections,
+                                         [], [], 1)[0]
+                for conn in readable:
+                    if conn is self.server:
+                        sock, address = self.server.accept()
+                        self.connections.append(_Connection(sock))
+                        continue
+                    try:
+                        messages = conn.receive()
+                    except (EOFError, socket.error, ValueError):
+                        self._drop(conn, on_result)
+                        continue
+                    for msg in messages:
+                        self._handle(conn, msg, on_result, on_log)
+                now = time.time()
+                for conn in self.connections[:]:
+                    if (conn.index is not None and
+                            now - conn.last_seen > self.timeout):
+                        self._drop(conn, on_result)
+        finally:
+            for conn in self.connections:
+                try:
+                    conn.send(msg="exit")
+                except socket.error:
+                    pass
+                conn.close()
+            self.connections = []
+            self.server.close()
+
+    def _handle(self, conn, msg, on_result, on_log):
+        if msg["msg"] == "hello":
+            conn.name = str(msg["name"])
+            logging.info("Worker %s connected", conn.name)
+        elif msg["msg"] == "log":
+            if on_log is not None:
+                on_log(msg["index"], msg["data"])
+        elif msg["msg"] == "done":
+            index = msg["index"]
+            conn.index = None
+            self._finish(index, str(msg["status"]), on_result,
+                         msg.get("elapsed", 0), msg.get("timings"),
+                         conn.name)
+
+
+def run_worker(address, run_test, name=None, interval=1.0):
+    """
+    Connect to a coordinator and run the tests it hands out until it's done.
+
+    :param address: (host, port) of the coordinator.
+    :param run_test: Called with (test dict, log callback, first, last) to
+            run a test, first and last telling whether it's the first or
+            last test of the worker (see Coordinator); returns a tuple
+            (status, elapsed, timings). The log callback takes text to
+            stream to the coordinator.
+    :param name: Name of the worker, by default <hostname>:<pid>.
+    :param interval: Seconds between log updates and keepalive messages.
+    """
+    if name is None:
+        name = "%s:%d" % (socket.gethostname(), os.getpid())
+    conn = _Connection(socket.create_connection(address))
+    conn.send(msg="hello", name=name)
+    try:
+        while True:
+            try:
+                messages = conn.receive()
+            except (EOFError, socket.error):
+                # The coordinator is gone
+                return
+            for msg in messages:
+                if msg["msg"] == "exit":
+                    return
+                if msg["msg"] == "run":
+                    _run_worker_test(conn, msg["index"],
+                                     _to_str(msg["params"]),
+                                     msg.get("first", False),
+                                     msg.get("last", False), run_test,
+                                     interval)
+    finally:
+        conn.close()
+
+
+def _to_str(obj):
+    """
+    Turn the unicode strings JSON decoding produces back into str.
+    """
+    if isinstance(obj, unicode):
+        return obj.encode("utf-8")
+    if isinstance(obj, list):
+        return [_to_str(item) for item in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(key), _to_str(value))
+                    for key, value in obj.items())
+    return obj
+
+
+def _run_worker_test(conn, index, params, first, last, run_test, interval):
+    """
+    Run a test in a thread, streaming its log and keeping the connection
+    alive, and report its result.
+    """
+    lock = threading.Lock()
+    log_data = []
+    result = []
+
+    def log(data):
+        lock.acquire()
+        try:
+            log_data.append(data)
+        finally:
+            lock.release()
+
+    def run():
+        try:
+            result.append(run_test(params, log, first, last))
+        except Exception, details:
+            logging.error("Test %d failed to run: %s", index, details)
+            result.append(("ERROR", 0, {}))
+
+    def flush(keepalive=True):
+        lock.acquire()
+        try:
+            data = "".join(log_data)
+            del log_data[:]
+        finally:
+            lock.release()
+        if data:
+            # JSON strings are unicode; logs may have any bytes
+            conn.send(msg="log", index=index,
+                      data=data.decode("utf-8", "replace"))
+        elif keepalive:
+            conn.send(msg="alive")
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    while thread.isAlive():
+        thread.join(interval)
+        flush()
+    flush(keepalive=False)
+    status, elapsed, timings = result[0]
+    conn.send(msg="done", index=index, status=status, elapsed=elapsed,
+              timings=timings)
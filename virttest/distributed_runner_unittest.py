@@ -0,0 +1,136 @@
+#!/usr/bin/python
+
+import json
+import socket
+import threading
+import unittest
+
+import common
+import distributed_runner
+
+
+def make_tests(*specs):
+    return [(i, {"name": name, "dep": dep})
+            for i, (name, dep) in enumerate(specs)]
+
+
+class DistributedRunnerTest(unittest.TestCase):
+
+    def run_job(self, tests, n_workers=3, fail=(), done=None, dying=0):
+        coordinator = distributed_runner.Coordinator(
+            tests, ("127.0.0.1", 0), done=done, max_requeue=1)
+        results = {}
+        logs = {}
+        self.hosts = {}
+
+        def make_run_test(worker):
+            def run_test(params, log, first, last):
+                log("running %s\n" % params["name"])
+                self.hosts.setdefault(worker, []).append((params["name"],
+                                                          first, last))
+                if params["name"] == "binary":
+                    log("caf\xc3\xa9 \xff")
+                if params["name"] in fail:
+                    return "FAIL", 0.1, {}
+                return "PASS", 0.1, {"test": 0.1}
+            return run_test
+
+        def on_result(index, status, elapsed, timings, worker):
+            results[index] = (status, worker)
+
+        def on_log(index, data):
+            logs[index] = logs.get(index, "") + data
+
+        def die():
+            # Take a test and disappear without an answer
+            sock = socket.create_connection(coordinator.address)
+            sock.sendall(json.dumps({"msg": "hello", "name": "dying"}) +
+                         "\n")
+            sock.recv(65536)
+            sock.close()
+
+        threads = [threading.Thread(target=die) for _ in range(dying)]
+        threads += [threading.Thread(target=distributed_runner.run_worker,
+                                     args=(coordinator.address,
+                                           make_run_test(i),
+                                           "worker%d" % i, 0.05))
+                    for i in range(n_workers)]
+        for thread in threads:
+            thread.start()
+        coordinator.run(on_result, on_log)
+        for thread in threads:
+            thread.join(10)
+            self.assertFalse(thread.isAlive())
+        return results, logs
+
+    def testRunAll(self):
+        tests = make_tests(*[("test%d" % i, []) for i in range(10)])
+        results, logs = self.run_job(tests)
+        self.assertEqual(sorted(results), range(10))
+        for index in range(10):
+            self.assertEqual(results[index][0], "PASS")
+            self.assertEqual(logs[index], "running test%d\n" % index)
+
+    def testDependencies(self):
+        tests = make_tests(("install.a", []), ("install.b", []),
+                           ("boot.a", ["install.a"]),
+                           ("boot.b", ["install.b"]),
+                           ("reboot.b", ["boot.b"]))
+        results, _ = self.run_job(tests, fail=("boot.b",))
+        self.assertEqual(results[2], ("PASS", results[0][1]))
+        self.assertEqual(results[3], ("FAIL", results[1][1]))
+        self.assertEqual(results[4], ("SKIP", None))
+
+    def testDone(self):
+        tests = make_tests(("install", []), ("boot", ["install"]),
+                           ("other", []))
+        results, _ = self.run_job(tests, n_workers=0,
+                                  done={0: False, 2: True})
+        self.assertEqual(results, {1: ("SKIP", None)})
+
+    def testRequeue(self):
+        tests = make_tests(("test0", []), ("test1", []))
+        results, _ = self.run_job(tests, n_workers=1, dying=1)
+        self.assertEqual(results, {0: ("PASS", "worker0"),
+                                   1: ("PASS", "worker0")})
+
+    def testHostSetup(self):
+        tests = make_tests(*[("test%d" % i, []) for i in range(4)])
+        self.run_job(tests, n_workers=1)
+        self.assertEqual(self.hosts.values(),
+                         [[("test0", True, False), ("test1", False, False),
+                           ("test2", False, False), ("test3", False, True)]])
+        # Every worker sets up and cleans up its own host
+        tests = make_tests(*[("test%d" % i, []) for i in range(20)])
+        self.run_job(tests, n_workers=3)
+        for steps in self.hosts.values():
+            self.assertTrue(steps[0][1])
+            self.assertTrue(steps[-1][2])
+            for (_, _, last), (_, first, _) in zip(steps, steps[1:]):
+                self.assertEqual(first, last)
+
+    def testBinaryLog(self):
+        tests = make_tests(("binary", []))
+        _, logs = self.run_job(tests, n_workers=1)
+        self.assertEqual(logs[0], u"running binary\ncaf\xe9 \ufffd")
+
+    def testPrereqs(self):
+        tests = make_tests(("install.a", []), ("install.b", []),
+                           ("boot.a", ["install.a"]),
+                           ("boot.all", ["install"]),
+                           ("install.c", ["boot"]))
+        self.assertEqual(distributed_runner.get_prereqs(tests),
+                         {0: [], 1: [], 2: [0], 3: [0, 1], 4: [2, 3]})
+        # Skipped tests leave holes in the indexes
+        self.assertEqual(distributed_runner.get_prereqs(tests[2:]),
+                         {2: [], 3: [], 4: [2, 3]})
+
+    def testParseAddress(self):
+        self.assertEqual(distributed_runner.parse_address("host:1234"),
+                         ("host", 1234))
+        self.assertRaises(ValueError, distributed_runner.parse_address,
+                          "host")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+"""
+Journal of the tests a job ran, to resume the job where it stopped.
+
+Every finished test appends a row with its name, shortname, status and
+timing to a SQLite database in the debug dir of the job. Nothing is ever
+updated in place, so the journal stays consistent even if the job dies in
+the middle of a test.
+"""
+import os
+import sqlite3
+import time
+
+
+JOURNAL_FILENAME = "journal.db"
+
+# Statuses that count as passed when tests depend on the test
+PASSED = ("PASS", "WARN")
+
+
+class JobJournal(object):
+
+    """
+    Append-only journal of the test results of a job.
+    """
+
+    def __init__(self, debugdir):
+        """
+        Open (or create) the journal of a job.
+
+        :param debugdir: Debug dir of the job.
+        """
+        self.filename = os.path.join(debugdir, JOURNAL_FILENAME)
+        self.db = sqlite3.connect(self.filename)
+        self.db.execute("CREATE TABLE IF NOT EXISTS tests ("
+                        "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                        "name TEXT, shortname TEXT, status TEXT, "
+                        "start REAL, elapsed REAL)")
+        self.db.commit()
+
+    def add(self, name, shortname, status, elapsed):
+        """
+        Record the result of a test.
+
+        :param name: Full name of the test (its 'name' param).
+        :param shortname: Short name (tag) of the test.
+        :param status: PASS, WARN, FAIL, ERROR or SKIP.
+        :param elapsed: Run time of the test in seconds.
+        """
+        self.db.execute("INSERT INTO tests (name, shortname, status, start, "
+                        "elapsed) VALUES (?, ?, ?, ?, ?)",
+                        (name, shortname, status, time.time() - elapsed,
+                         elapsed))
+        self.db.commit()
+
+    def get_results(self):
+        """
+        Return the latest result of every test in the journal.
+
+        :return: Dict mapping test names to (status, elapsed) tuples.
+        """
+        results = {}
+        for name, status, elapsed in self.db.execute(
+                "SELECT name, status, elapsed FROM tests ORDER BY id"):
+            results[str(name)] = (str(status), elapsed)
+        return results
+
+    def close(self):
+        self.db.close()
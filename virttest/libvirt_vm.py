@@ -389,6 +389,22 @@ class VM(virt_vm.BaseVM):
         def add_smp(help_text, smp):
             return " --vcpu=%s" % smp
 
+        def add_cpuset(help_text, cpuset):
+            if has_option(help_text, "cpuset"):
+                return " --cpuset=%s" % cpuset
+            else:
+                logging.warning("virt-install has no --cpuset option, the "
+                                "vCPUs are not pinned to CPUs %s", cpuset)
+                return ""
+
+        def add_numatune(help_text, nodeset):
+            if has_option(help_text, "numatune"):
+                return " --numatune %s,mode=strict" % nodeset
+            else:
+                logging.warning("virt-install has no --numatune option, the "
+                                "memory is not bound to NUMA node %s", nodeset)
+                return ""
+
         def add_location(help_text, location):
             if has_option(help_text, "location"):
                 return " --location %s" % location
@@ -647,6 +663,21 @@ class VM(virt_vm.BaseVM):
         if smp:
             virt_install_cmd += add_smp(help_text, smp)
 
+        # Pin guest memory (and vCPUs) to a numa node, as qemu_vm does
+        # with numactl
+        if params.get("numa_node"):
+            numa_node = int(params.get("numa_node"))
+            if len(utils_misc.get_node_cpus()) < int(params.get("smp", 1)):
+                logging.info("Skip pinning, no enough nodes")
+            elif numa_node < 0:
+                n = utils_misc.NumaNode(numa_node)
+                virt_install_cmd += add_numatune(help_text, n.node_id)
+            else:
+                virt_install_cmd += add_numatune(help_text, numa_node - 1)
+                if params.get("numa_cpuset"):
+                    virt_install_cmd += add_cpuset(help_text,
+                                                   params.get("numa_cpuset"))
+
         # TODO: directory location for vmlinuz/kernel for cdrom install ?
         location = None
         if params.get("medium") == 'url':
@@ -906,6 +937,9 @@ class VM(virt_vm.BaseVM):
                                                        output_params=output_params)
             # Cause serial_console.close() to close open log file
             self.serial_console.set_log_file(output_filename)
+            buffer_limit = self.params.get("serial_console_buffer_limit")
+            if buffer_limit:
+                self.serial_console.set_buffer_limit(int(buffer_limit))
 
     def set_root_serial_console(self, device, remove=False):
         """
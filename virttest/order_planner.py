@@ -0,0 +1,157 @@
+"""
+Reorder the tests of a job so that fewer VMs have to be booted.
+
+Between tests, env_process.preprocess() restarts a VM whenever the
+parameters its command line is made of differ from the ones of the
+running VM. Running the tests that use the same VM configuration one
+after the other lets them share a single boot.
+"""
+import heapq
+
+import utils_params
+
+
+# Parameters of a VM whose change makes preprocess restart it
+VM_PARAMS = ("vm_type", "qemu_binary", "machine_type", "cpu_model", "mem",
+             "smp", "vcpu_cores", "vcpu_threads", "vcpu_sockets", "images",
+             "nics", "cdroms")
+IMAGE_PARAMS = ("image_name", "image_format", "drive_format")
+NIC_PARAMS = ("nic_model", "netdst", "nettype")
+
+
+def get_vm_key(params):
+    """
+    Return a hashable description of the VMs a test runs with.
+
+    :param params: Dict of a test.
+    :return: Tuple of the VM defining params of all the VMs of the test,
+            or None if the test doesn't start VMs.
+    """
+    if params.get("skip") == "yes" or params.get("start_vm") != "yes":
+        return None
+    params = utils_params.Params(params)
+    key = []
+    for vm_name in params.objects("vms"):
+        vm_params = params.object_params(vm_name)
+        key.append(vm_name)
+        key.extend(vm_params.get(name) for name in VM_PARAMS)
+        for image_name in vm_params.objects("images"):
+            image_params = vm_params.object_params(image_name)
+            key.extend(image_params.get(name) for name in IMAGE_PARAMS)
+        for nic_name in vm_params.objects("nics"):
+            nic_params = vm_params.object_params(nic_name)
+            key.extend(nic_params.get(name) for name in NIC_PARAMS)
+    return tuple(key)
+
+
+def count_boots(dicts):
+    """
+    Count the VM boots a sequence of tests needs.
+
+    A test that starts VMs boots them unless the test before left VMs of
+    the same configuration running (i.e. didn't set kill_vm).
+
+    :param dicts: Test dicts in the order they run.
+    """
+    boots = 0
+    running = None
+    for params in dicts:
+        if params.get("skip") == "yes":
+            continue
+        key = get_vm_key(params)
+        if key is not None:
+            if key != running:
+                boots += 1
+            running = key
+        if params.get("kill_vm") == "yes":
+            running = None
+    return boots
+
+
+def reorder(dicts):
+    """
+    Reorder tests so that the ones with the same VM configuration follow
+    each other.
+
+    A test depends on the tests whose names contain one of its 'dep'
+    params. The order of every test and such a test is kept, so tests run
+    after the tests they depend on exactly as before. Otherwise the next
+    test is the first one (in the original order) using the VMs left
+    running by the previous test, else the first one not starting VMs
+    (those leave the running VMs alone), else the first one at all.
+
+    :param dicts: Test dicts in the original order.
+    :return: List of the test dicts in the new order.
+    """
+    dicts = list(dicts)
+    n_tests = len(dicts)
+    keys = [get_vm_key(params) for params in dicts]
+
+    dep_tests = {}
+    for params in dicts:
+        for dep in params.get("dep", []):
+            dep_tests[dep] = []
+    if dep_tests:
+        for j, params in enumerate(dicts):
+            for dep in dep_tests:
+                if dep in params["name"]:
+                    dep_tests[dep].append(j)
+    after = [[] for _ in xrange(n_tests)]
+    n_before = [0] * n_tests
+    for i, params in enumerate(dicts):
+        related = set()
+        for dep in params.get("dep", []):
+            related.update(dep_tests[dep])
+        related.discard(i)
+        for j in related:
+            first, second = min(i, j), max(i, j)
+            after[first].append(second)
+            n_before[second] += 1
+
+    # Tests all whose predecessors are placed, as a whole and per VM key
+    ready = []
+    ready_by_key = {}
+
+    def make_ready(i):
+        heapq.heappush(ready, i)
+        heapq.heappush(ready_by_key.setdefault(keys[i], []), i)
+
+    for i in xrange(n_tests):
+        if not n_before[i]:
+            make_ready(i)
+
+    placed = [False] * n_tests
+    order = []
+    running = None
+    while ready:
+        i = None
+        # Tests reusing the running VMs first, then the ones not using VMs
+        preferred = []
+        if running is not None:
+            preferred = [running, None]
+        for key in preferred:
+            queue = ready_by_key.get(key)
+            while queue and placed[queue[0]]:
+                heapq.heappop(queue)
+            if queue:
+                i = heapq.heappop(queue)
+                break
+        if i is None:
+            while placed[ready[0]]:
+                heapq.heappop(ready)
+            i = heapq.heappop(ready)
+        placed[i] = True
+        order.append(i)
+        params = dicts[i]
+        if keys[i] is not None:
+            running = keys[i]
+        if params.get("kill_vm") == "yes":
+            running = None
+        for j in after[i]:
+            n_before[j] -= 1
+            if not n_before[j]:
+                make_ready(j)
+        while ready and placed[ready[0]]:
+            heapq.heappop(ready)
+
+    return [dicts[i] for i in order]
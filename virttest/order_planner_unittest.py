@@ -0,0 +1,65 @@
+#!/usr/bin/python
+
+import unittest
+
+import common
+import order_planner
+
+
+def make_test(name, mem="1024", dep=None, **params):
+    test = {"name": name, "shortname": name, "dep": dep or [],
+            "start_vm": "yes", "vms": "vm1", "images": "image1",
+            "image_name": "images/f20", "nics": "nic1", "mem": mem}
+    test.update(params)
+    return test
+
+
+class OrderPlannerTest(unittest.TestCase):
+
+    def names(self, tests):
+        return [test["name"] for test in tests]
+
+    def testVMKey(self):
+        self.assertEqual(order_planner.get_vm_key(make_test("a")),
+                         order_planner.get_vm_key(make_test("b")))
+        self.assertNotEqual(order_planner.get_vm_key(make_test("a")),
+                            order_planner.get_vm_key(make_test("a",
+                                                               mem="2048")))
+        self.assertNotEqual(
+            order_planner.get_vm_key(make_test("a")),
+            order_planner.get_vm_key(make_test("a", image_name_image1="x")))
+        self.assertEqual(order_planner.get_vm_key(make_test("a",
+                                                            start_vm="no")),
+                         None)
+
+    def testCountBoots(self):
+        tests = [make_test("a"), make_test("b", mem="2048"), make_test("c")]
+        self.assertEqual(order_planner.count_boots(tests), 3)
+        self.assertEqual(order_planner.count_boots(tests[::2]), 1)
+        tests[0]["kill_vm"] = "yes"
+        self.assertEqual(order_planner.count_boots(tests[::2]), 2)
+
+    def testReorder(self):
+        tests = [make_test("a.1"), make_test("b.1", mem="2048"),
+                 make_test("a.2"), make_test("b.2", mem="2048"),
+                 make_test("host", start_vm="no"), make_test("a.3")]
+        ordered = order_planner.reorder(tests)
+        self.assertEqual(self.names(ordered),
+                         ["a.1", "a.2", "a.3", "host", "b.1", "b.2"])
+        self.assertEqual(order_planner.count_boots(tests), 5)
+        self.assertEqual(order_planner.count_boots(ordered), 2)
+
+    def testReorderKeepsDependencies(self):
+        tests = [make_test("install.a"),
+                 make_test("install.b", mem="2048"),
+                 make_test("boot.b", mem="2048", dep=["install.b"]),
+                 make_test("boot.a", dep=["install.a"]),
+                 make_test("other.b", mem="2048"),
+                 make_test("stop.a", mem="2048", dep=["boot.a"])]
+        names = self.names(order_planner.reorder(tests))
+        self.assertEqual(names, ["install.a", "boot.a", "install.b", "boot.b",
+                                 "other.b", "stop.a"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1129,6 +1129,10 @@ class VM(virt_vm.BaseVM):
             else:
                 n = numa_node - 1
                 cmd += "numactl -m %s " % n
+                # Run the vCPUs on the node too (e.g. on the CPUs of the
+                # parallel worker the test runs on)
+                if params.get("numa_cpuset"):
+                    cmd += "-C %s " % params.get("numa_cpuset")
 
         # Start constructing devices representation
         devices = qcontainer.DevContainer(qemu_binary, self.name,
@@ -1889,6 +1893,9 @@ class VM(virt_vm.BaseVM):
             output_func=utils_misc.log_line,
             output_params=("serial-%s-%s.log" % (tmp_serial, self.name),),
             prompt=self.params.get("shell_prompt", "[\#\$]"))
+        buffer_limit = self.params.get("serial_console_buffer_limit")
+        if buffer_limit:
+            self.serial_console.set_buffer_limit(int(buffer_limit))
         del tmp_serial
 
     def update_system_dependent_devs(self):
@@ -1,5 +1,6 @@
 import os
 import select
+import heapq
 import utils_env
 import virt_vm
 import aexpect
@@ -38,6 +39,46 @@ class scheduler:
         # specifically to each worker.  For example, each worker must use a
         # different environment file and a different MAC address pool.
         self.worker_dicts = [{"env": "env%d" % i} for i in range(num_workers)]
+        self._build_graph()
+
+    def _build_graph(self):
+        """
+        Resolve the 'dep' params of the tests into a dependency graph.
+
+        A test depends on every test whose name contains one of its deps.
+        Each distinct dep is matched against the test names only once, so
+        the scheduler never has to scan the test list again.
+        """
+        n_tests = len(self.tests)
+        dep_tests = {}
+        tests_with_dep = {}
+        for i, test in enumerate(self.tests):
+            for dep in test.get("dep", []):
+                tests_with_dep.setdefault(dep, []).append(i)
+        for dep in tests_with_dep:
+            dep_tests[dep] = [j for j, t in enumerate(self.tests)
+                              if dep in t["name"]]
+        # Tests that share a dependency ("dep in other_dep or other_dep in
+        # dep") with a test run on the same worker as the test
+        related_deps = {}
+        for dep in tests_with_dep:
+            related_deps[dep] = [other for other in tests_with_dep
+                                 if dep in other or other in dep]
+
+        # dependencies[i]: tests i waits for, dependents[j]: tests waiting
+        # for j, related[i]: tests to run on the worker that runs i
+        self.dependencies = [set() for _ in range(n_tests)]
+        self.dependents = [set() for _ in range(n_tests)]
+        self.related = [set() for _ in range(n_tests)]
+        for i, test in enumerate(self.tests):
+            for dep in test.get("dep", []):
+                for j in dep_tests[dep]:
+                    self.dependencies[i].add(j)
+                    self.dependents[j].add(i)
+                for other in related_deps[dep]:
+                    self.related[i].update(tests_with_dep[other])
+        for i in range(n_tests):
+            self.related[i].update(self.dependents[i])
 
     def worker(self, index, run_test_func):
         """
@@ -96,13 +137,86 @@ class scheduler:
 
         Sends commands to workers, telling them to run tests, clean up or
         terminate execution.
+
+        Tests become ready when the last of their dependencies passed and
+        are queued in order, on the worker they are bound to (if any), so
+        finding the next test for a worker doesn't scan the test list.
         """
+        n_tests = len(self.tests)
         idle_workers = []
-        closing_workers = []
-        test_status = ["waiting"] * len(self.tests)
-        test_worker = [None] * len(self.tests)
+        closing_workers = set()
+        test_status = ["waiting"] * n_tests
+        test_worker = [None] * n_tests
         used_cpus = [0] * self.num_workers
         used_mem = [0] * self.num_workers
+        # Sums over all workers and over the workers shutting down
+        total_used_cpus = total_used_mem = 0
+        closing_cpus = closing_mem = 0
+        # Number of dependencies of each test that didn't pass yet
+        unmet = [len(deps) for deps in self.dependencies]
+        # Ready tests bound to no worker, and ready tests of each worker
+        ready = [i for i in range(n_tests) if not unmet[i]]
+        ready_on = [[] for _ in range(self.num_workers)]
+
+        def fail(test_index):
+            # Tests depending on a failed test will never run
+            stack = list(self.dependents[test_index])
+            while stack:
+                i = stack.pop()
+                if test_status[i] == "waiting":
+                    test_status[i] = "fail"
+                    stack.extend(self.dependents[i])
+
+        def find_test(worker):
+            # Returns (test index, whether a test can run soon on worker).
+            # Tests that can't run on worker now go back to their queues.
+            test_found = False
+            chosen = None
+            skipped = []
+            queues = [ready_on[worker], ready]
+            while chosen is None:
+                heads = [q for q in queues if q]
+                if not heads:
+                    break
+                queue = min(heads, key=lambda q: q[0])
+                i = heapq.heappop(queue)
+                if test_status[i] != "waiting":
+                    continue
+                # Tests bound to another worker since they became ready
+                # were moved to its queue already
+                if test_worker[i] is not None and test_worker[i] != worker:
+                    continue
+                skipped.append((queue, i))
+                test = self.tests[i]
+                # Make sure we have enough resources to run the test
+                test_used_cpus = int(test.get("used_cpus", 1))
+                test_used_mem = int(test.get("used_mem", 128))
+                # First make sure the other workers aren't using too many
+                # CPUs (not including the workers currently shutting down)
+                uc = total_used_cpus - used_cpus[worker] - closing_cpus
+                if uc and uc + test_used_cpus > self.total_cpus:
+                    continue
+                # ... or too much memory
+                um = total_used_mem - used_mem[worker] - closing_mem
+                if um and um + test_used_mem > self.total_mem:
+                    continue
+                # If we reached this point it means there are, or will
+                # soon be, enough resources to run the test
+                test_found = True
+                # Now check if the test can be run right now, i.e. if the
+                # other workers, including the ones currently shutting
+                # down, aren't using too many CPUs
+                uc = total_used_cpus - used_cpus[worker]
+                if uc and uc + test_used_cpus > self.total_cpus:
+                    continue
+                # ... or too much memory
+                um = total_used_mem - used_mem[worker]
+                if um and um + test_used_mem > self.total_mem:
+                    continue
+                chosen = skipped.pop()[1]
+            for queue, i in skipped:
+                heapq.heappush(queue, i)
+            return chosen, test_found
 
         while True:
             # Wait for a message from a worker
@@ -124,19 +238,28 @@ class scheduler:
                 # A worker completed a test
                 elif msg[0] == "done":
                     test_index = int(msg[1])
-                    test = self.tests[test_index]
                     status = int(eval(msg[2]))
                     test_status[test_index] = ("fail", "pass")[status]
-                    # If the test failed, mark all dependent tests as "failed"
-                    # too
-                    if not status:
-                        for i, other_test in enumerate(self.tests):
-                            for dep in other_test.get("dep", []):
-                                if dep in test["name"]:
-                                    test_status[i] = "fail"
+                    if status:
+                        for i in self.dependents[test_index]:
+                            unmet[i] -= 1
+                            if not unmet[i] and test_status[i] == "waiting":
+                                if test_worker[i] is None:
+                                    heapq.heappush(ready, i)
+                                else:
+                                    heapq.heappush(ready_on[test_worker[i]],
+                                                   i)
+                    else:
+                        # If the test failed, mark all dependent tests as
+                        # "failed" too
+                        fail(test_index)
 
                 # A worker is done shutting down its VMs and other processes
                 elif msg[0] == "cleanup_done":
+                    total_used_cpus -= used_cpus[worker_index]
+                    total_used_mem -= used_mem[worker_index]
+                    closing_cpus -= used_cpus[worker_index]
+                    closing_mem -= used_mem[worker_index]
                     used_cpus[worker_index] = 0
                     used_mem[worker_index] = 0
                     closing_workers.remove(worker_index)
@@ -146,83 +269,40 @@ class scheduler:
 
             for worker in idle_workers[:]:
                 # Find a test for this worker
-                test_found = False
-                for i, test in enumerate(self.tests):
-                    # We only want "waiting" tests
-                    if test_status[i] != "waiting":
-                        continue
-                    # Make sure the test isn't assigned to another worker
-                    if test_worker[i] is not None and test_worker[i] != worker:
-                        continue
-                    # Make sure the test's dependencies are satisfied
-                    dependencies_satisfied = True
-                    for dep in test["dep"]:
-                        dependencies = [j for j, t in enumerate(self.tests)
-                                        if dep in t["name"]]
-                        bad_status_deps = [j for j in dependencies
-                                           if test_status[j] != "pass"]
-                        if bad_status_deps:
-                            dependencies_satisfied = False
-                            break
-                    if not dependencies_satisfied:
-                        continue
-                    # Make sure we have enough resources to run the test
-                    test_used_cpus = int(test.get("used_cpus", 1))
-                    test_used_mem = int(test.get("used_mem", 128))
-                    # First make sure the other workers aren't using too many
-                    # CPUs (not including the workers currently shutting down)
-                    uc = (sum(used_cpus) - used_cpus[worker] -
-                          sum(used_cpus[i] for i in closing_workers))
-                    if uc and uc + test_used_cpus > self.total_cpus:
-                        continue
-                    # ... or too much memory
-                    um = (sum(used_mem) - used_mem[worker] -
-                          sum(used_mem[i] for i in closing_workers))
-                    if um and um + test_used_mem > self.total_mem:
-                        continue
-                    # If we reached this point it means there are, or will
-                    # soon be, enough resources to run the test
-                    test_found = True
-                    # Now check if the test can be run right now, i.e. if the
-                    # other workers, including the ones currently shutting
-                    # down, aren't using too many CPUs
-                    uc = (sum(used_cpus) - used_cpus[worker])
-                    if uc and uc + test_used_cpus > self.total_cpus:
-                        continue
-                    # ... or too much memory
-                    um = (sum(used_mem) - used_mem[worker])
-                    if um and um + test_used_mem > self.total_mem:
-                        continue
+                i, test_found = find_test(worker)
+                if i is not None:
+                    test = self.tests[i]
                     # Everything is OK -- run the test
                     test_status[i] = "running"
                     test_worker[i] = worker
                     idle_workers.remove(worker)
                     # Update used_cpus and used_mem
-                    used_cpus[worker] = test_used_cpus
-                    used_mem[worker] = test_used_mem
-                    # Assign all related tests to this worker
-                    for j, other_test in enumerate(self.tests):
-                        for other_dep in other_test["dep"]:
-                            # All tests that depend on this test
-                            if other_dep in test["name"]:
-                                test_worker[j] = worker
-                                break
-                            # ... and all tests that share a dependency
-                            # with this test
-                            for dep in test["dep"]:
-                                if dep in other_dep or other_dep in dep:
-                                    test_worker[j] = worker
-                                    break
+                    total_used_cpus -= used_cpus[worker]
+                    total_used_mem -= used_mem[worker]
+                    used_cpus[worker] = int(test.get("used_cpus", 1))
+                    used_mem[worker] = int(test.get("used_mem", 128))
+                    total_used_cpus += used_cpus[worker]
+                    total_used_mem += used_mem[worker]
+                    # Assign all related tests to this worker, moving the
+                    # ready ones to its queue: their worker may never look
+                    # at its own queue again
+                    for j in self.related[i]:
+                        if (test_worker[j] != worker and not unmet[j] and
+                                test_status[j] == "waiting"):
+                            heapq.heappush(ready_on[worker], j)
+                        test_worker[j] = worker
                     # Tell the worker to run the test
                     self.s2w_w[worker].write("run %s\n" % i)
-                    break
 
                 # If there won't be any tests for this worker to run soon, tell
                 # the worker to free its used resources
-                if not test_found and (used_cpus[worker] or used_mem[worker]):
+                elif not test_found and (used_cpus[worker] or
+                                         used_mem[worker]):
                     self.s2w_w[worker].write("cleanup\n")
                     idle_workers.remove(worker)
-                    closing_workers.append(worker)
+                    closing_workers.add(worker)
+                    closing_cpus += used_cpus[worker]
+                    closing_mem += used_mem[worker]
 
             # If there are no more new tests to run, terminate the workers and
             # the scheduler
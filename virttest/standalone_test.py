@@ -5,8 +5,10 @@ import sys
 import time
 import traceback
 import Queue
+import multiprocessing
 import glob
 import shutil
+import json
 from autotest.client.shared import error
 from autotest.client import utils
 import aexpect
@@ -20,6 +22,9 @@ import data_dir
 import bootstrap
 import storage
 import cartesian_config
+import order_planner
+import job_journal
+import distributed_runner
 import arch
 import funcatexit
 import version
@@ -32,6 +37,118 @@ global TAG_INDEX
 TAG_INDEX = {}
 
 
+class TestModuleIndex(object):
+
+    """
+    Index of the test modules of a job.
+
+    Walking the test dirs of the providers of a test and looking for its
+    module there is done once per set of test dirs, and each module is
+    loaded once per job.
+    """
+
+    def __init__(self):
+        # (other_tests_dirs, provider, vm_type) -> list of test dirs
+        self.subtest_dirs = {}
+        # (other_tests_dirs, provider, vm_type) -> {type: test dir}
+        self.module_dirs = {}
+        # module path -> loaded module
+        self.modules = {}
+
+    def get_subtest_dirs(self, params, bindir):
+        """
+        Get the dirs the test modules of a test are searched in.
+
+        :param params: Test params (other_tests_dirs, provider, vm_type).
+        :param bindir: Root dir of virt-test.
+        :return: Tuple (index key, list of test dirs).
+        """
+        key = (params.get("other_tests_dirs", ""),
+               params.get("provider", None), params.get("vm_type"))
+        if key in self.subtest_dirs:
+            return key, self.subtest_dirs[key]
+
+        subtest_dirs = []
+        other_subtests_dirs, provider, vm_type = key
+        for d in other_subtests_dirs.split():
+            d = os.path.join(*d.split("/"))
+            subtestdir = os.path.join(bindir, d, "tests")
+            if not os.path.isdir(subtestdir):
+                raise error.TestError("Directory %s does not "
+                                      "exist" % (subtestdir))
+            subtest_dirs += data_dir.SubdirList(subtestdir,
+                                                bootstrap.test_filter)
+
+        if provider is None:
+            # Verify if we have the correspondent source file for it
+            for generic_subdir in asset.get_test_provider_subdirs('generic'):
+                subtest_dirs += data_dir.SubdirList(generic_subdir,
+                                                    bootstrap.test_filter)
+
+            for specific_subdir in asset.get_test_provider_subdirs(vm_type):
+                subtest_dirs += data_dir.SubdirList(specific_subdir,
+                                                    bootstrap.test_filter)
+        else:
+            provider_info = asset.get_test_provider_info(provider)
+            for backend in provider_info['backends']:
+                subtest_dirs += data_dir.SubdirList(
+                    provider_info['backends'][backend]['path'],
+                    bootstrap.test_filter)
+
+        # Make sure we can load provider_lib in tests
+        for d in subtest_dirs:
+            if os.path.dirname(d) not in sys.path:
+                sys.path.insert(0, os.path.dirname(d))
+
+        # The first dir a module is found in wins
+        module_dirs = {}
+        for d in subtest_dirs:
+            try:
+                filenames = os.listdir(d)
+            except OSError:
+                continue
+            for filename in filenames:
+                t_type, ext = os.path.splitext(filename)
+                if ext == ".py" and t_type not in module_dirs:
+                    module_dirs[t_type] = d
+
+        self.subtest_dirs[key] = subtest_dirs
+        self.module_dirs[key] = module_dirs
+        return key, subtest_dirs
+
+    def load_module(self, t_type, params, bindir):
+        """
+        Get the module of a test type, loading it on first use.
+
+        :param t_type: Test type (name of the test module).
+        :param params: Test params (other_tests_dirs, provider, vm_type).
+        :param bindir: Root dir of virt-test.
+        :raise error.TestError: If the module can't be found.
+        """
+        key, subtest_dirs = self.get_subtest_dirs(params, bindir)
+        subtest_dir = self.module_dirs[key].get(t_type)
+        if subtest_dir is None:
+            msg = ("Could not find test file %s.py on test"
+                   "dirs %s" % (t_type, subtest_dirs))
+            raise error.TestError(msg)
+        module_path = os.path.join(subtest_dir, "%s.py" % t_type)
+        logging.debug("Found subtest module %s", module_path)
+        if module_path not in self.modules:
+            # Load the test module. Modules of the same name in other test
+            # dirs get a sys.modules entry of their own, or loading one
+            # would overwrite the other.
+            name = "%s_%x" % (t_type, abs(hash(module_path)))
+            f, p, d = imp.find_module(t_type, [subtest_dir])
+            try:
+                self.modules[module_path] = imp.load_module(name, f, p, d)
+            finally:
+                f.close()
+        return self.modules[module_path]
+
+
+TEST_MODULES = TestModuleIndex()
+
+
 class Test(object):
 
     """
@@ -65,6 +182,8 @@ class Test(object):
         self.logfile = None
         self.file_handler = None
         self.background_errors = Queue.Queue()
+        # Seconds spent in each phase of the test
+        self.timings = {}
 
     def set_debugdir(self, debugdir):
         self.debugdir = os.path.join(debugdir, self.tag)
@@ -91,6 +210,30 @@ class Test(object):
         logger.removeHandler(self.file_handler)
         self.file_handler.close()
 
+    def add_timing(self, phase, start):
+        """
+        Add the time elapsed since start to the time spent in a phase.
+
+        :param phase: preprocess, test, postprocess, env_save or funcatexit.
+        :param start: time.time() at the start of the phase.
+        """
+        self.timings[phase] = (self.timings.get(phase, 0) +
+                               time.time() - start)
+
+    def save_env(self, env):
+        start = time.time()
+        try:
+            env.save()
+        finally:
+            self.add_timing("env_save", start)
+
+    def run_exitfuncs(self, env, t_type):
+        start = time.time()
+        try:
+            return funcatexit.run_exitfuncs(env, t_type)
+        finally:
+            self.add_timing("funcatexit", start)
+
     def verify_background_errors(self):
         """
         Verify if there are any errors that happened on background threads.
@@ -142,38 +285,6 @@ class Test(object):
         try:
             try:
                 try:
-                    subtest_dirs = []
-
-                    other_subtests_dirs = params.get("other_tests_dirs", "")
-                    for d in other_subtests_dirs.split():
-                        d = os.path.join(*d.split("/"))
-                        subtestdir = os.path.join(self.bindir, d, "tests")
-                        if not os.path.isdir(subtestdir):
-                            raise error.TestError("Directory %s does not "
-                                                  "exist" % (subtestdir))
-                        subtest_dirs += data_dir.SubdirList(subtestdir,
-                                                            bootstrap.test_filter)
-
-                    provider = params.get("provider", None)
-
-                    if provider is None:
-                        # Verify if we have the correspondent source file for it
-                        for generic_subdir in asset.get_test_provider_subdirs('generic'):
-                            subtest_dirs += data_dir.SubdirList(generic_subdir,
-                                                                bootstrap.test_filter)
-
-                        for specific_subdir in asset.get_test_provider_subdirs(params.get("vm_type")):
-                            subtest_dirs += data_dir.SubdirList(specific_subdir,
-                                                                bootstrap.test_filter)
-                    else:
-                        provider_info = asset.get_test_provider_info(provider)
-                        for key in provider_info['backends']:
-                            subtest_dirs += data_dir.SubdirList(
-                                provider_info['backends'][key]['path'],
-                                bootstrap.test_filter)
-
-                    subtest_dir = None
-
                     # Get the test routine corresponding to the specified
                     # test type
                     logging.debug("Searching for test modules that match "
@@ -182,63 +293,53 @@ class Test(object):
                                   params.get("type"), params.get("provider", None))
 
                     t_types = params.get("type").split()
-                    # Make sure we can load provider_lib in tests
-                    for s in subtest_dirs:
-                        if os.path.dirname(s) not in sys.path:
-                            sys.path.insert(0, os.path.dirname(s))
 
                     test_modules = {}
                     for t_type in t_types:
-                        for d in subtest_dirs:
-                            module_path = os.path.join(d, "%s.py" % t_type)
-                            if os.path.isfile(module_path):
-                                logging.debug("Found subtest module %s",
-                                              module_path)
-                                subtest_dir = d
-                                break
-                        if subtest_dir is None:
-                            msg = ("Could not find test file %s.py on test"
-                                   "dirs %s" % (t_type, subtest_dirs))
-                            raise error.TestError(msg)
-                        # Load the test module
-                        f, p, d = imp.find_module(t_type, [subtest_dir])
-                        test_modules[t_type] = imp.load_module(t_type, f, p, d)
-                        f.close()
+                        test_modules[t_type] = TEST_MODULES.load_module(
+                            t_type, params, self.bindir)
 
                     # Preprocess
+                    start = time.time()
                     try:
                         params = env_process.preprocess(self, params, env)
                     finally:
-                        env.save()
+                        self.add_timing("preprocess", start)
+                        self.save_env(env)
 
                     # Run the test function
                     for t_type, test_module in test_modules.items():
                         run_func = utils_misc.get_test_entrypoint_func(
                             t_type, test_module)
+                        start = time.time()
                         try:
                             run_func(self, params, env)
                             self.verify_background_errors()
                         finally:
-                            env.save()
+                            self.add_timing("test", start)
+                            self.save_env(env)
                     test_passed = True
-                    error_message = funcatexit.run_exitfuncs(env, t_type)
+                    error_message = self.run_exitfuncs(env, t_type)
                     if error_message:
                         raise error.TestWarn("funcatexit failed with: %s"
                                              % error_message)
 
                 except Exception, e:
                     if (t_type is not None):
-                        error_message = funcatexit.run_exitfuncs(env, t_type)
+                        error_message = self.run_exitfuncs(env, t_type)
                         if error_message:
                             logging.error(error_message)
+                    start = time.time()
                     try:
                         env_process.postprocess_on_error(self, params, env)
                     finally:
-                        env.save()
+                        self.add_timing("postprocess", start)
+                        self.save_env(env)
                     raise
 
             finally:
                 # Postprocess
+                start = time.time()
                 try:
                     try:
                         env_process.postprocess(self, params, env)
@@ -248,7 +349,8 @@ class Test(object):
                         logging.error("Exception raised during "
                                       "postprocessing: %s", e)
                 finally:
-                    env.save()
+                    self.add_timing("postprocess", start)
+                    self.save_env(env)
 
         except Exception, e:
             if params.get("abort_on_error") != "yes":
@@ -419,6 +521,22 @@ def print_warn(t_elapsed, open_fd=False):
     print_stdout(msg)
 
 
+def print_result(result, t_elapsed, open_fd=False):
+    """
+    Print a test status (PASS, WARN, ERROR, SKIP or FAIL) to stdout.
+    """
+    if result == "PASS":
+        print_pass(t_elapsed, open_fd=open_fd)
+    elif result == "WARN":
+        print_warn(t_elapsed, open_fd=open_fd)
+    elif result == "ERROR":
+        print_error(t_elapsed, open_fd=open_fd)
+    elif result == "SKIP":
+        print_skip(open_fd=open_fd)
+    else:
+        print_fail(t_elapsed, open_fd=open_fd)
+
+
 def reset_logging():
     """
     Remove all the handlers and unset the log level on the root logger.
@@ -541,6 +659,31 @@ def get_cartesian_parser_details(cartesian_parser):
     return details
 
 
+def get_test_dicts(parser, options, reorder=True):
+    """
+    Generate the cartesian dicts of this job.
+
+    If a shard was requested (--shard), only the dicts of that shard are
+    generated. With --reorder-tests the dicts come in the order that needs
+    the fewest VM boots.
+
+    :param parser: Cartesian parser object with test options.
+    :param options: OptParse object with cmdline options.
+    :param reorder: Whether to honour --reorder-tests.
+    """
+    if not getattr(options, "shard", None):
+        dicts = parser.get_dicts()
+    else:
+        shard, shards = cartesian_config.parse_shard(options.shard)
+        costs = None
+        if getattr(options, "shard_costs", None):
+            costs = cartesian_config.read_costs(options.shard_costs)
+        dicts = parser.get_dicts(shard=shard, shards=shards, costs=costs)
+    if reorder and getattr(options, "reorder_tests", False):
+        dicts = order_planner.reorder(dicts)
+    return dicts
+
+
 def print_test_list(options, cartesian_parser):
     """
     Helper function to pretty print the test list.
@@ -557,7 +700,7 @@ def print_test_list(options, cartesian_parser):
     if options.tests:
         tests = options.tests.split(" ")
         cartesian_parser.only_filter(", ".join(tests))
-    for params in cartesian_parser.get_dicts():
+    for params in get_test_dicts(cartesian_parser, options):
         virt_test_type = params.get('virt_test_type', "")
         supported_virt_backends = virt_test_type.split(" ")
         if options.type in supported_virt_backends:
@@ -576,10 +719,15 @@ def print_test_list(options, cartesian_parser):
                 pipe.write(out)
             except IOError:
                 return
+    if cartesian_parser.profile is not None:
+        pipe.write("\n" + cartesian_parser.profile.report())
 
 
 def get_guest_name_parser(options):
-    cartesian_parser = cartesian_config.Parser()
+    cache_dir = None
+    if not getattr(options, "no_config_cache", False):
+        cache_dir = data_dir.get_cache_dir('cfg')
+    cartesian_parser = cartesian_config.Parser(cache_dir=cache_dir)
     machines_cfg_path = data_dir.get_backend_cfg_path(options.type,
                                                       'machines.cfg')
     guest_os_cfg_path = data_dir.get_backend_cfg_path(options.type,
@@ -757,7 +905,44 @@ def cleanup_env(parser, options):
         logging.info("")
 
 
-def _job_report(job_elapsed_time, n_tests, n_tests_skipped, n_tests_failed):
+def _load_timings(debugdir):
+    """
+    Load the phase timings of the tests of a job (when resuming it).
+
+    :param debugdir: Log directory of the job.
+    :return: Dict mapping test tags to dicts of seconds per phase.
+    """
+    timings_file = os.path.join(debugdir, "timings.json")
+    if not os.path.isfile(timings_file):
+        return {}
+    timings_fd = open(timings_file)
+    try:
+        return json.load(timings_fd)
+    finally:
+        timings_fd.close()
+
+
+def _save_timings(debugdir, timings):
+    """
+    Write the phase timings of the tests of a job to timings.json.
+
+    It's written after every test, so that a job that dies can be resumed
+    with them; the file is replaced at once, never left half written.
+
+    :param debugdir: Log directory of the job.
+    :param timings: Dict mapping test tags to dicts of seconds per phase.
+    """
+    timings_file = os.path.join(debugdir, "timings.json")
+    timings_fd = open(timings_file + ".tmp", "w")
+    try:
+        json.dump(timings, timings_fd, indent=4, sort_keys=True)
+    finally:
+        timings_fd.close()
+    os.rename(timings_file + ".tmp", timings_file)
+
+
+def _job_report(job_elapsed_time, n_tests, n_tests_skipped, n_tests_failed,
+                timings=None, top=10):
     """
     Print to stdout and run log stats of our test job.
 
@@ -765,6 +950,8 @@ def _job_report(job_elapsed_time, n_tests, n_tests_skipped, n_tests_failed):
     :param n_tests: Total Number of tests executed.
     :param n_tests_skipped: Total Number of tests skipped.
     :param n_tests_passed: Number of tests that passed.
+    :param timings: Dict mapping test tags to dicts of seconds per phase.
+    :param top: Number of the slowest test phases to list.
     """
     minutes, seconds = divmod(job_elapsed_time, 60)
     hours, minutes = divmod(minutes, 60)
@@ -801,134 +988,134 @@ def _job_report(job_elapsed_time, n_tests, n_tests_skipped, n_tests_failed):
         logging.info("Tests skipped: %d", n_tests_skipped)
     logging.info("Success rate: %.2f %%", success_rate)
 
-
-def run_tests(parser, options):
+    if timings:
+        phases = [(elapsed, phase, tag)
+                  for tag, test_timings in timings.items()
+                  for phase, elapsed in test_timings.items()]
+        phases.sort(reverse=True)
+        print_header("SLOWEST TEST PHASES:")
+        logging.info("Slowest test phases:")
+        for elapsed, phase, tag in phases[:top]:
+            print_stdout("%10.2f s  %-12s %s" % (elapsed, phase, tag))
+            logging.info("%10.2f s  %-12s %s", elapsed, phase, tag)
+
+
+# Add the parameter decide if setup host env in the test case
+# For some special tests we only setup host in the first and last case
+# When we need to setup host env we need the host_setup_flag as following:
+#    0(00): do nothing
+#    1(01): setup env
+#    2(10): cleanup env
+#    3(11): setup and cleanup env
+HOST_SETUP_FLAG = 1
+HOST_CLEANUP_FLAG = 2
+
+
+def _add_host_setup_flag(dct, flag):
     """
-    Runs the sequence of KVM tests based on the list of dctionaries
-    generated by the configuration system, handling dependencies.
+    Make a test set up and/or clean up the host env.
 
-    :param parser: Config parser object.
-    :param options: Test runner options object.
-    :return: True, if all tests ran passed, False if any of them failed.
+    :param dct: Dict of the test.
+    :param flag: HOST_SETUP_FLAG and/or HOST_CLEANUP_FLAG.
     """
-    test_start_time = time.strftime('%Y-%m-%d-%H.%M.%S')
-    logdir = options.logdir or os.path.join(data_dir.get_root_dir(), 'logs')
-    debugbase = 'run-%s' % test_start_time
-    debugdir = os.path.join(logdir, debugbase)
-    latestdir = os.path.join(logdir, "latest")
-    if not os.path.isdir(debugdir):
-        os.makedirs(debugdir)
-    try:
-        os.unlink(latestdir)
-    except OSError, detail:
-        pass
-    os.symlink(debugbase, latestdir)
+    if dct.get("host_setup_flag", None) is not None:
+        dct["host_setup_flag"] = int(dct["host_setup_flag"]) | flag
+    else:
+        dct["host_setup_flag"] = flag
 
-    debuglog = os.path.join(debugdir, "debug.log")
-    loglevel = options.log_level
-    configure_file_logging(debuglog, loglevel)
 
-    print_stdout(bcolors.HEADER +
-                 "DATA DIR: %s" % data_dir.get_backing_data_dir() +
-                 bcolors.ENDC)
+def _get_run_dicts(parser, options, last_index, host_setup=True):
+    """
+    Generate the dicts of the test job along with their index.
 
-    print_header("DEBUG LOG: %s" % debuglog)
+    The dicts get the parameters that depend on the position of the test in
+    the job (host_setup_flag) and on the host state (kvm_default) added.
+    The host state is read once per job, and again for the tests that set
+    refresh_host_facts.
 
-    last_index = -1
+    :param parser: Config parser object.
+    :param options: Test runner options object.
+    :param last_index: Index of the last test of the job.
+    :param host_setup: Whether the first and last tests set up and clean
+            up the host env; False if the tests run on several hosts.
+    """
+    host_facts = utils_misc.HostFacts()
 
-    logging.info("Starting test job at %s", test_start_time)
-    logging.info("")
+    for index, dct in enumerate(get_test_dicts(parser, options)):
+        if host_setup and index == 0:
+            _add_host_setup_flag(dct, HOST_SETUP_FLAG)
+        if host_setup and index == last_index:
+            _add_host_setup_flag(dct, HOST_CLEANUP_FLAG)
 
-    logging.info(version.get_pretty_version_info())
-    logging.info("")
+        # Add kvm module status
+        if dct.get("refresh_host_facts") == "yes":
+            host_facts.refresh()
+        dct["kvm_default"] = host_facts.get_module_params(
+            dct.get("sysfs_dir", "/sys"), "kvm")
 
-    cleanup_env(parser, options)
+        if options.uri:
+            dct["connect_uri"] = options.uri
 
-    d = parser.get_dicts().next()
+        yield index, dct
 
-    if not options.config:
-        if not options.keep_image_between_tests:
-            logging.debug("Creating first backup of guest image")
-            qemu_img = storage.QemuImg(d, data_dir.get_data_dir(), "image")
-            qemu_img.backup_image(d, data_dir.get_data_dir(), 'backup', True)
-            logging.debug("")
 
-    for line in get_cartesian_parser_details(parser).splitlines():
-        logging.info(line)
+def _count_resumed(result):
+    """
+    Account for the result of a test taken from the journal of the job.
 
-    logging.info("Defined test set:")
-    for i, d in enumerate(parser.get_dicts()):
-        shortname = d.get("_name_map_file")["subtests.cfg"]
+    :param result: Status of the test in the journal.
+    :return: Tuple (failed, failed tests, skipped tests) to add to the job's.
+    """
+    if result == "SKIP":
+        return False, 0, 1
+    if result in ("FAIL", "ERROR"):
+        return result == "FAIL", 1, 0
+    return False, 0, 0
 
-        logging.info("Test %4d:  %s", i + 1, shortname)
-        last_index += 1
 
-    if last_index == -1:
-        print_stdout("No tests generated by config file %s" % parser.filename)
-        print_stdout("Please check the file for errors (bad variable names, "
-                     "wrong indentation)")
-        sys.exit(-1)
-    logging.info("")
+def _run_tests_serial(parser, options, debugdir, last_index, journal,
+                      resumed, timings):
+    """
+    Run the tests of the job one after the other.
 
+    :param parser: Config parser object.
+    :param options: Test runner options object.
+    :param debugdir: Log directory of the job.
+    :param last_index: Index of the last test of the job.
+    :param journal: JobJournal the results of the tests are added to.
+    :param resumed: Results (status, elapsed) of tests not to run again,
+            by test name.
+    :param timings: Dict the phase timings of the tests are added to.
+    :return: Tuple (failed, number of failed tests, number of skipped tests).
+    """
     n_tests = last_index + 1
     n_tests_failed = 0
     n_tests_skipped = 0
-    print_header("TESTS: %s" % n_tests)
-
-    status_dct = {}
+    dep_index = utils_misc.DependencyIndex()
     failed = False
-    # Add the parameter decide if setup host env in the test case
-    # For some special tests we only setup host in the first and last case
-    # When we need to setup host env we need the host_setup_flag as following:
-    #    0(00): do nothing
-    #    1(01): setup env
-    #    2(10): cleanup env
-    #    3(11): setup and cleanup env
-    index = 0
-    setup_flag = 1
-    cleanup_flag = 2
-    job_start_time = time.time()
-
-    for dct in parser.get_dicts():
-        shortname = d.get("_short_name_map_file")["subtests.cfg"]
-
-        if index == 0:
-            if dct.get("host_setup_flag", None) is not None:
-                flag = int(dct["host_setup_flag"])
-                dct["host_setup_flag"] = flag | setup_flag
-            else:
-                dct["host_setup_flag"] = setup_flag
-        if index == last_index:
-            if dct.get("host_setup_flag", None) is not None:
-                flag = int(dct["host_setup_flag"])
-                dct["host_setup_flag"] = flag | cleanup_flag
-            else:
-                dct["host_setup_flag"] = cleanup_flag
-        index += 1
-
-        # Add kvm module status
-        dct["kvm_default"] = utils_misc.get_module_params(
-            dct.get("sysfs_dir", "/sys"), "kvm")
 
+    for index, dct in _get_run_dicts(parser, options, last_index):
         if dct.get("skip") == "yes":
             continue
 
-        dependencies_satisfied = True
-        for dep in dct.get("dep"):
-            for test_name in status_dct.keys():
-                if dep not in test_name:
-                    continue
-
-                if not status_dct[test_name]:
-                    dependencies_satisfied = False
-                    break
+        if dct.get("name") in resumed:
+            result, t_elapsed = resumed[dct.get("name")]
+            dep_index.add(dct.get("name"), result in job_journal.PASSED)
+            t_failed, t_n_failed, t_n_skipped = _count_resumed(result)
+            failed = failed or t_failed
+            n_tests_failed += t_n_failed
+            n_tests_skipped += t_n_skipped
+            print_stdout("(%d/%d) %s (resumed):" % (index + 1, n_tests,
+                                                    Test(dct, options).tag),
+                         end=False)
+            print_result(result, t_elapsed, open_fd=options.show_open_fd)
+            continue
 
-        if options.uri:
-            dct["connect_uri"] = options.uri
+        dependencies_satisfied = dep_index.satisfied(dct.get("dep"))
 
         current_status = False
 
-        pretty_index = "(%d/%d)" % (index, n_tests)
+        pretty_index = "(%d/%d)" % (index + 1, n_tests)
 
         t = Test(dct, options)
         print_stdout("%s %s:" % (pretty_index, t.tag), end=False)
@@ -949,6 +1136,8 @@ def run_tests(parser, options):
                 finally:
                     t_end = time.time()
                     t_elapsed = t_end - t_begin
+                    timings[t.tag] = t.timings
+                    _save_timings(debugdir, timings)
             except error.TestError, reason:
                 n_tests_failed += 1
                 logging.info("ERROR %s -> %s: %s", t.tag,
@@ -956,7 +1145,8 @@ def run_tests(parser, options):
                 logging.info("")
                 t.stop_file_logging()
                 print_error(t_elapsed, open_fd=options.show_open_fd)
-                status_dct[dct.get("name")] = False
+                dep_index.add(dct.get("name"), False)
+                journal.add(dct.get("name"), t.tag, "ERROR", t_elapsed)
                 continue
             except error.TestNAError, reason:
                 n_tests_skipped += 1
@@ -965,7 +1155,8 @@ def run_tests(parser, options):
                 logging.info("")
                 t.stop_file_logging()
                 print_skip(open_fd=options.show_open_fd)
-                status_dct[dct.get("name")] = False
+                dep_index.add(dct.get("name"), False)
+                journal.add(dct.get("name"), t.tag, "SKIP", t_elapsed)
                 continue
             except error.TestWarn, reason:
                 logging.info("WARN %s -> %s: %s", t.tag,
@@ -974,7 +1165,8 @@ def run_tests(parser, options):
                 logging.info("")
                 t.stop_file_logging()
                 print_warn(t_elapsed, open_fd=options.show_open_fd)
-                status_dct[dct.get("name")] = True
+                dep_index.add(dct.get("name"), True)
+                journal.add(dct.get("name"), t.tag, "WARN", t_elapsed)
                 continue
             except Exception, reason:
                 n_tests_failed += 1
@@ -994,22 +1186,605 @@ def run_tests(parser, options):
                 current_status = False
         else:
             print_skip(open_fd=options.show_open_fd)
-            status_dct[dct.get("name")] = False
+            dep_index.add(dct.get("name"), False)
+            journal.add(dct.get("name"), t.tag, "SKIP", 0)
             continue
 
         if not current_status:
             failed = True
             print_fail(t_elapsed, open_fd=options.show_open_fd)
+            journal.add(dct.get("name"), t.tag, "FAIL", t_elapsed)
 
         else:
             print_pass(t_elapsed, open_fd=options.show_open_fd)
+            journal.add(dct.get("name"), t.tag, "PASS", t_elapsed)
+
+        dep_index.add(dct.get("name"), current_status)
+
+    return failed, n_tests_failed, n_tests_skipped
+
+
+def _get_worker_params(worker, dct, numa_placement=None):
+    """
+    Parameters private to a parallel worker.
+
+    Each worker keeps its VMs in its own env file and gives them MAC
+    addresses from its own range, so workers never step on each other.
+    Tests that set numa_pin_worker get the NUMA node and CPUs of the
+    worker as numa_node and numa_cpuset, which qemu_vm and libvirt_vm bind
+    their VMs to.
+
+    :param worker: Index of the worker.
+    :param dct: Test dict the parameters are for.
+    :param numa_placement: (node id, cpuset) of every worker, as returned
+            by utils_misc.get_numa_placement().
+    """
+    style = utils_net.VMNetStyle(dct.get("vm_type", "default"),
+                                 dct.get("driver_type", "default"))
+    params = {"env": "%s%d" % (dct.get("env", "env"), worker),
+              "mac_prefix": "%s:%02x" % (style["mac_prefix"], worker)}
+    if numa_placement and dct.get("numa_pin_worker") == "yes":
+        node_id, cpuset = numa_placement[worker]
+        # numa_node counts the host nodes from 1
+        params["numa_node"] = str(node_id + 1)
+        params["numa_cpuset"] = cpuset
+    return params
+
+
+def _run_test_process(t, debugdir, index, queue):
+    """
+    Run a test in a worker process and report its outcome to the scheduler.
+
+    The process logs only to the debug log of the test, so the logs of
+    tests running at the same time don't get mixed up.
+
+    :param t: Test object.
+    :param debugdir: Log directory of the job.
+    :param index: Index of the test in the job.
+    :param queue: Queue the tuple (index, status, elapsed time, phase
+            timings) is put on.
+    """
+    logger = logging.getLogger()
+    for hdlr in logger.handlers[:]:
+        logger.removeHandler(hdlr)
 
-        status_dct[dct.get("name")] = current_status
+    status = "ERROR"
+    t_begin = time.time()
+    try:
+        t.set_debugdir(debugdir)
+        t.start_file_logging()
+        try:
+            if t.run_once():
+                status = "PASS"
+            else:
+                status = "FAIL"
+            logging.info("%s %s", status, t.tag)
+        except error.TestError, reason:
+            status = "ERROR"
+            logging.info("ERROR %s -> %s: %s", t.tag,
+                         reason.__class__.__name__, reason)
+        except error.TestNAError, reason:
+            status = "SKIP"
+            logging.info("SKIP %s -> %s: %s", t.tag,
+                         reason.__class__.__name__, reason)
+        except error.TestWarn, reason:
+            status = "WARN"
+            logging.info("WARN %s -> %s: %s", t.tag,
+                         reason.__class__.__name__, reason)
+        except Exception, reason:
+            status = "EXCEPTION"
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            logging.error("")
+            tb_info = traceback.format_exception(exc_type, exc_value,
+                                                 exc_traceback.tb_next)
+            for e_line in "".join(tb_info).splitlines():
+                logging.error(e_line)
+            logging.error("")
+            logging.error("FAIL %s -> %s: %s", t.tag,
+                          reason.__class__.__name__, reason)
+        logging.info("")
+        t.stop_file_logging()
+    finally:
+        queue.put((index, status, time.time() - t_begin, t.timings))
+
+
+def _destroy_worker_env(vm_type, env_name):
+    """
+    Destroy the VMs and processes a parallel worker left behind.
+
+    :param vm_type: VM type of the tests the worker ran.
+    :param env_name: Name of the env file of the worker.
+    """
+    env_filename = os.path.join(data_dir.get_backend_dir(vm_type), env_name)
+    if os.path.isfile(env_filename):
+        env = utils_env.Env(filename=env_filename, version=Test.env_version)
+        env.destroy()
+
+
+def _run_tests_parallel(parser, options, debugdir, last_index, journal,
+                        resumed, timings):
+    """
+    Run independent tests of the job at the same time in worker processes.
+
+    Every test runs in a process of its own on one of options.parallel
+    workers. The VMs of a worker stay in its env file between tests, and a
+    worker only takes a test if the used_cpus and used_mem params of the
+    tests on all the workers fit into options.parallel_cpus CPUs and
+    options.parallel_mem MB (a test that doesn't fit at all still runs, on
+    its own). A test runs once all the earlier tests it depends on are done
+    and then on the worker of the last of them, so it finds the VMs they
+    prepared. The first and the last test of the job, which set up and
+    clean up the host, run alone.
+
+    :param parser: Config parser object.
+    :param options: Test runner options object.
+    :param debugdir: Log directory of the job.
+    :param last_index: Index of the last test of the job.
+    :param journal: JobJournal the results of the tests are added to.
+    :param resumed: Results (status, elapsed) of tests not to run again,
+            by test name.
+    :param timings: Dict the phase timings of the tests are added to.
+    :return: Tuple (failed, number of failed tests, number of skipped tests).
+    """
+    n_tests = last_index + 1
+    n_tests_failed = 0
+    n_tests_skipped = 0
+    failed = False
+    n_workers = options.parallel
+    total_cpus = options.parallel_cpus or utils.count_cpus()
+    total_mem = options.parallel_mem or utils.memtotal() / 1024
+
+    tests = list(_get_run_dicts(parser, options, last_index))
+    runnable = [i for i, dct in tests if dct.get("skip") != "yes"]
+    prereqs = distributed_runner.get_prereqs([tests[i] for i in runnable])
+
+    numa_placement = None
+    if [i for i in runnable if tests[i][1].get("numa_pin_worker") == "yes"]:
+        try:
+            numa_placement = utils_misc.get_numa_placement(n_workers)
+        except Exception, details:
+            logging.warning("Cannot place the workers on NUMA nodes, "
+                            "running the tests unpinned: %s", details)
+        else:
+            for worker, (node_id, cpuset) in enumerate(numa_placement):
+                logging.info("Worker %d: NUMA node %d, CPUs %s", worker,
+                             node_id, cpuset)
+
+    status = {}
+    test_worker = {}
+    used_cpus = [0] * n_workers
+    used_mem = [0] * n_workers
+    worker_env = [None] * n_workers
+    running = {}
+    queue = multiprocessing.Queue()
+    pending = runnable[:]
+
+    def report(index, dct, result, t_elapsed):
+        pretty_index = "(%d/%d)" % (index + 1, n_tests)
+        tag = Test(dct, options).tag
+        if result == "EXCEPTION":
+            result = "FAIL"
+        logging.info("%s %s: %s", pretty_index, tag, result)
+        print_stdout("%s %s:" % (pretty_index, tag), end=False)
+        print_result(result, t_elapsed, open_fd=options.show_open_fd)
+        journal.add(dct["name"], tag, result, t_elapsed)
+
+    def fits(worker, dct):
+        # Resources of the other workers plus the ones of the test; a test
+        # that is too big for the budgets still runs when nothing else does
+        cpus = sum(used_cpus) - used_cpus[worker]
+        mem = sum(used_mem) - used_mem[worker]
+        if cpus and cpus + int(dct.get("used_cpus", 1)) > total_cpus:
+            return False
+        if mem and mem + int(dct.get("used_mem", 128)) > total_mem:
+            return False
+        return True
+
+    def start(index, worker):
+        dct = tests[index][1].copy()
+        dct.update(_get_worker_params(worker, dct, numa_placement))
+        t = Test(dct, options)
+        used_cpus[worker] = int(dct.get("used_cpus", 1))
+        used_mem[worker] = int(dct.get("used_mem", 128))
+        worker_env[worker] = (dct.get("vm_type"), dct["env"])
+        test_worker[index] = worker
+        process = multiprocessing.Process(target=_run_test_process,
+                                          args=(t, debugdir, index, queue))
+        process.start()
+        running[worker] = (index, process)
+        logging.info("Starting %s on worker %d", t.tag, worker)
+
+    def clean(worker):
+        logging.info("Cleaning up worker %d", worker)
+        _destroy_worker_env(*worker_env[worker])
+        used_cpus[worker] = 0
+        used_mem[worker] = 0
+
+    for index in runnable:
+        dct = tests[index][1]
+        if dct["name"] not in resumed:
+            continue
+        result, t_elapsed = resumed[dct["name"]]
+        pending.remove(index)
+        status[index] = result in job_journal.PASSED
+        t_failed, t_n_failed, t_n_skipped = _count_resumed(result)
+        failed = failed or t_failed
+        n_tests_failed += t_n_failed
+        n_tests_skipped += t_n_skipped
+        print_stdout("(%d/%d) %s (resumed):" % (index + 1, n_tests,
+                                                Test(dct, options).tag),
+                     end=False)
+        print_result(result, t_elapsed, open_fd=options.show_open_fd)
+
+    while pending or running:
+        idle = [w for w in xrange(n_workers) if w not in running]
+        started = False
+        blocked = None
+        for index in pending[:]:
+            if not idle:
+                break
+            dct = tests[index][1]
+            # The tests setting up and cleaning up the host run alone
+            if index != runnable[0] and runnable[0] not in status:
+                break
+            if index == runnable[-1] and (running or len(pending) > 1):
+                break
+            if [j for j in prereqs[index] if j not in status]:
+                continue
+            if [j for j in prereqs[index] if not status[j]]:
+                pending.remove(index)
+                status[index] = False
+                report(index, dct, "SKIP", 0)
+                continue
+            keep = []
+            workers = idle
+            worker = None
+            if prereqs[index]:
+                # Tests resumed from the journal didn't run on any worker
+                worker = test_worker.get(prereqs[index][-1])
+            if worker is not None:
+                if worker not in idle:
+                    continue
+                keep = workers = [worker]
+            workers = [w for w in workers if fits(w, dct)]
+            if not workers:
+                if blocked is None:
+                    blocked = keep
+                continue
+            pending.remove(index)
+            start(index, workers[0])
+            idle.remove(workers[0])
+            started = True
+
+        if blocked is not None and not started:
+            # No test fits next to the VMs of the idle workers, shut some
+            # down rather than waiting for the busy workers only
+            for worker in idle:
+                if worker not in blocked and (used_cpus[worker] or
+                                              used_mem[worker]):
+                    clean(worker)
+                    break
+            else:
+                blocked = None
+            if blocked is not None:
+                continue
+
+        if not running:
+            continue
+        try:
+            index, result, t_elapsed, t_timings = queue.get(timeout=1)
+        except Queue.Empty:
+            # A process that died without a word (e.g. killed) counts as
+            # an error of its test
+            for worker, (index, process) in running.items():
+                if not process.is_alive() and queue.empty():
+                    process.join()
+                    del running[worker]
+                    status[index] = False
+                    n_tests_failed += 1
+                    report(index, tests[index][1], "ERROR", 0)
+            continue
+
+        worker = test_worker[index]
+        running[worker][1].join()
+        del running[worker]
+        status[index] = result in ("PASS", "WARN")
+        if result in ("ERROR", "EXCEPTION"):
+            n_tests_failed += 1
+        elif result == "SKIP":
+            n_tests_skipped += 1
+        if result in ("FAIL", "EXCEPTION"):
+            failed = True
+        timings[Test(tests[index][1], options).tag] = t_timings
+        _save_timings(debugdir, timings)
+        report(index, tests[index][1], result, t_elapsed)
+
+    for worker in xrange(n_workers):
+        if worker_env[worker] is not None:
+            clean(worker)
+
+    return failed, n_tests_failed, n_tests_skipped
+
+
+def _run_tests_distributed(parser, options, debugdir, last_index, journal,
+                           resumed, timings):
+    """
+    Hand the tests of the job to workers on other hosts.
+
+    The tests go to the workers that connect to options.coordinator
+    (see run_worker()); their logs end up in the debug dirs of the tests in
+    the job's debug dir, as if they ran locally.
+
+    :param parser: Config parser object.
+    :param options: Test runner options object.
+    :param debugdir: Log directory of the job.
+    :param last_index: Index of the last test of the job.
+    :param journal: JobJournal the results of the tests are added to.
+    :param resumed: Results (status, elapsed) of tests not to run again,
+            by test name.
+    :param timings: Dict the phase timings of the tests are added to.
+    :return: Tuple (failed, number of failed tests, number of skipped tests).
+    """
+    n_tests = last_index + 1
+    counts = {"failed": False, "n_failed": 0, "n_skipped": 0}
+
+    # The workers set up and clean up their own hosts
+    tests = [(index, dct) for index, dct in
+             _get_run_dicts(parser, options, last_index, host_setup=False)
+             if dct.get("skip") != "yes"]
+    tags = dict((index, Test(dct, options).tag) for index, dct in tests)
+    done = {}
+    for index, dct in tests:
+        if dct["name"] not in resumed:
+            continue
+        result, t_elapsed = resumed[dct["name"]]
+        done[index] = result in job_journal.PASSED
+        t_failed, t_n_failed, t_n_skipped = _count_resumed(result)
+        counts["failed"] = counts["failed"] or t_failed
+        counts["n_failed"] += t_n_failed
+        counts["n_skipped"] += t_n_skipped
+        print_stdout("(%d/%d) %s (resumed):" % (index + 1, n_tests,
+                                                tags[index]),
+                     end=False)
+        print_result(result, t_elapsed, open_fd=options.show_open_fd)
+
+    coordinator = distributed_runner.Coordinator(
+        tests, distributed_runner.parse_address(options.coordinator),
+        done=done)
+    print_header("COORDINATOR: %s:%d" % coordinator.address)
+    dicts = dict(tests)
+
+    def on_result(index, result, t_elapsed, t_timings, worker):
+        pretty_index = "(%d/%d)" % (index + 1, n_tests)
+        if result == "ERROR":
+            counts["n_failed"] += 1
+        elif result == "FAIL":
+            counts["failed"] = True
+            counts["n_failed"] += 1
+        elif result == "SKIP":
+            counts["n_skipped"] += 1
+        logging.info("%s %s: %s (worker %s)", pretty_index, tags[index],
+                     result, worker)
+        print_stdout("%s %s:" % (pretty_index, tags[index]), end=False)
+        print_result(result, t_elapsed, open_fd=options.show_open_fd)
+        journal.add(dicts[index]["name"], tags[index], result, t_elapsed)
+        if t_timings:
+            timings[tags[index]] = t_timings
+            _save_timings(debugdir, timings)
+
+    def on_log(index, data):
+        test_debugdir = os.path.join(debugdir, tags[index])
+        if not os.path.isdir(test_debugdir):
+            os.makedirs(test_debugdir)
+        log_file = open(os.path.join(test_debugdir, "debug.log"), "a")
+        try:
+            log_file.write(data.encode("utf-8"))
+        finally:
+            log_file.close()
+
+    coordinator.run(on_result, on_log)
+
+    return counts["failed"], counts["n_failed"], counts["n_skipped"]
+
+
+def run_worker(options):
+    """
+    Run the tests a coordinator (see run_tests()) hands out on this host.
+
+    :param options: Test runner options object, options.worker being the
+            host:port of the coordinator.
+    :return: True.
+    """
+    logdir = options.logdir or os.path.join(data_dir.get_root_dir(), 'logs')
+    debugdir = os.path.join(logdir, 'worker-%s-%d' %
+                            (time.strftime('%Y-%m-%d-%H.%M.%S'), os.getpid()))
+    if not os.path.isdir(debugdir):
+        os.makedirs(debugdir)
+    configure_file_logging(os.path.join(debugdir, "debug.log"),
+                           options.log_level)
+    print_header("DEBUG LOG: %s" % os.path.join(debugdir, "debug.log"))
+    print_header("COORDINATOR: %s" % options.worker)
+    queue = multiprocessing.Queue()
+    host_facts = utils_misc.HostFacts()
+
+    def run_test(dct, log, first, last):
+        # Set up this host before its first test, clean it up after its last
+        if first:
+            _add_host_setup_flag(dct, HOST_SETUP_FLAG)
+        if last:
+            _add_host_setup_flag(dct, HOST_CLEANUP_FLAG)
+        # The kvm module of this host, not the one of the coordinator's
+        if dct.get("refresh_host_facts") == "yes":
+            host_facts.refresh()
+        dct["kvm_default"] = host_facts.get_module_params(
+            dct.get("sysfs_dir", "/sys"), "kvm")
+        t = Test(dct, options)
+        print_stdout("%s:" % t.tag, end=False)
+        logfile = os.path.join(debugdir, t.tag, "debug.log")
+        offset = 0
+        if os.path.isfile(logfile):
+            offset = os.path.getsize(logfile)
+        process = multiprocessing.Process(target=_run_test_process,
+                                          args=(t, debugdir, 0, queue))
+        process.start()
+        result = None
+        while result is None:
+            try:
+                result = queue.get(timeout=1)
+            except Queue.Empty:
+                if not process.is_alive() and queue.empty():
+                    result = (0, "ERROR", 0, {})
+            if os.path.isfile(logfile):
+                log_file = open(logfile)
+                try:
+                    log_file.seek(offset)
+                    data = log_file.read()
+                finally:
+                    log_file.close()
+                offset += len(data)
+                if data:
+                    log(data)
+        process.join()
+        _, status, t_elapsed, t_timings = result
+        if status == "EXCEPTION":
+            status = "FAIL"
+        print_result(status, t_elapsed, open_fd=options.show_open_fd)
+        return status, t_elapsed, t_timings
+
+    distributed_runner.run_worker(
+        distributed_runner.parse_address(options.worker), run_test)
+    return True
+
+
+def run_tests(parser, options):
+    """
+    Runs the sequence of KVM tests based on the list of dctionaries
+    generated by the configuration system, handling dependencies.
+
+    :param parser: Config parser object.
+    :param options: Test runner options object.
+    :return: True, if all tests ran passed, False if any of them failed.
+    """
+    test_start_time = time.strftime('%Y-%m-%d-%H.%M.%S')
+    logdir = options.logdir or os.path.join(data_dir.get_root_dir(), 'logs')
+    debugbase = 'run-%s' % test_start_time
+    if options.resume:
+        # Continue the job in its own debug dir
+        logdir, debugbase = os.path.split(
+            os.path.abspath(options.resume).rstrip(os.sep))
+    debugdir = os.path.join(logdir, debugbase)
+    latestdir = os.path.join(logdir, "latest")
+    if not os.path.isdir(debugdir):
+        os.makedirs(debugdir)
+    try:
+        os.unlink(latestdir)
+    except OSError, detail:
+        pass
+    os.symlink(debugbase, latestdir)
+
+    debuglog = os.path.join(debugdir, "debug.log")
+    loglevel = options.log_level
+    configure_file_logging(debuglog, loglevel)
+
+    print_stdout(bcolors.HEADER +
+                 "DATA DIR: %s" % data_dir.get_backing_data_dir() +
+                 bcolors.ENDC)
+
+    print_header("DEBUG LOG: %s" % debuglog)
+
+    last_index = -1
+
+    logging.info("Starting test job at %s", test_start_time)
+    logging.info("")
+
+    logging.info(version.get_pretty_version_info())
+    logging.info("")
+
+    cleanup_env(parser, options)
+
+    d = parser.get_dicts().next()
+
+    if not options.config:
+        if not options.keep_image_between_tests:
+            logging.debug("Creating first backup of guest image")
+            qemu_img = storage.QemuImg(d, data_dir.get_data_dir(), "image")
+            qemu_img.backup_image(d, data_dir.get_data_dir(), 'backup', True)
+            logging.debug("")
+
+    for line in get_cartesian_parser_details(parser).splitlines():
+        logging.info(line)
+
+    logging.info("Defined test set:")
+    for i, d in enumerate(get_test_dicts(parser, options)):
+        shortname = d.get("_name_map_file")["subtests.cfg"]
+
+        logging.info("Test %4d:  %s", i + 1, shortname)
+        last_index += 1
+
+        # Index the test modules up front (before any worker processes
+        # start); a missing test dir is reported when the test runs
+        try:
+            TEST_MODULES.get_subtest_dirs(d, data_dir.get_root_dir())
+        except error.TestError:
+            pass
+
+    if last_index == -1:
+        print_stdout("No tests generated by config file %s" % parser.filename)
+        print_stdout("Please check the file for errors (bad variable names, "
+                     "wrong indentation)")
+        sys.exit(-1)
+    logging.info("")
+
+    n_tests = last_index + 1
+    print_header("TESTS: %s" % n_tests)
+
+    if options.reorder_tests:
+        boots = order_planner.count_boots(
+            get_test_dicts(parser, options, reorder=False))
+        planned_boots = order_planner.count_boots(
+            get_test_dicts(parser, options))
+        print_header("VM BOOTS SAVED BY TEST ORDER: %d (%d instead of %d)" %
+                     (boots - planned_boots, planned_boots, boots))
+        logging.info("Test order needs %d VM boots instead of %d",
+                     planned_boots, boots)
+        logging.info("")
+
+    journal = job_journal.JobJournal(debugdir)
+    resumed = {}
+    if options.resume:
+        for name, (result, t_elapsed) in journal.get_results().items():
+            if result in job_journal.PASSED or not options.rerun_failed:
+                resumed[name] = (result, t_elapsed)
+        logging.info("Resuming job %s, %d test results taken from %s",
+                     debugdir, len(resumed), journal.filename)
+        logging.info("")
+
+    timings = {}
+    if options.resume:
+        timings = _load_timings(debugdir)
+
+    job_start_time = time.time()
+
+    if options.coordinator:
+        failed, n_tests_failed, n_tests_skipped = _run_tests_distributed(
+            parser, options, debugdir, last_index, journal, resumed, timings)
+    elif options.parallel > 1:
+        failed, n_tests_failed, n_tests_skipped = _run_tests_parallel(
+            parser, options, debugdir, last_index, journal, resumed, timings)
+    else:
+        failed, n_tests_failed, n_tests_skipped = _run_tests_serial(
+            parser, options, debugdir, last_index, journal, resumed, timings)
+    journal.close()
+    _save_timings(debugdir, timings)
 
     cleanup_env(parser, options)
 
     job_end_time = time.time()
     job_elapsed_time = job_end_time - job_start_time
-    _job_report(job_elapsed_time, n_tests, n_tests_skipped, n_tests_failed)
+    _job_report(job_elapsed_time, n_tests, n_tests_skipped, n_tests_failed,
+                timings)
+    if parser.profile is not None:
+        for line in parser.profile.report().splitlines():
+            logging.info(line)
 
     return not failed
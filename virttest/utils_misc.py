@@ -495,6 +495,81 @@ def get_hash_from_file(hash_path, dvd_basename):
             return line.split()[0]
 
 
+class HostFacts(object):
+
+    """
+    Facts about the host read once and shared by the tests of a job.
+
+    The tests of a job would otherwise read them again from sysfs for every
+    test dict. refresh() drops them, e.g. after a test reloaded a module.
+    """
+
+    def __init__(self):
+        self._module_params = {}
+
+    def get_module_params(self, sys_path, module_name):
+        """
+        Get the params of a module, see get_module_params().
+
+        :param sys_path: sysfs path for modules info
+        :param module_name: module to check
+        """
+        key = (sys_path, module_name)
+        if key not in self._module_params:
+            self._module_params[key] = get_module_params(sys_path,
+                                                         module_name)
+        return self._module_params[key]
+
+    def refresh(self):
+        """
+        Read the facts from the host again the next time they're needed.
+        """
+        self._module_params = {}
+
+
+class DependencyIndex(object):
+
+    """
+    Index from the dep params of tests to the status of the tests they
+    match, i.e. the finished tests whose names contain them.
+
+    Checking the deps of a test costs a lookup per dep instead of a scan of
+    all the finished tests.
+    """
+
+    def __init__(self):
+        self._failed = []
+        self._dep_failed = {}
+
+    def add(self, name, passed):
+        """
+        Record the outcome of a test.
+
+        :param name: Name of the test.
+        :param passed: Whether the tests depending on it may run.
+        """
+        if passed:
+            return
+        self._failed.append(name)
+        for dep in self._dep_failed:
+            if dep in name:
+                self._dep_failed[dep] = True
+
+    def satisfied(self, deps):
+        """
+        Check whether none of the tests deps match failed.
+
+        :param deps: The dep param of a test.
+        """
+        for dep in deps:
+            if dep not in self._dep_failed:
+                self._dep_failed[dep] = bool([name for name in self._failed
+                                              if dep in name])
+            if self._dep_failed[dep]:
+                return False
+        return True
+
+
 def run_tests(parser, job):
     """
     Runs the sequence of KVM tests based on the list of dictionaries
@@ -510,7 +585,8 @@ def run_tests(parser, job):
         logging.info("Test %4d:  %s" % (i + 1, d["shortname"]))
         last_index += 1
 
-    status_dict = {}
+    dep_index = DependencyIndex()
+    host_facts = HostFacts()
     failed = False
     # Add the parameter decide if setup host env in the test case
     # For some special tests we only setup host in the first and last case
@@ -539,22 +615,15 @@ def run_tests(parser, job):
         index += 1
 
         # Add kvm module status
+        if param_dict.get("refresh_host_facts") == "yes":
+            host_facts.refresh()
         sysfs_dir = param_dict.get("sysfs_dir", "/sys")
-        param_dict["kvm_default"] = get_module_params(sysfs_dir, 'kvm')
+        param_dict["kvm_default"] = host_facts.get_module_params(sysfs_dir,
+                                                                 'kvm')
 
         if param_dict.get("skip") == "yes":
             continue
-        dependencies_satisfied = True
-        for dep in param_dict.get("dep"):
-            for test_name in status_dict.keys():
-                if dep not in test_name:
-                    continue
-                # So the only really non-fatal state is WARN,
-                # All the others make it not safe to proceed with dependency
-                # execution
-                if status_dict[test_name] not in ['GOOD', 'WARN']:
-                    dependencies_satisfied = False
-                    break
+        dependencies_satisfied = dep_index.satisfied(param_dict.get("dep"))
         test_iterations = int(param_dict.get("iterations", 1))
         test_tag = param_dict.get(
             "vm_type") + "." + param_dict.get("shortname")
@@ -587,7 +656,11 @@ def run_tests(parser, job):
         if not base_job.JOB_STATUSES[current_status]:
             failed = True
 
-        status_dict[param_dict.get("name")] = current_status
+        # So the only really non-fatal state is WARN,
+        # All the others make it not safe to proceed with dependency
+        # execution
+        dep_index.add(param_dict.get("name"),
+                      current_status in ['GOOD', 'WARN'])
 
     return not failed
 
@@ -1477,6 +1550,42 @@ class NumaNode(object):
             logging.info("    %s: %s" % (i, self.dict[i]))
 
 
+def get_numa_placement(num_workers, numa_info=None):
+    """
+    Spread parallel test workers over the NUMA nodes of the host.
+
+    Workers go to the online nodes in turn. The workers sharing a node split
+    its CPUs between them, unless the node has fewer CPUs than workers, in
+    which case they all get the whole node.
+
+    :param num_workers: Number of workers.
+    :param numa_info: NumaInfo of the host, read from the host by default.
+    :return: List of (node id, cpuset) tuples, one per worker; cpuset is a
+            comma separated list of CPU ids.
+    :rtype: list
+    """
+    if numa_info is None:
+        numa_info = NumaInfo()
+    node_ids = sorted(numa_info.nodes)
+    node_workers = {}
+    for worker in xrange(num_workers):
+        node_id = node_ids[worker % len(node_ids)]
+        node_workers.setdefault(node_id, []).append(worker)
+
+    placement = [None] * num_workers
+    for node_id, workers in node_workers.items():
+        cpus = numa_info.nodes[node_id].cpus
+        n_cpus = len(cpus)
+        for i, worker in enumerate(workers):
+            if n_cpus >= len(workers):
+                worker_cpus = cpus[i * n_cpus / len(workers):
+                                   (i + 1) * n_cpus / len(workers)]
+            else:
+                worker_cpus = cpus
+            placement[worker] = (node_id, ",".join(worker_cpus))
+    return placement
+
+
 def get_dev_major_minor(dev):
     """
     Get the major and minor numbers of the device
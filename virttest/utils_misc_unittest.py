@@ -1,6 +1,7 @@
 #!/usr/bin/python
 
 import os
+import shutil
 import tempfile
 import unittest
 
@@ -73,6 +74,35 @@ git_repo_foo_commit = bc732ad8b2ed8be52160b893735417b43a1e91a8
         self.assertEqual(h.lbranch, 'local')
         self.assertEqual(h.commit, 'bc732ad8b2ed8be52160b893735417b43a1e91a8')
 
+    def test_dependency_index(self):
+        dep_index = utils_misc.DependencyIndex()
+        self.assertTrue(dep_index.satisfied(["install"]))
+        dep_index.add("qcow2.install.f20", True)
+        dep_index.add("raw.install.f20", False)
+        self.assertTrue(dep_index.satisfied(["qcow2.install"]))
+        self.assertFalse(dep_index.satisfied(["install"]))
+        self.assertTrue(dep_index.satisfied(["boot"]))
+        dep_index.add("raw.boot.f20", False)
+        self.assertFalse(dep_index.satisfied(["boot"]))
+        self.assertFalse(dep_index.satisfied(["qcow2.install", "raw"]))
+
+    def test_host_facts(self):
+        sys_path = tempfile.mkdtemp()
+        params_dir = os.path.join(sys_path, "module", "kvm", "parameters")
+        os.makedirs(params_dir)
+        param_file = os.path.join(params_dir, "ignore_msrs")
+        open(param_file, "w").write("N\n")
+        host_facts = utils_misc.HostFacts()
+        self.assertEqual(host_facts.get_module_params(sys_path, "kvm"),
+                         {param_file: "N"})
+        open(param_file, "w").write("Y\n")
+        self.assertEqual(host_facts.get_module_params(sys_path, "kvm"),
+                         {param_file: "N"})
+        host_facts.refresh()
+        self.assertEqual(host_facts.get_module_params(sys_path, "kvm"),
+                         {param_file: "Y"})
+        shutil.rmtree(sys_path)
+
     def test_normalize_data_size(self):
         n1 = utils_misc.normalize_data_size("12M")
         n2 = utils_misc.normalize_data_size("1024M", "G")
@@ -198,6 +228,14 @@ class TestNumaNode(unittest.TestCase):
         self.assertEqual(self.numa_node.dict["0"], [])
         self.assertEqual(self.numa_node.dict["1"], ["1231"])
 
+    def test_get_numa_placement(self):
+        numa_info = utils_misc.NumaInfo(self.all_nodes_path,
+                                        self.online_nodes_path)
+        self.assertEqual(utils_misc.get_numa_placement(3, numa_info),
+                         [(0, "0,1"), (0, "2,3,4"), (0, "5,6,7")])
+        self.assertEqual(utils_misc.get_numa_placement(10, numa_info)[9],
+                         (0, "0,1,2,3,4,5,6,7"))
+
     def test_bitlist_to_string(self):
         string = 'foo'
         bitlist = [0, 1, 1, 0, 0, 1, 1, 0, 0, 1,
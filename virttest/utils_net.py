@@ -1938,6 +1938,9 @@ class VMNet(list):
         for key, value in VMNetStyle(self.vm_type,
                                      self.driver_type).items():
             setattr(self, key, value)
+        # A private range of addresses, e.g. of a parallel test worker
+        if self.params.get('mac_prefix'):
+            self.mac_prefix = self.params['mac_prefix']
 
     def process_mac(self, value):
         """
@@ -27,7 +27,6 @@ import urlparse
 import re
 import weakref
 import time
-import select
 import utils_misc
 from autotest.client import utils
 from autotest.client import os_dep
@@ -220,7 +219,7 @@ class VirshSession(aexpect.ShellSession):
             logging.debug(result)
         return result
 
-    def read_until_output_matches(self, patterns, filter_func=lambda x: x,
+    def read_until_output_matches(self, patterns, filter_func=None,
                                   timeout=60, internal_timeout=None,
                                   print_func=None, match_func=None):
         """
@@ -233,7 +232,7 @@ class VirshSession(aexpect.ShellSession):
         :param patterns: List of strings (regular expression patterns)
         :param filter_func: Function to apply to the data read from the child before
                 attempting to match it against the patterns (should take and
-                return a string)
+                return a string), or None
         :param timeout: The duration (in seconds) to wait until a match is
                 found
         :param internal_timeout: The timeout to pass to read_nonblocking
@@ -246,18 +245,14 @@ class VirshSession(aexpect.ShellSession):
                 terminates while waiting for output
         :raise ExpectError: Raised if an unknown error occurs
         """
+        matcher = self._get_output_matcher(patterns, filter_func, match_func)
         if not match_func:
             match_func = self.match_patterns
-        fd = self._get_fd("expect")
         o = ""
         end_time = time.time() + timeout
         while True:
-            try:
-                r, w, x = select.select([fd], [], [],
-                                        max(0, end_time - time.time()))
-            except (select.error, TypeError):
-                break
-            if not r:
+            if not self._poll_reader("expect",
+                                     max(0, end_time - time.time())):
                 raise aexpect.ExpectTimeoutError(patterns, o)
             # Read data from child
             data = self.read_nonblocking(internal_timeout,
@@ -272,7 +267,7 @@ class VirshSession(aexpect.ShellSession):
             o += data
 
             out = ''
-            match = match_func(filter_func(o), patterns)
+            match = matcher(o)
             if match is not None:
                 output = o.splitlines()
                 # Find the second match in output reverse list, only return
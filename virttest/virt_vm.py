@@ -860,7 +860,7 @@ class BaseVM(object):
         panic_re.append(r"general protection fault:.* RSP.*>")
         panic_re = "|".join(panic_re)
         if self.serial_console is not None:
-            data = self.serial_console.get_output()
+            data = self.serial_console.map_output()
             match = re.search(panic_re, data, re.DOTALL | re.MULTILINE | re.I)
             if match is not None:
                 raise VMDeadKernelCrashError(match.group(0))
@@ -887,7 +887,7 @@ class BaseVM(object):
         :raise: VMInvalidInstructionCode, in case a wrong instruction code.
         """
         if self.serial_console is not None:
-            data = self.serial_console.get_output()
+            data = self.serial_console.map_output()
             match = re.findall(r".*trap invalid opcode.*\n", data,
                                re.MULTILINE)
 
@@ -957,6 +957,8 @@ class BaseVM(object):
                                       interface=neigh_attach_if)
         session.set_status_test_command(self.params.get("status_test_command",
                                                         ""))
+        session.set_status_sentinel(self.params.get("status_sentinel") ==
+                                    "yes")
         self.remote_sessions.append(session)
         return session
 
@@ -1161,12 +1163,13 @@ class BaseVM(object):
         status_test_command = self.params.get("status_test_command", "")
 
         # Some times need recreate the serial_console.
-        if not (self.serial_console and
-                os.path.exists(self.serial_console.inpipe_filename)):
+        if not (self.serial_console and self.serial_console.is_alive()):
             self.create_serial_console()
 
         self.serial_console.set_linesep(linesep)
         self.serial_console.set_status_test_command(status_test_command)
+        self.serial_console.set_status_sentinel(
+            self.params.get("status_sentinel") == "yes")
 
         # Try to get a login prompt
         self.serial_console.sendline()